@@ -7,10 +7,24 @@ from sqlalchemy import text
 from datetime import timedelta
 import os
 from models import db
+from services.redis_client import init_redis
+from services.principal_cache import init_principal_cache
+from services.token_versions import init_token_versions, is_token_revoked
+from services.passwords import init_password_hasher
+from services.rate_limit import init_rate_limiter
+from services.exchange_rates import init_exchange_rates
+from services.storage import init_storage
+from services.uploads import init_uploads
+from services.previews import init_previews
+from services.signed_urls import init_signed_urls
+from services.versioning import init_versioning
+from services.idempotency import init_idempotency
+from services.rollups import init_rollups, backfill_rollups
 from routes.auth import bp as auth_bp
 from routes.delegations import bp as delegations_bp
 from routes.admin import bp as admin_bp
 from routes.manager import bp as manager_bp
+from routes.files import bp as files_bp
 from seed_users import init_seed
 
 load_dotenv()
@@ -27,8 +41,9 @@ CORS(app, resources={
             "http://127.0.0.1:3000"
         ],
         "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "expose_headers": ["Content-Type", "Authorization"],
+        "allow_headers": ["Content-Type", "Authorization", "Upload-Offset", "If-None-Match", "Idempotency-Key"],
+        "expose_headers": ["Content-Type", "Authorization", "X-Next-Cursor", "Link", "Retry-After",
+                           "Location", "Upload-Offset", "Upload-Length", "ETag", "Idempotent-Replayed"],
         "supports_credentials": False
     }
 })
@@ -40,6 +55,56 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'super-secret')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=24)
 app.config['DEV_SEED'] = os.getenv('DEV_SEED', 'false')
+app.config['REDIS_URL'] = os.getenv('REDIS_URL')
+app.config['PRINCIPAL_CACHE_TTL'] = int(os.getenv('PRINCIPAL_CACHE_TTL', '60'))
+app.config['PRINCIPAL_CACHE_SIZE'] = int(os.getenv('PRINCIPAL_CACHE_SIZE', '10000'))
+app.config['TOKEN_VERSION_CACHE_TTL'] = int(os.getenv('TOKEN_VERSION_CACHE_TTL', '30'))
+# Wersje tokenów w Redis uzupełniane z bazy wygasają po tylu sekundach (opublikowane podbicia nie)
+app.config['TOKEN_VERSION_FILL_TTL'] = int(os.getenv('TOKEN_VERSION_FILL_TTL', '3600'))
+# Koszt bcrypt i pula procesów hashujących hasła
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', '12'))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or None
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.getenv('PASSWORD_HASH_MAX_PENDING', '0')) or None
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+app.config['PASSWORD_HASH_RETRY_AFTER'] = int(os.getenv('PASSWORD_HASH_RETRY_AFTER', '1'))
+# Limity logowania: "pojemność/sekundy" kubełka tokenów
+app.config['LOGIN_RATE_LIMIT_EMAIL'] = os.getenv('LOGIN_RATE_LIMIT_EMAIL', '5/60')
+app.config['LOGIN_RATE_LIMIT_IP'] = os.getenv('LOGIN_RATE_LIMIT_IP', '30/60')
+# Import pracowników: limit wierszy na żądanie - każdy wiersz to jeden hash bcrypt w puli haseł;
+# import jest synchroniczny, 500 wierszy przy koszcie 12 to do ok. 30 s odpowiedzi (patrz ENDPOINTS.md)
+app.config['BULK_IMPORT_MAX_ROWS'] = int(os.getenv('BULK_IMPORT_MAX_ROWS', '500'))
+# Maksymalna liczba decyzji w jednym POST /api/manager/items/decisions
+app.config['MANAGER_DECISIONS_MAX_ITEMS'] = int(os.getenv('MANAGER_DECISIONS_MAX_ITEMS', '1000'))
+# GET /api/delegations: domyślny i maksymalny rozmiar strony, gdy klient stronicuje (limit/cursor)
+app.config['DELEGATIONS_PAGE_SIZE'] = int(os.getenv('DELEGATIONS_PAGE_SIZE', '100'))
+app.config['DELEGATIONS_MAX_PAGE_SIZE'] = int(os.getenv('DELEGATIONS_MAX_PAGE_SIZE', '500'))
+app.config['EXCHANGE_RATE_CACHE_TTL'] = int(os.getenv('EXCHANGE_RATE_CACHE_TTL', '3600'))
+# Strumieniowe dodawanie wydatków (NDJSON): rozmiar partii i maksymalna długość linii
+app.config['EXPENSE_STREAM_BATCH_SIZE'] = int(os.getenv('EXPENSE_STREAM_BATCH_SIZE', '200'))
+app.config['EXPENSE_STREAM_MAX_LINE_BYTES'] = int(os.getenv('EXPENSE_STREAM_MAX_LINE_BYTES', '65536'))
+# Magazyn plików dokumentów (adresowany SHA-256) i limit rozmiaru pojedynczego pliku
+app.config['DOCUMENT_STORAGE_ROOT'] = os.getenv('DOCUMENT_STORAGE_ROOT', os.path.join(app.root_path, 'storage'))
+app.config['DOCUMENT_MAX_BYTES'] = int(os.getenv('DOCUMENT_MAX_BYTES', str(25 * 1024 * 1024)))
+# Za nginx: prefiks internal location, pod którym nginx serwuje DOCUMENT_STORAGE_ROOT (X-Accel-Redirect)
+app.config['DOCUMENT_ACCEL_REDIRECT_PREFIX'] = os.getenv('DOCUMENT_ACCEL_REDIRECT_PREFIX')
+app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', '86400'))
+# Podglądy dokumentów: dłuższy bok w px, liczba wątków i czas oczekiwania na podgląd generowany na żądanie
+app.config['PREVIEW_MAX_SIZE'] = int(os.getenv('PREVIEW_MAX_SIZE', '480'))
+app.config['PREVIEW_WORKERS'] = int(os.getenv('PREVIEW_WORKERS', '2'))
+app.config['PREVIEW_WAIT_SECONDS'] = float(os.getenv('PREVIEW_WAIT_SECONDS', '5'))
+# Limit pikseli obrazu (po zmniejszeniu JPEG przy dekodowaniu) - większe pliki nie dostają podglądu
+app.config['PREVIEW_MAX_PIXELS'] = int(os.getenv('PREVIEW_MAX_PIXELS', '25000000'))
+# Podpisane adresy plików: klucz (domyślnie wyprowadzany z JWT_SECRET_KEY), ważność i zaokrąglenie wygaśnięcia w sekundach
+app.config['SIGNED_URL_SECRET'] = os.getenv('SIGNED_URL_SECRET')
+app.config['SIGNED_URL_TTL'] = int(os.getenv('SIGNED_URL_TTL', '900'))
+app.config['SIGNED_URL_BUCKET'] = int(os.getenv('SIGNED_URL_BUCKET', '300'))
+# Idempotency-Key: czas przechowywania odpowiedzi, blokada trwającego żądania (s) i limit kluczy bez Redisa
+app.config['IDEMPOTENCY_KEY_TTL'] = int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400'))
+app.config['IDEMPOTENCY_LOCK_TTL'] = int(os.getenv('IDEMPOTENCY_LOCK_TTL', '60'))
+app.config['IDEMPOTENCY_LOCAL_MAX_KEYS'] = int(os.getenv('IDEMPOTENCY_LOCAL_MAX_KEYS', '10000'))
+# Synchronizacja delta: rozmiar strony
+app.config['SYNC_PAGE_SIZE'] = int(os.getenv('SYNC_PAGE_SIZE', '500'))
+app.config['SYNC_MAX_PAGE_SIZE'] = int(os.getenv('SYNC_MAX_PAGE_SIZE', '2000'))
 
 # Initialize extensions
 db.init_app(app)
@@ -47,25 +112,113 @@ jwt = JWTManager(app)
 bcrypt = Bcrypt(app)
 # Zapisujemy bcrypt w extensions, żeby był dostępny w blueprintach
 app.extensions['bcrypt'] = bcrypt
+# Redis (opcjonalny) - musi być gotowy przed usługami, które z niego korzystają
+init_redis(app)
+# Hashowanie haseł w osobnej, ograniczonej puli procesów (poza wątkiem żądania)
+init_password_hasher(app)
+# Ograniczanie prób logowania (chroni CPU przed credential stuffingiem)
+init_rate_limiter(app)
+# Historia kursów walut w pamięci procesu
+init_exchange_rates(app)
+# Magazyn plików dokumentów (adresowany treścią)
+init_storage(app)
+# Sesje wznawialnego uploadu (fragmenty na dysku, sprzątane po UPLOAD_SESSION_TTL)
+init_uploads(app)
+# Pula generująca podglądy dokumentów w tle
+init_previews(app)
+# Podpisane (HMAC) adresy plików - serwowane bez JWT i bez zapytań do bazy
+init_signed_urls(app)
+# Wersje delegacji podbijane przy zmianach ich wydatków i dokumentów (ETag)
+init_versioning(app)
+# Liczniki i sumy wydatków per delegacja (delegation_rollup) oraz komendy `flask rollups`
+init_rollups(app)
+# Klucze Idempotency-Key z zapisanymi odpowiedziami (Redis lub pamięć procesu)
+init_idempotency(app)
+# Cache tożsamości (role, is_active, manager_id) używany przez require_role
+init_principal_cache(app)
+# Wersje bezpieczeństwa pracowników - tokeny ze starszą wersją są odrzucane
+init_token_versions(app)
+
+@jwt.token_in_blocklist_loader
+def check_token_version(jwt_header, jwt_payload):
+    return is_token_revoked(jwt_payload)
 
 # Register blueprints
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
 app.register_blueprint(delegations_bp, url_prefix='/api/delegations')
 app.register_blueprint(admin_bp, url_prefix='/api/admin')
 app.register_blueprint(manager_bp, url_prefix='/api/manager')
+app.register_blueprint(files_bp, url_prefix='/api/files')
+
+# Kolumny i indeksy dodawane przez migration.sql - brak któregokolwiek uruchamia migrację
+MIGRATION_COLUMNS = [
+    ('employee', 'role'),
+    ('employee', 'security_version'),
+    ('document', 'content_hash'),
+    ('document', 'size_bytes'),
+    ('employee', 'version'),
+    ('delegation', 'version'),
+    ('expense', 'version'),
+    ('delegation', 'change_seq'),
+    ('expense', 'change_seq'),
+    ('document', 'change_seq'),
+    ('sync_tombstone', 'change_seq'),
+    ('delegation', 'change_xid'),
+    ('expense', 'change_xid'),
+    ('document', 'change_xid'),
+    ('sync_tombstone', 'change_xid'),
+    ('delegation_rollup', 'pending_pln'),
+]
+MIGRATION_INDEXES = [
+    'ix_employee_username_lower',
+    'ix_employee_email_lower',
+    'ix_delegation_employee_start_id',
+    'ix_delegation_employee_change_xid',
+    'ix_expense_delegation_change_xid',
+    'ix_document_delegation_change_xid',
+    'ix_sync_tombstone_employee_change_xid',
+    'ix_employee_manager_id',
+]
+MIGRATION_TRIGGERS = [
+    'sync_tombstone_delegation',
+    'sync_tombstone_expense',
+    'sync_tombstone_document',
+]
 
 def run_migration_if_needed():
-    """Run migration if needed (check if role column exists)"""
+    """Run migration if needed (check if columns, indexes and triggers added by migration.sql exist)"""
     try:
         with db.engine.begin() as connection:
-            # Check if role column exists
-            result = connection.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'employee' AND column_name = 'role'
-            """))
-            if result.fetchone() is None:
-                print("[MIGRATION] Missing columns detected, running migration...")
+            # Check if all migrated columns exist
+            missing = []
+            for table_name, column_name in MIGRATION_COLUMNS:
+                result = connection.execute(text("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = :table_name AND column_name = :column_name
+                """), {"table_name": table_name, "column_name": column_name})
+                if result.fetchone() is None:
+                    missing.append(f"{table_name}.{column_name}")
+            # Check if all migrated indexes exist
+            for index_name in MIGRATION_INDEXES:
+                result = connection.execute(text("""
+                    SELECT indexname 
+                    FROM pg_indexes 
+                    WHERE indexname = :index_name
+                """), {"index_name": index_name})
+                if result.fetchone() is None:
+                    missing.append(index_name)
+            # Check if all migrated triggers exist (db.create_all() does not create them)
+            for trigger_name in MIGRATION_TRIGGERS:
+                result = connection.execute(text("""
+                    SELECT tgname 
+                    FROM pg_trigger 
+                    WHERE tgname = :trigger_name
+                """), {"trigger_name": trigger_name})
+                if result.fetchone() is None:
+                    missing.append(trigger_name)
+            if missing:
+                print(f"[MIGRATION] Missing columns, indexes or triggers detected ({', '.join(missing)}), running migration...")
                 with open('migration.sql', 'r', encoding='utf-8') as f:
                     migration_sql = f.read()
                 connection.execute(text(migration_sql))
@@ -81,6 +234,8 @@ if __name__ == '__main__':
         db.create_all()
         # Run migration if needed
         run_migration_if_needed()
+        # Wiersze rollupu dla delegacji, które ich jeszcze nie mają
+        backfill_rollups()
         # Run seed after DB initialization
         init_seed(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -1,3 +1,7 @@
+-- Globalny numer zmiany dla synchronizacji delta (delegation, expense, document, sync_tombstone);
+-- change_xid to transakcja zapisu - kursor synchronizacji nie wyprzedza niezakończonych transakcji
+CREATE SEQUENCE "change_seq";
+
 CREATE TABLE "employee" (
   "id" serial PRIMARY KEY,
   "username" varchar(120) UNIQUE NOT NULL,
@@ -8,9 +12,17 @@ CREATE TABLE "employee" (
   "is_active" boolean DEFAULT true NOT NULL,
   "role" varchar(50) DEFAULT 'employee' NOT NULL,
   "manager_id" integer,
-  "created_at" timestamp
+  "security_version" integer DEFAULT 1 NOT NULL,
+  "created_at" timestamp,
+  "version" integer DEFAULT 1 NOT NULL,
+  "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Wyszukiwanie username/email bez rozróżniania wielkości liter (lower(trim(...)))
+CREATE UNIQUE INDEX "ix_employee_username_lower" ON "employee" (lower(trim("username")));
+CREATE UNIQUE INDEX "ix_employee_email_lower" ON "employee" (lower(trim("email")));
+CREATE INDEX "ix_employee_manager_id" ON "employee" ("manager_id");
+
 CREATE TABLE "expense" (
   "id" serial PRIMARY KEY,
   "explanation" text,
@@ -23,9 +35,15 @@ CREATE TABLE "expense" (
   "status" varchar,
   "category_id" integer NOT NULL,
   "created_at" timestamp,
-  "closed_at" timestamp
+  "closed_at" timestamp,
+  "version" integer DEFAULT 1 NOT NULL,
+  "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP,
+  "change_seq" bigint DEFAULT nextval('change_seq'),
+  "change_xid" bigint DEFAULT (pg_current_xact_id()::text::bigint)
 );
 
+CREATE INDEX "ix_expense_delegation_change_xid" ON "expense" ("delegation_id", "change_xid", "change_seq");
+
 CREATE TABLE "delegation" (
   "id" serial PRIMARY KEY,
   "employee_id" integer NOT NULL,
@@ -38,9 +56,17 @@ CREATE TABLE "delegation" (
   "purpose" text,
   "created_at" timestamp,
   "closed_at" timestamp,
-  "export_date" timestamp
+  "export_date" timestamp,
+  "version" integer DEFAULT 1 NOT NULL,
+  "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP,
+  "change_seq" bigint DEFAULT nextval('change_seq'),
+  "change_xid" bigint DEFAULT (pg_current_xact_id()::text::bigint)
 );
 
+-- Stronicowanie keyset listy delegacji pracownika
+CREATE INDEX "ix_delegation_employee_start_id" ON "delegation" ("employee_id", "start_date", "id");
+CREATE INDEX "ix_delegation_employee_change_xid" ON "delegation" ("employee_id", "change_xid", "change_seq");
+
 CREATE TABLE "expense_category" (
   "id" serial PRIMARY KEY,
   "name" varchar NOT NULL
@@ -68,7 +94,65 @@ CREATE TABLE "document" (
   "file_path" varchar(500) NOT NULL,
   "file_type" varchar(50),
   "description" text,
-  "uploaded_at" timestamp DEFAULT CURRENT_TIMESTAMP
+  "uploaded_at" timestamp DEFAULT CURRENT_TIMESTAMP,
+  "content_hash" varchar(64),
+  "size_bytes" bigint,
+  "change_seq" bigint DEFAULT nextval('change_seq'),
+  "change_xid" bigint DEFAULT (pg_current_xact_id()::text::bigint)
+);
+
+CREATE INDEX "ix_document_delegation_change_xid" ON "document" ("delegation_id", "change_xid", "change_seq");
+
+-- Usunięte delegacje, wydatki i dokumenty (synchronizacja delta)
+CREATE TABLE "sync_tombstone" (
+  "id" serial PRIMARY KEY,
+  "entity" varchar(20) NOT NULL,
+  "entity_id" integer NOT NULL,
+  "delegation_id" integer NOT NULL,
+  "employee_id" integer NOT NULL,
+  "change_seq" bigint DEFAULT nextval('change_seq') NOT NULL,
+  "change_xid" bigint DEFAULT (pg_current_xact_id()::text::bigint) NOT NULL,
+  "deleted_at" timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX "ix_sync_tombstone_employee_change_xid" ON "sync_tombstone" ("employee_id", "change_xid", "change_seq");
+
+-- Tombstone'y zapisuje baza (także przy DELETE z Core i kaskadach), jednym INSERT na instrukcję
+CREATE OR REPLACE FUNCTION "sync_tombstone_delegation"() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO "sync_tombstone" ("entity", "entity_id", "delegation_id", "employee_id")
+  SELECT 'delegation', o."id", o."id", o."employee_id" FROM "deleted_rows" o;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- Wydatek lub dokument usunięty razem z delegacją nie dostaje własnego tombstone'u - obejmuje go tombstone delegacji
+CREATE OR REPLACE FUNCTION "sync_tombstone_child"() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO "sync_tombstone" ("entity", "entity_id", "delegation_id", "employee_id")
+  SELECT TG_TABLE_NAME, o."id", d."id", d."employee_id"
+  FROM "deleted_rows" o JOIN "delegation" d ON d."id" = o."delegation_id";
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER "sync_tombstone_delegation" AFTER DELETE ON "delegation"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_delegation"();
+CREATE OR REPLACE TRIGGER "sync_tombstone_expense" AFTER DELETE ON "expense"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_child"();
+CREATE OR REPLACE TRIGGER "sync_tombstone_document" AFTER DELETE ON "document"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_child"();
+
+-- Liczniki i sumy PLN wydatków delegacji per status (utrzymywane przez services/rollups.py)
+CREATE TABLE "delegation_rollup" (
+  "delegation_id" integer PRIMARY KEY,
+  "total_count" integer DEFAULT 0 NOT NULL,
+  "pending_count" integer DEFAULT 0 NOT NULL,
+  "approved_count" integer DEFAULT 0 NOT NULL,
+  "rejected_count" integer DEFAULT 0 NOT NULL,
+  "total_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "pending_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "approved_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "rejected_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP
 );
 
 COMMENT ON COLUMN "expense"."explanation" IS 'Note why the expense was needed';
@@ -35,6 +35,14 @@ BEGIN
     ) THEN
         ALTER TABLE "employee" ADD COLUMN "last_name" varchar(100) DEFAULT 'User' NOT NULL;
     END IF;
+
+    -- Add security_version column (JWT revocation by version)
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns 
+        WHERE table_name = 'employee' AND column_name = 'security_version'
+    ) THEN
+        ALTER TABLE "employee" ADD COLUMN "security_version" integer DEFAULT 1 NOT NULL;
+    END IF;
 END $$;
 
 -- Add foreign key constraint for manager_id if it doesn't exist
@@ -133,3 +141,160 @@ BEGIN
         ON DELETE CASCADE ON UPDATE CASCADE;
     END IF;
 END $$;
+
+-- Uploaded files: SHA-256 of the content in the document store and its size
+ALTER TABLE "document" ADD COLUMN IF NOT EXISTS "content_hash" varchar(64);
+ALTER TABLE "document" ADD COLUMN IF NOT EXISTS "size_bytes" bigint;
+
+-- Representation versions (ETag / conditional GET), bumped on every change
+ALTER TABLE "employee" ADD COLUMN IF NOT EXISTS "version" integer DEFAULT 1 NOT NULL;
+ALTER TABLE "employee" ADD COLUMN IF NOT EXISTS "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE "delegation" ADD COLUMN IF NOT EXISTS "version" integer DEFAULT 1 NOT NULL;
+ALTER TABLE "delegation" ADD COLUMN IF NOT EXISTS "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE "expense" ADD COLUMN IF NOT EXISTS "version" integer DEFAULT 1 NOT NULL;
+ALTER TABLE "expense" ADD COLUMN IF NOT EXISTS "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP;
+
+-- Functional unique indexes for case-insensitive username/email lookups
+-- Falls back to a non-unique index when existing rows already collide
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes WHERE indexname = 'ix_employee_username_lower'
+    ) THEN
+        BEGIN
+            CREATE UNIQUE INDEX "ix_employee_username_lower" ON "employee" (lower(trim("username")));
+        EXCEPTION WHEN unique_violation THEN
+            RAISE NOTICE 'Duplicate usernames (case-insensitive) found, creating non-unique ix_employee_username_lower';
+            CREATE INDEX "ix_employee_username_lower" ON "employee" (lower(trim("username")));
+        END;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes WHERE indexname = 'ix_employee_email_lower'
+    ) THEN
+        BEGIN
+            CREATE UNIQUE INDEX "ix_employee_email_lower" ON "employee" (lower(trim("email")));
+        EXCEPTION WHEN unique_violation THEN
+            RAISE NOTICE 'Duplicate emails (case-insensitive) found, creating non-unique ix_employee_email_lower';
+            CREATE INDEX "ix_employee_email_lower" ON "employee" (lower(trim("email")));
+        END;
+    END IF;
+END $$;
+
+-- Composite index backing keyset pagination of GET /api/delegations
+CREATE INDEX IF NOT EXISTS "ix_delegation_employee_start_id" ON "delegation" ("employee_id", "start_date", "id");
+
+-- Delta sync: global change sequence stamped on every insert/update
+CREATE SEQUENCE IF NOT EXISTS "change_seq";
+ALTER TABLE "delegation" ADD COLUMN IF NOT EXISTS "change_seq" bigint;
+ALTER TABLE "expense" ADD COLUMN IF NOT EXISTS "change_seq" bigint;
+ALTER TABLE "document" ADD COLUMN IF NOT EXISTS "change_seq" bigint;
+UPDATE "delegation" SET "change_seq" = nextval('change_seq') WHERE "change_seq" IS NULL;
+UPDATE "expense" SET "change_seq" = nextval('change_seq') WHERE "change_seq" IS NULL;
+UPDATE "document" SET "change_seq" = nextval('change_seq') WHERE "change_seq" IS NULL;
+ALTER TABLE "delegation" ALTER COLUMN "change_seq" SET DEFAULT nextval('change_seq');
+ALTER TABLE "expense" ALTER COLUMN "change_seq" SET DEFAULT nextval('change_seq');
+ALTER TABLE "document" ALTER COLUMN "change_seq" SET DEFAULT nextval('change_seq');
+
+-- Deleted delegations, expenses and documents reported to delta sync
+CREATE TABLE IF NOT EXISTS "sync_tombstone" (
+  "id" serial PRIMARY KEY,
+  "entity" varchar(20) NOT NULL,
+  "entity_id" integer NOT NULL,
+  "delegation_id" integer NOT NULL,
+  "employee_id" integer NOT NULL,
+  "change_seq" bigint DEFAULT nextval('change_seq') NOT NULL,
+  "deleted_at" timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+-- Per-delegation expense counts and PLN sums by status, maintained incrementally by services/rollups.py
+CREATE TABLE IF NOT EXISTS "delegation_rollup" (
+  "delegation_id" integer PRIMARY KEY,
+  "total_count" integer DEFAULT 0 NOT NULL,
+  "pending_count" integer DEFAULT 0 NOT NULL,
+  "approved_count" integer DEFAULT 0 NOT NULL,
+  "rejected_count" integer DEFAULT 0 NOT NULL,
+  "total_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "pending_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "approved_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "rejected_pln" numeric(14,2) DEFAULT 0 NOT NULL,
+  "updated_at" timestamp DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO "delegation_rollup" (
+  "delegation_id", "total_count", "pending_count", "approved_count", "rejected_count",
+  "total_pln", "pending_pln", "approved_pln", "rejected_pln"
+)
+SELECT d."id",
+  COUNT(e."id"),
+  COUNT(e."id") FILTER (WHERE e."status" = 'PENDING'),
+  COUNT(e."id") FILTER (WHERE e."status" = 'APPROVED'),
+  COUNT(e."id") FILTER (WHERE e."status" = 'REJECTED'),
+  COALESCE(SUM(e."pln"), 0),
+  COALESCE(SUM(e."pln") FILTER (WHERE e."status" = 'PENDING'), 0),
+  COALESCE(SUM(e."pln") FILTER (WHERE e."status" = 'APPROVED'), 0),
+  COALESCE(SUM(e."pln") FILTER (WHERE e."status" = 'REJECTED'), 0)
+FROM "delegation" d
+LEFT JOIN (
+  SELECT "id", "delegation_id",
+    CASE
+      WHEN upper(trim("status")) IN ('APPROVED', 'ACCEPTED', 'ZAAKCEPTOWANY') THEN 'APPROVED'
+      WHEN upper(trim("status")) IN ('REJECTED', 'ODRZUCONY', 'DENIED') THEN 'REJECTED'
+      ELSE 'PENDING'
+    END AS "status",
+    COALESCE(NULLIF("pln_amount", 0), NULLIF("amount", 0), 0) AS "pln"
+  FROM "expense"
+) e ON e."delegation_id" = d."id"
+GROUP BY d."id"
+ON CONFLICT ("delegation_id") DO NOTHING;
+
+-- Manager team lookups (GET /api/manager/employees?include=stats); delegation.employee_id is covered by ix_delegation_employee_*
+CREATE INDEX IF NOT EXISTS "ix_employee_manager_id" ON "employee" ("manager_id");
+
+-- Delta sync cursor: id of the writing transaction, so the cursor never passes a transaction still in progress
+ALTER TABLE "delegation" ADD COLUMN IF NOT EXISTS "change_xid" bigint;
+ALTER TABLE "expense" ADD COLUMN IF NOT EXISTS "change_xid" bigint;
+ALTER TABLE "document" ADD COLUMN IF NOT EXISTS "change_xid" bigint;
+ALTER TABLE "sync_tombstone" ADD COLUMN IF NOT EXISTS "change_xid" bigint;
+UPDATE "delegation" SET "change_xid" = 0 WHERE "change_xid" IS NULL;
+UPDATE "expense" SET "change_xid" = 0 WHERE "change_xid" IS NULL;
+UPDATE "document" SET "change_xid" = 0 WHERE "change_xid" IS NULL;
+UPDATE "sync_tombstone" SET "change_xid" = 0 WHERE "change_xid" IS NULL;
+ALTER TABLE "delegation" ALTER COLUMN "change_xid" SET DEFAULT (pg_current_xact_id()::text::bigint);
+ALTER TABLE "expense" ALTER COLUMN "change_xid" SET DEFAULT (pg_current_xact_id()::text::bigint);
+ALTER TABLE "document" ALTER COLUMN "change_xid" SET DEFAULT (pg_current_xact_id()::text::bigint);
+ALTER TABLE "sync_tombstone" ALTER COLUMN "change_xid" SET DEFAULT (pg_current_xact_id()::text::bigint);
+ALTER TABLE "sync_tombstone" ALTER COLUMN "change_xid" SET NOT NULL;
+
+-- Delegations have their (employee_id, change_xid, change_seq) index; children are looked up per changed delegation
+DROP INDEX IF EXISTS "ix_delegation_employee_change_seq";
+DROP INDEX IF EXISTS "ix_expense_delegation_change_seq";
+DROP INDEX IF EXISTS "ix_document_delegation_change_seq";
+DROP INDEX IF EXISTS "ix_sync_tombstone_employee_change_seq";
+CREATE INDEX IF NOT EXISTS "ix_delegation_employee_change_xid" ON "delegation" ("employee_id", "change_xid", "change_seq");
+CREATE INDEX IF NOT EXISTS "ix_expense_delegation_change_xid" ON "expense" ("delegation_id", "change_xid", "change_seq");
+CREATE INDEX IF NOT EXISTS "ix_document_delegation_change_xid" ON "document" ("delegation_id", "change_xid", "change_seq");
+CREATE INDEX IF NOT EXISTS "ix_sync_tombstone_employee_change_xid" ON "sync_tombstone" ("employee_id", "change_xid", "change_seq");
+
+-- Tombstones are written by the database (also for Core DELETEs and cascades), one INSERT per statement
+CREATE OR REPLACE FUNCTION "sync_tombstone_delegation"() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO "sync_tombstone" ("entity", "entity_id", "delegation_id", "employee_id")
+  SELECT 'delegation', o."id", o."id", o."employee_id" FROM "deleted_rows" o;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- An expense or document deleted together with its delegation is covered by the delegation's tombstone
+CREATE OR REPLACE FUNCTION "sync_tombstone_child"() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO "sync_tombstone" ("entity", "entity_id", "delegation_id", "employee_id")
+  SELECT TG_TABLE_NAME, o."id", d."id", d."employee_id"
+  FROM "deleted_rows" o JOIN "delegation" d ON d."id" = o."delegation_id";
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER "sync_tombstone_delegation" AFTER DELETE ON "delegation"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_delegation"();
+CREATE OR REPLACE TRIGGER "sync_tombstone_expense" AFTER DELETE ON "expense"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_child"();
+CREATE OR REPLACE TRIGGER "sync_tombstone_document" AFTER DELETE ON "document"
+  REFERENCING OLD TABLE AS "deleted_rows" FOR EACH STATEMENT EXECUTE FUNCTION "sync_tombstone_child"();
@@ -1,10 +1,23 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import Column, Integer, String, Date, Text, Numeric, DateTime, ForeignKey
+from sqlalchemy import func, literal_column
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
 db = SQLAlchemy()
 
+# Globalny, rosnący numer zmiany (synchronizacja delta) - nadawany przy każdym INSERT/UPDATE
+CHANGE_SEQ = db.Sequence('change_seq', metadata=db.metadata)
+
+def current_xid():
+    """Identyfikator (xid8) transakcji zapisującej wiersz - kursor synchronizacji nie wyprzedza niezakończonych transakcji"""
+    return db.cast(db.cast(func.pg_current_xact_id(), Text), db.BigInteger)
+
+def normalize_identifier(value):
+    """Postać username/email używana w wyszukiwaniu i indeksach lower(trim(...))"""
+    return (value or '').strip().lower()
+
 class Employee(db.Model):
     __tablename__ = 'employee'
     
@@ -17,11 +30,40 @@ class Employee(db.Model):
     is_active = db.Column(db.Boolean, default=True, nullable=False)
     role = db.Column(db.String(50), default='employee', nullable=False)  # employee, manager, accountant, admin
     manager_id = db.Column(db.Integer, db.ForeignKey('employee.id'), nullable=True)
+    # Wersja bezpieczeństwa - podbijana przy blokadzie, zmianie roli/menedżera i hasła (unieważnia stare JWT)
+    security_version = db.Column(db.Integer, default=1, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Wersja reprezentacji (ETag) - podbijana przy każdej zmianie wiersza
+    version = db.Column(db.Integer, default=1, onupdate=literal_column('version + 1'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     delegations = relationship("Delegation", back_populates="employee")
     # Relacja self-referential dla manager-employee
     manager = relationship("Employee", remote_side=[id], backref="subordinates")
+    
+    # Unikalne indeksy funkcyjne - wyszukiwanie bez rozróżniania wielkości liter i spacji w O(log n)
+    __table_args__ = (
+        db.Index('ix_employee_username_lower', func.lower(func.trim(username)), unique=True),
+        db.Index('ix_employee_email_lower', func.lower(func.trim(email)), unique=True),
+        # Zespół menedżera (lista podwładnych, przegląd z licznikami)
+        db.Index('ix_employee_manager_id', manager_id),
+    )
+    
+    @hybrid_property
+    def username_key(self):
+        return normalize_identifier(self.username)
+    
+    @username_key.expression
+    def username_key(cls):
+        return func.lower(func.trim(cls.username))
+    
+    @hybrid_property
+    def email_key(self):
+        return normalize_identifier(self.email)
+    
+    @email_key.expression
+    def email_key(cls):
+        return func.lower(func.trim(cls.email))
 
 class Delegation(db.Model):
     __tablename__ = 'delegation'
@@ -38,10 +80,26 @@ class Delegation(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     closed_at = db.Column(db.DateTime)
     export_date = db.Column(db.DateTime)
+    # Wersja reprezentacji (ETag) - podbijana także przy zmianach wydatków i dokumentów delegacji
+    version = db.Column(db.Integer, default=1, onupdate=literal_column('version + 1'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    change_seq = db.Column(db.BigInteger, default=CHANGE_SEQ.next_value(), onupdate=CHANGE_SEQ.next_value())
+    change_xid = db.Column(db.BigInteger, default=current_xid(), onupdate=current_xid())
     
     employee = relationship("Employee", back_populates="delegations")
     expenses = relationship("Expense", back_populates="delegation")
     documents = relationship("Document", back_populates="delegation", cascade="all, delete-orphan")
+    # Liczniki i sumy wydatków per status (utrzymywane przez services.rollups)
+    rollup = relationship(
+        "DelegationRollup", uselist=False, viewonly=True,
+        primaryjoin="Delegation.id == foreign(DelegationRollup.delegation_id)"
+    )
+    
+    # Stronicowanie keyset listy delegacji pracownika po (start_date, id); zmiany od kursora synchronizacji
+    __table_args__ = (
+        db.Index('ix_delegation_employee_start_id', employee_id, start_date, id),
+        db.Index('ix_delegation_employee_change_xid', employee_id, change_xid, change_seq),
+    )
 
 class Expense(db.Model):
     __tablename__ = 'expense'
@@ -58,11 +116,20 @@ class Expense(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('expense_category.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     closed_at = db.Column(db.DateTime)
+    version = db.Column(db.Integer, default=1, onupdate=literal_column('version + 1'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    change_seq = db.Column(db.BigInteger, default=CHANGE_SEQ.next_value(), onupdate=CHANGE_SEQ.next_value())
+    change_xid = db.Column(db.BigInteger, default=current_xid(), onupdate=current_xid())
     
     # Relacje zgodne z diagramem ERD
     delegation = relationship("Delegation", back_populates="expenses")
     currency = relationship("Currency", back_populates="expenses")
     category = relationship("ExpenseCategory", back_populates="expenses")
+    
+    # Zmiany wydatków delegacji od kursora synchronizacji
+    __table_args__ = (
+        db.Index('ix_expense_delegation_change_xid', delegation_id, change_xid, change_seq),
+    )
 
 class ExpenseCategory(db.Model):
     __tablename__ = 'expense_category'
@@ -107,6 +174,47 @@ class Document(db.Model):
     file_type = db.Column(db.String(50))
     description = db.Column(db.Text)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Plik w magazynie adresowanym treścią (NULL dla dokumentów z samą ścieżką od klienta)
+    content_hash = db.Column(db.String(64))  # SHA-256 hex
+    size_bytes = db.Column(db.BigInteger)
+    change_seq = db.Column(db.BigInteger, default=CHANGE_SEQ.next_value(), onupdate=CHANGE_SEQ.next_value())
+    change_xid = db.Column(db.BigInteger, default=current_xid(), onupdate=current_xid())
     
     delegation = relationship("Delegation", back_populates="documents")
-    expense = relationship("Expense", backref="documents")
\ No newline at end of file
+    expense = relationship("Expense", backref="documents")
+    
+    __table_args__ = (
+        db.Index('ix_document_delegation_change_xid', delegation_id, change_xid, change_seq),
+    )
+
+class SyncTombstone(db.Model):
+    """Ślad usuniętej delegacji, wydatku lub dokumentu dla synchronizacji delta (zapisuje go trigger w bazie)"""
+    __tablename__ = 'sync_tombstone'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # delegation, expense, document
+    entity_id = db.Column(db.Integer, nullable=False)
+    delegation_id = db.Column(db.Integer, nullable=False)
+    employee_id = db.Column(db.Integer, nullable=False)
+    change_seq = db.Column(db.BigInteger, default=CHANGE_SEQ.next_value(), nullable=False)
+    change_xid = db.Column(db.BigInteger, default=current_xid(), nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_sync_tombstone_employee_change_xid', employee_id, change_xid, change_seq),
+    )
+
+class DelegationRollup(db.Model):
+    """Liczba wydatków delegacji i suma ich kwot PLN per status (PENDING, APPROVED, REJECTED)"""
+    __tablename__ = 'delegation_rollup'
+    
+    delegation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total_count = db.Column(db.Integer, default=0, nullable=False)
+    pending_count = db.Column(db.Integer, default=0, nullable=False)
+    approved_count = db.Column(db.Integer, default=0, nullable=False)
+    rejected_count = db.Column(db.Integer, default=0, nullable=False)
+    total_pln = db.Column(db.Numeric(14, 2), default=0, nullable=False)
+    pending_pln = db.Column(db.Numeric(14, 2), default=0, nullable=False)
+    approved_pln = db.Column(db.Numeric(14, 2), default=0, nullable=False)
+    rejected_pln = db.Column(db.Numeric(14, 2), default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -1,32 +1,21 @@
 from flask import Blueprint, request, jsonify, current_app, abort
-from models import db, Employee, Delegation, Expense
+from models import db, Employee, Delegation, normalize_identifier
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from flask_bcrypt import Bcrypt
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
-from utils import require_role, get_current_employee
+from utils import require_role, get_current_employee, make_etag, not_modified_response, etag_response
+from services.principal_cache import invalidate_principal
+from services.token_versions import bump_security_version, publish_security_version
+from services.passwords import hash_password, PasswordHasherBusy
+from services.rate_limit import get_rate_limiter
+from services.employee_import import parse_rows, import_employees, ImportFormatError
+from services.delegations import load_delegation_detail, delegation_detail_version, serialize_document
+from services.versioning import load_delegation_stamp, load_employee_delegations_stamp
+from services.delegation_status import normalize_status, load_delegation_statuses
+from services.rollups import summarize_rollup, serialize_rollup_summary
 from decimal import Decimal
 
 bp = Blueprint('admin', __name__)
 
-def normalize_status(status):
-    """Normalizuje status do uppercase EN: PENDING | APPROVED | REJECTED"""
-    if not status:
-        return 'PENDING'
-    s = str(status).upper().strip()
-    if s in ['PENDING', 'APPROVED', 'REJECTED']:
-        return s
-    # Fallback dla starych wartości
-    if s in ['ACCEPTED', 'ZAAKCEPTOWANY']:
-        return 'APPROVED'
-    if s in ['ODRZUCONY', 'DENIED']:
-        return 'REJECTED'
-    return 'PENDING'
-
-def get_bcrypt():
-    """Pobiera instancję bcrypt z current_app"""
-    return current_app.extensions.get('bcrypt')
-
 @bp.route('/employees', methods=['GET'])
 @jwt_required()
 @require_role('admin')
@@ -81,7 +70,7 @@ def create_employee():
             }), 400
         
         # Sprawdzenie duplikatów
-        existing_username = Employee.query.filter(func.lower(func.trim(Employee.username)) == func.lower(username_raw)).first()
+        existing_username = Employee.query.filter(Employee.username_key == normalize_identifier(username_raw)).first()
         if existing_username:
             return jsonify({
                 "error": "DUPLICATE",
@@ -89,7 +78,7 @@ def create_employee():
                 "message": "Username already exists"
             }), 409
         
-        existing_email = Employee.query.filter(func.lower(func.trim(Employee.email)) == func.lower(email_raw)).first()
+        existing_email = Employee.query.filter(Employee.email_key == normalize_identifier(email_raw)).first()
         if existing_email:
             return jsonify({
                 "error": "DUPLICATE",
@@ -97,9 +86,8 @@ def create_employee():
                 "message": "Email already exists"
             }), 409
         
-        # Hashowanie hasła
-        bcrypt = get_bcrypt()
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        # Hashowanie hasła (w puli procesów)
+        hashed_password = hash_password(password)
         
         # Tworzenie nowego pracownika
         # FIX: first_name i last_name są wymagane w modelu, więc ustawiamy defaults
@@ -150,6 +138,73 @@ def create_employee():
             "status": "error",
             "message": "Employee with this username or email already exists"
         }), 409
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/employees/bulk', methods=['POST'])
+@jwt_required()
+@require_role('admin')
+def bulk_create_employees():
+    """
+    Masowy import pracowników z CSV (text/csv) lub NDJSON (application/x-ndjson) (tylko admin).
+    Kolumny: username, email, password, first_name, last_name, role, is_active,
+    manager_id lub manager_email. Zwraca raport per wiersz.
+    """
+    try:
+        try:
+            rows = parse_rows(request.content_type, request.get_data())
+        except ImportFormatError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+        
+        if not rows:
+            return jsonify({
+                "status": "error",
+                "message": "No rows to import"
+            }), 400
+        
+        max_rows = current_app.config.get('BULK_IMPORT_MAX_ROWS', 500)
+        if len(rows) > max_rows:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many rows. Maximum is {max_rows} per request"
+            }), 413
+        
+        results, created = import_employees(rows)
+        db.session.commit()
+        
+        return jsonify({
+            "status": "success" if created else "error",
+            "created": created,
+            "failed": len(results) - created,
+            "results": results
+        }), 201 if created else 400
+        
+    except IntegrityError:
+        # Równoległe utworzenie tego samego pracownika - cały import jest wycofywany
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Employee with this username or email was created concurrently, nothing was imported"
+        }), 409
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         db.session.rollback()
         return jsonify({
@@ -179,11 +234,24 @@ def update_employee(employee_id):
                     "status": "error",
                     "message": "Invalid role. Allowed roles: employee, manager, accountant, admin"
                 }), 400
+            if data['role'] != employee.role:
+                # Rola jest claimem w JWT - stare tokeny muszą zostać odrzucone
+                bump_security_version(employee)
             employee.role = data['role']
         
         # Aktualizacja statusu aktywnego
         if 'is_active' in data:
-            employee.is_active = data['is_active']
+            # Tylko JSON true/false - bool("false") reaktywowałby konto
+            is_active = data['is_active']
+            if not isinstance(is_active, bool):
+                return jsonify({
+                    "status": "error",
+                    "message": "is_active must be a boolean"
+                }), 400
+            if is_active != employee.is_active:
+                # Jak przy blokadzie - dezaktywowany pracownik traci wszystkie aktywne tokeny
+                bump_security_version(employee)
+            employee.is_active = is_active
         
         # Aktualizacja menedżera
         if 'manager_id' in data:
@@ -200,13 +268,15 @@ def update_employee(employee_id):
                         "status": "error",
                         "message": "Assigned manager must have 'manager' role"
                     }), 400
+            if manager_id != employee.manager_id:
+                bump_security_version(employee)
             employee.manager_id = manager_id
         
         # Aktualizacja username i email (jeśli podane)
         if 'username' in data:
             # Sprawdź czy username nie jest zajęty przez innego użytkownika
             existing = Employee.query.filter(
-                Employee.username == data['username'],
+                Employee.username_key == normalize_identifier(data['username']),
                 Employee.id != employee_id
             ).first()
             if existing:
@@ -219,7 +289,7 @@ def update_employee(employee_id):
         if 'email' in data:
             # Sprawdź czy email nie jest zajęty przez innego użytkownika
             existing = Employee.query.filter(
-                Employee.email == data['email'],
+                Employee.email_key == normalize_identifier(data['email']),
                 Employee.id != employee_id
             ).first()
             if existing:
@@ -230,6 +300,8 @@ def update_employee(employee_id):
             employee.email = data['email']
         
         db.session.commit()
+        invalidate_principal(employee.id)
+        publish_security_version(employee)
         
         return jsonify({
             "status": "success",
@@ -266,6 +338,7 @@ def activate_employee(employee_id):
         
         employee.is_active = True
         db.session.commit()
+        invalidate_principal(employee.id)
         
         return jsonify({
             "status": "success",
@@ -293,7 +366,11 @@ def block_employee(employee_id):
             }), 404
         
         employee.is_active = False
+        # Zablokowany pracownik traci wszystkie aktywne tokeny
+        bump_security_version(employee)
         db.session.commit()
+        invalidate_principal(employee.id)
+        publish_security_version(employee)
         
         return jsonify({
             "status": "success",
@@ -335,11 +412,15 @@ def assign_manager(employee_id):
                     "status": "error",
                     "message": "Assigned user must have 'manager' role"
                 }), 400
-            employee.manager_id = manager_id
-        else:
-            employee.manager_id = None
+        
+        # manager_id jest claimem w JWT - stare tokeny muszą zostać odrzucone
+        if (manager_id or None) != employee.manager_id:
+            bump_security_version(employee)
+        employee.manager_id = manager_id or None
         
         db.session.commit()
+        invalidate_principal(employee.id)
+        publish_security_version(employee)
         
         return jsonify({
             "status": "success",
@@ -357,31 +438,6 @@ def assign_manager(employee_id):
             "status": "error",
             "message": str(e)
         }), 500
-def compute_delegation_status(expenses):
-    """
-    Oblicza status delegacji na podstawie statusów wydatków.
-    Jedno źródło prawdy - używa normalize_status.
-    - PENDING: jeśli istnieje przynajmniej jeden wydatek pending
-    - REJECTED: tylko jeśli wszystkie wydatki są rejected (i jest ich > 0)
-    - APPROVED: jeśli pending = 0 i przynajmniej jeden wydatek jest approved
-    - Jeśli brak wydatków: zwraca 'PENDING'
-    """
-    if not expenses:
-        return 'PENDING'
-    
-    statuses = [normalize_status(e.status) for e in expenses]
-    pending_count = statuses.count('PENDING')
-    approved_count = statuses.count('APPROVED')
-    rejected_count = statuses.count('REJECTED')
-    total_count = len(statuses)
-    
-    if pending_count > 0:
-        return 'PENDING'
-    if rejected_count == total_count:
-        return 'REJECTED'
-    if approved_count > 0:
-        return 'APPROVED'
-    return 'PENDING'
 @bp.route('/managers', methods=['GET'])
 @jwt_required()
 @require_role('admin')
@@ -458,8 +514,20 @@ def get_manager_details(manager_id):
 @jwt_required()
 @require_role('admin')
 def get_admin_employee_details(employee_id):
-    '''Pobranie szczegółów pracownika wraz z jego delegacjami (tylko admin)'''
+    '''Pobranie szczegółów pracownika wraz z jego delegacjami (tylko admin, ETag)'''
     try:
+        # Wersja pracownika i jego delegacji jednym zapytaniem - 304 bez ładowania wydatków
+        stamp = load_employee_delegations_stamp(employee_id)
+        if not stamp:
+            return jsonify({
+                "status": "error",
+                "message": "Employee not found"
+            }), 404
+        etag = make_etag('admin-employee', employee_id, *stamp)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        
         employee = Employee.query.get(employee_id)
         if not employee:
             return jsonify({
@@ -467,8 +535,8 @@ def get_admin_employee_details(employee_id):
                 "message": "Employee not found"
             }), 404
         
-        # Pobierz delegacje pracownika
-        delegations = Delegation.query.filter_by(employee_id=employee_id).all()
+        # Delegacje pracownika ze statusem wyliczonym z wydatków - jedno zapytanie grupowane
+        delegations = load_delegation_statuses(Delegation.employee_id == employee_id)
         employee_data = {
             "id": employee.id,
             "username": employee.username,
@@ -480,7 +548,7 @@ def get_admin_employee_details(employee_id):
             "manager_id": employee.manager_id
         }
         delegations_data = []
-        for d in delegations:
+        for d, _, derived_status, _ in delegations:
             # WALIDACJA: delegacja musi należeć do tego pracownika
             if d.employee_id != employee_id:
                 return jsonify({
@@ -488,10 +556,6 @@ def get_admin_employee_details(employee_id):
                     "message": f"Inconsistent delegation.employee_id: delegation {d.id} has employee_id={d.employee_id}, expected {employee_id}"
                 }), 500
             
-            # Pobierz wydatki delegacji i oblicz status
-            expenses = Expense.query.filter_by(delegation_id=d.id).all()
-            derived_status = compute_delegation_status(expenses)
-            
             delegations_data.append({
                 "id": d.id,
                 "name": d.name,
@@ -504,11 +568,11 @@ def get_admin_employee_details(employee_id):
                 "purpose": d.purpose,
                 "created_at": d.created_at.isoformat() if d.created_at else None
             })
-        return jsonify({
+        return etag_response({
             "status": "success",
             "employee": employee_data,
             "delegations": delegations_data
-        }), 200
+        }, etag)
     except Exception as e:
         return jsonify({
             "status": "error",
@@ -518,17 +582,29 @@ def get_admin_employee_details(employee_id):
 @jwt_required()
 @require_role('admin')
 def get_admin_delegation_details(delegation_id):
-    '''Pobranie szczegółów delegacji wraz z wydatkami (tylko admin)'''
+    '''Pobranie szczegółów delegacji wraz z wydatkami (tylko admin, ETag)'''
     try:
-        delegation = Delegation.query.get(delegation_id)
+        stamp = load_delegation_stamp(delegation_id)
+        if not stamp:
+            return jsonify({
+                "status": "error",
+                "message": "Delegation not found"
+            }), 404
+        etag = make_etag('admin-delegation', *delegation_detail_version(stamp))
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        
+        # Delegacja z pracownikiem, wydatkami i dokumentami w stałej liczbie zapytań
+        delegation = load_delegation_detail(delegation_id)
         if not delegation:
             return jsonify({
                 "status": "error",
                 "message": "Delegation not found"
             }), 404
         
-        # Pobierz pracownika i waliduj spójność
-        employee = Employee.query.get(delegation.employee_id)
+        # Pracownik i walidacja spójności
+        employee = delegation.employee
         if not employee:
             return jsonify({
                 "status": "error",
@@ -537,10 +613,9 @@ def get_admin_delegation_details(delegation_id):
         if delegation.employee_id != employee.id:
             abort(500, description=f"Inconsistent delegation employee: delegation.employee_id={delegation.employee_id}, employee.id={employee.id}")
         
-        # Pobierz wydatki delegacji
-        expenses = Expense.query.filter_by(delegation_id=delegation_id).all()
-        # Oblicz status delegacji na podstawie wydatków (jedno źródło prawdy)
-        derived_status = compute_delegation_status(expenses)
+        expenses = delegation.expenses
+        # Status i sumy z rollupu delegacji - bez przeliczania wszystkich wydatków
+        summary = summarize_rollup(delegation.rollup)
         
         delegation_data = {
             "id": delegation.id,
@@ -550,7 +625,7 @@ def get_admin_delegation_details(delegation_id):
             "purpose": delegation.purpose,
             "start_date": delegation.start_date.isoformat() if delegation.start_date else None,
             "end_date": delegation.end_date.isoformat() if delegation.end_date else None,
-            "status": derived_status,
+            "status": summary.status,
             "employee_id": delegation.employee_id
         }
         employee_data = {
@@ -560,12 +635,7 @@ def get_admin_delegation_details(delegation_id):
             "last_name": employee.last_name,
             "email": employee.email
         }
-        # Przygotuj dane wydatków z obliczonymi sumami
         expenses_data = []
-        total_amount = Decimal('0')
-        pending_amount = Decimal('0')
-        approved_amount = Decimal('0')
-        rejected_amount = Decimal('0')
         for exp in expenses:
             # WALIDACJA: expense musi należeć do tej delegacji
             if exp.delegation_id != delegation_id:
@@ -583,26 +653,30 @@ def get_admin_delegation_details(delegation_id):
                 "category_id": exp.category_id,
                 "created_at": exp.created_at.isoformat() if exp.created_at else None
             })
-            
-            total_amount += amount
-            if status == 'PENDING':
-                pending_amount += amount
-            elif status == 'APPROVED':
-                approved_amount += amount
-            elif status == 'REJECTED':
-                rejected_amount += amount
         
-        return jsonify({
+        return etag_response({
             "status": "success",
             "delegation": delegation_data,
             "employee": employee_data,
             "items": expenses_data,
-            "summary": {
-                "total": float(total_amount),
-                "pending": float(pending_amount),
-                "approved": float(approved_amount),
-                "rejected": float(rejected_amount)
-            }
+            "documents": [serialize_document(doc) for doc in delegation.documents],
+            "summary": serialize_rollup_summary(summary)
+        }, etag)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/rate-limits', methods=['GET'])
+@jwt_required()
+@require_role('admin')
+def get_rate_limits():
+    """Liczniki limitów logowania per kubełek - do strojenia limitów (tylko admin)"""
+    try:
+        return jsonify({
+            "status": "success",
+            "buckets": get_rate_limiter().stats()
         }), 200
     except Exception as e:
         return jsonify({
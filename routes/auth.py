@@ -1,15 +1,15 @@
-from flask import Blueprint, request, jsonify, current_app
-from models import db, Employee
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
-from flask_bcrypt import Bcrypt
+from flask import Blueprint, request, jsonify
+from models import db, Employee, normalize_identifier
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from sqlalchemy.exc import IntegrityError
+from services.token_versions import create_employee_token, bump_security_version, publish_security_version
+from services.passwords import hash_password, check_password, get_password_hasher, PasswordHasherBusy
+from services.rate_limit import check_login_rate
+from services.versioning import load_employee_version
+from utils import make_etag, not_modified_response, etag_response
 
 bp = Blueprint('auth', __name__)
 
-def get_bcrypt():
-    """Pobiera instancję bcrypt z current_app"""
-    return current_app.extensions.get('bcrypt')
-
 @bp.route('/register', methods=['POST'])
 def register():
     """Rejestracja nowego pracownika"""
@@ -25,7 +25,8 @@ def register():
         
         # Sprawdzenie czy pracownik już istnieje
         existing_employee = Employee.query.filter(
-            (Employee.username == data['username']) | (Employee.email == data['email'])
+            (Employee.username_key == normalize_identifier(data['username'])) |
+            (Employee.email_key == normalize_identifier(data['email']))
         ).first()
         
         if existing_employee:
@@ -34,9 +35,8 @@ def register():
                 "message": "Employee with this username or email already exists"
             }), 409
         
-        # Hashowanie hasła
-        bcrypt = get_bcrypt()
-        hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+        # Hashowanie hasła (w puli procesów)
+        hashed_password = hash_password(data['password'])
         
         # Tworzenie nowego pracownika
         new_employee = Employee(
@@ -61,6 +61,12 @@ def register():
             "status": "error",
             "message": "Employee with this username or email already exists"
         }), 409
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         db.session.rollback()
         return jsonify({
@@ -82,8 +88,16 @@ def login():
                 "message": "Email and password are required"
             }), 400
         
-        # Znajdź pracownika po emailu
-        employee = Employee.query.filter_by(email=email).first()
+        # Limit prób logowania per IP i per email - odrzucamy przed zapytaniem do bazy i bcryptem
+        retry_after = check_login_rate(email, request.remote_addr)
+        if retry_after:
+            return jsonify({
+                "status": "error",
+                "message": "Too many login attempts, try again later"
+            }), 429, {'Retry-After': str(retry_after)}
+        
+        # Znajdź pracownika po emailu (indeks lower(trim(email)))
+        employee = Employee.query.filter(Employee.email_key == normalize_identifier(email)).first()
         
         if not employee:
             return jsonify({
@@ -99,15 +113,24 @@ def login():
             }), 403
         
         # Weryfikacja hasła
-        bcrypt = get_bcrypt()
-        if not bcrypt.check_password_hash(employee.password, password):
+        if not check_password(employee.password, password):
             return jsonify({
                 "status": "error",
                 "message": "Invalid credentials"
             }), 401
         
-        # Generowanie JWT tokena
-        access_token = create_access_token(identity=str(employee.id))
+        # Hash z nieaktualnym cost factorem - przelicz go przy okazji udanego logowania
+        hasher = get_password_hasher()
+        if hasher.needs_rehash(employee.password):
+            try:
+                employee.password = hasher.hash(password)
+                db.session.commit()
+            except PasswordHasherBusy:
+                # Przeliczymy przy następnym logowaniu
+                db.session.rollback()
+        
+        # Generowanie JWT tokena (claimy role, manager_id i ver - autoryzacja bez bazy)
+        access_token = create_employee_token(employee)
         
         # Przygotowanie odpowiedzi
         response_data = {
@@ -125,6 +148,11 @@ def login():
         
         return jsonify(response_data), 200
         
+    except PasswordHasherBusy as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         return jsonify({
             "status": "error",
@@ -134,9 +162,20 @@ def login():
 @bp.route('/me', methods=['GET'])
 @jwt_required()
 def get_current_employee():
-    """Pobranie danych aktualnego zalogowanego pracownika"""
+    """Pobranie danych aktualnego zalogowanego pracownika (ETag, If-None-Match -> 304)"""
     try:
         employee_id = get_jwt_identity()
+        version = load_employee_version(employee_id)
+        if version is None:
+            return jsonify({
+                "status": "error",
+                "message": "Employee not found"
+            }), 404
+        etag = make_etag('me', employee_id, version)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        
         employee = Employee.query.get(employee_id)
         
         if not employee:
@@ -155,10 +194,10 @@ def get_current_employee():
             "created_at": employee.created_at.isoformat() if employee.created_at else None
         }
         
-        return jsonify({
+        return etag_response({
             "status": "success",
             "employee": employee_data
-        }), 200
+        }, etag)
         
     except Exception as e:
         return jsonify({
@@ -218,24 +257,33 @@ def change_password():
             }), 400
         
         # Weryfikacja starego hasła
-        bcrypt = get_bcrypt()
-        if not bcrypt.check_password_hash(employee.password, old_password):
+        if not check_password(employee.password, old_password):
             return jsonify({
                 "status": "error",
                 "message": "Invalid old password"
             }), 401
         
         # Hashowanie nowego hasła
-        hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
+        hashed_password = hash_password(new_password)
         employee.password = hashed_password
+        # Zmiana hasła unieważnia wszystkie wcześniej wydane tokeny
+        bump_security_version(employee)
         
         db.session.commit()
+        publish_security_version(employee)
         
         return jsonify({
             "status": "success",
-            "message": "Password changed successfully"
+            "message": "Password changed successfully",
+            "token": create_employee_token(employee)
         }), 200
         
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         db.session.rollback()
         return jsonify({
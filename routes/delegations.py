@@ -1,39 +1,224 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, current_app, url_for, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, Delegation, Employee, Document, Expense, ExchangeRate, Currency
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import RequestEntityTooLarge
+from models import db, Delegation, Document, Expense, Currency
 from datetime import datetime, date
-from utils import get_current_employee
+import base64
+import json
+from utils import get_current_principal, make_etag, not_modified_response, etag_response
+from services.expenses import (
+    validate_expenses, insert_expenses, serialize_expense, iter_ndjson, stream_expenses
+)
+from services.employee_import import NDJSON_CONTENT_TYPES
+from services.delegations import (
+    load_delegation_detail, can_view_delegation, delegation_detail_version, document_urls, serialize_document
+)
+from services.versioning import load_delegation_stamp
+from services.idempotency import idempotent
+from services.sync import changes_since, decode_sync_cursor, encode_sync_cursor, InvalidSyncCursor
+from services.storage import (
+    get_storage, send_stored_file, send_from_store, document_mimetype, DocumentTooLarge, MULTIPART_OVERHEAD
+)
+from services.previews import get_previews, PreviewFailed, PREVIEW_MIMETYPE
+from services.document_archive import stream_documents_zip
+from services.uploads import (
+    get_upload_sessions, UploadNotFound, UploadOffsetMismatch, UploadBusy, UploadIncomplete
+)
 
 bp = Blueprint('delegations', __name__)
 
+# Pola listy delegacji dostępne w parametrze fields= (id jest zawsze zwracane)
+DELEGATION_LIST_FIELDS = {
+    'id': lambda d: d.id,
+    'start_date': lambda d: d.start_date.isoformat() if d.start_date else None,
+    'end_date': lambda d: d.end_date.isoformat() if d.end_date else None,
+    'status': lambda d: d.status,
+    'country': lambda d: d.country,
+    'city': lambda d: d.city,
+    'name': lambda d: d.name,
+    'purpose': lambda d: d.purpose,
+    'created_at': lambda d: d.created_at.isoformat() if d.created_at else None
+}
+
+def _encode_cursor(delegation):
+    """Kursor keyset: (start_date, id) ostatniego elementu strony"""
+    raw = f"{delegation.start_date.isoformat()}|{delegation.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+    start_date, _, delegation_id = raw.partition('|')
+    return datetime.strptime(start_date, '%Y-%m-%d').date(), int(delegation_id)
+
+def _serialize_new_document(document):
+    download_url, preview_url = document_urls(document)
+    return {
+        'id': document.id,
+        'filename': document.filename,
+        'file_type': document.file_type,
+        'description': document.description,
+        'content_hash': document.content_hash,
+        'size_bytes': document.size_bytes,
+        'download_url': download_url,
+        'preview_url': preview_url
+    }
+
 @bp.route('', methods=['GET'])
 @jwt_required()
 def get_delegations():
-    """Pobranie listy delegacji zalogowanego pracownika"""
+    """
+    Pobranie listy delegacji zalogowanego pracownika.
+    Bez limit i cursor - pełna lista jak dotąd. Z nimi stronicowanie keyset po
+    (start_date, id) malejąco - kolejna strona przez ?cursor= z nagłówka
+    X-Next-Cursor. Filtry: status (lista po przecinku), date_from, date_to,
+    country, city; fields= ogranicza zwracane pola.
+    """
     employee_id = get_jwt_identity()
     
     try:
         # Sprawdź czy pracownik istnieje
-        employee = Employee.query.get(employee_id)
+        employee = get_current_principal()
         if not employee:
             return jsonify({
                 "status": "error",
                 "message": "Employee not found"
             }), 404
         
-        delegations = Delegation.query.filter_by(employee_id=employee_id).all()
-        return jsonify([{
-                'id': d.id,
-                'start_date': d.start_date.isoformat() if d.start_date else None,
-                'end_date': d.end_date.isoformat() if d.end_date else None,
-                'status': d.status,
-                'country': d.country,
-                'city': d.city,
-                'name': d.name,
-                'purpose': d.purpose,
-                'created_at': d.created_at.isoformat() if d.created_at else None
-            } for d in delegations]
-        ), 200
+        # Rozmiar strony - stronicowanie tylko na żądanie klienta (limit lub cursor),
+        # żeby dotychczasowi klienci nadal dostawali całą listę
+        limit = None
+        if 'limit' in request.args or 'cursor' in request.args:
+            default_limit = current_app.config.get('DELEGATIONS_PAGE_SIZE', 100)
+            max_limit = current_app.config.get('DELEGATIONS_MAX_PAGE_SIZE', 500)
+            try:
+                limit = int(request.args.get('limit', default_limit))
+            except ValueError:
+                return jsonify({
+                    "status": "error",
+                    "message": "limit must be an integer"
+                }), 400
+            limit = max(1, min(limit, max_limit))
+        
+        # Sparse fieldset
+        fields = list(DELEGATION_LIST_FIELDS)
+        if request.args.get('fields'):
+            requested = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+            unknown = [f for f in requested if f not in DELEGATION_LIST_FIELDS]
+            if unknown:
+                return jsonify({
+                    "status": "error",
+                    "message": f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(DELEGATION_LIST_FIELDS)}"
+                }), 400
+            fields = ['id'] + [f for f in requested if f != 'id']
+        
+        query = Delegation.query.filter(Delegation.employee_id == employee.id)
+        
+        # Filtry
+        if request.args.get('status'):
+            statuses = [s.strip().lower() for s in request.args['status'].split(',') if s.strip()]
+            query = query.filter(func.lower(Delegation.status).in_(statuses))
+        try:
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date() \
+                if request.args.get('date_from') else None
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date() \
+                if request.args.get('date_to') else None
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Invalid date format: {str(e)}"
+            }), 400
+        if date_from:
+            query = query.filter(Delegation.end_date >= date_from)
+        if date_to:
+            query = query.filter(Delegation.start_date <= date_to)
+        if request.args.get('country'):
+            query = query.filter(func.lower(Delegation.country) == request.args['country'].strip().lower())
+        if request.args.get('city'):
+            query = query.filter(func.lower(Delegation.city) == request.args['city'].strip().lower())
+        
+        # Keyset - indeks (employee_id, start_date, id)
+        if request.args.get('cursor'):
+            try:
+                cursor_date, cursor_id = _decode_cursor(request.args['cursor'])
+            except (ValueError, UnicodeDecodeError):
+                return jsonify({
+                    "status": "error",
+                    "message": "Invalid cursor"
+                }), 400
+            query = query.filter(tuple_(Delegation.start_date, Delegation.id) < tuple_(cursor_date, cursor_id))
+        
+        columns = {'id', 'start_date'} | set(fields)
+        query = query.options(load_only(*[getattr(Delegation, f) for f in columns]))
+        query = query.order_by(Delegation.start_date.desc(), Delegation.id.desc())
+        if limit is not None:
+            query = query.limit(limit + 1)
+        delegations = query.all()
+        
+        has_more = limit is not None and len(delegations) > limit
+        delegations = delegations[:limit]
+        
+        response = jsonify([
+            {f: DELEGATION_LIST_FIELDS[f](d) for f in fields}
+            for d in delegations
+        ])
+        if has_more:
+            next_cursor = _encode_cursor(delegations[-1])
+            response.headers['X-Next-Cursor'] = next_cursor
+            next_args = request.args.to_dict()
+            next_args['cursor'] = next_cursor
+            response.headers['Link'] = f'<{url_for(".get_delegations", **next_args)}>; rel="next"'
+        return response, 200
+    
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/changes', methods=['GET'])
+@jwt_required()
+def get_delegation_changes():
+    """
+    Synchronizacja delta: delegacje, wydatki i dokumenty zalogowanego pracownika
+    utworzone, zmienione lub usunięte po kursorze ?since= (brak - pełna synchronizacja).
+    Przy has_more klient od razu pyta ponownie z since=next_cursor, na koniec
+    zapisuje cursor z ostatniej odpowiedzi.
+    """
+    try:
+        employee = get_current_principal()
+        if not employee:
+            return jsonify({
+                "status": "error",
+                "message": "Employee not found"
+            }), 404
+        
+        try:
+            since, after = decode_sync_cursor(request.args.get('since'))
+        except InvalidSyncCursor:
+            return jsonify({
+                "status": "error",
+                "message": "Invalid cursor"
+            }), 400
+        try:
+            limit = int(request.args.get('limit', current_app.config.get('SYNC_PAGE_SIZE', 500)))
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "limit must be an integer"
+            }), 400
+        limit = max(1, min(limit, current_app.config.get('SYNC_MAX_PAGE_SIZE', 2000)))
+        
+        changes, cursor, position, has_more = changes_since(employee.id, since, limit, after)
+        return jsonify({
+            "status": "success",
+            **changes,
+            "cursor": encode_sync_cursor(cursor),
+            "next_cursor": encode_sync_cursor(cursor, position),
+            "has_more": has_more
+        }), 200
     
     except Exception as e:
         return jsonify({
@@ -43,6 +228,7 @@ def get_delegations():
 
 @bp.route('', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_delegation():
     """Utworzenie nowej delegacji"""
     employee_id = get_jwt_identity()
@@ -50,7 +236,7 @@ def create_delegation():
     
     try:
         # Sprawdź czy pracownik istnieje
-        employee = Employee.query.get(employee_id)
+        employee = get_current_principal()
         if not employee:
             return jsonify({
                 "status": "error",
@@ -74,6 +260,21 @@ def create_delegation():
                 "message": "start_date must be before or equal to end_date"
             }), 400
         
+        # Walidacja wszystkich wydatków przed zapisem - raportujemy wszystkie błędy naraz
+        expenses_data = data.get('expenses') or []
+        if not isinstance(expenses_data, list):
+            return jsonify({
+                "status": "error",
+                "message": "expenses must be a list"
+            }), 400
+        expense_rows, expense_errors = validate_expenses(expenses_data)
+        if expense_errors:
+            return jsonify({
+                "status": "error",
+                "message": "Invalid expenses",
+                "errors": expense_errors
+            }), 400
+        
         new_delegation = Delegation(
             employee_id=employee_id,
             start_date=start_date,
@@ -88,83 +289,8 @@ def create_delegation():
         db.session.add(new_delegation)
         db.session.flush()  # Flush to get the delegation ID
         
-        # Handle expenses if provided
-        created_expenses = []
-        expenses_data = data.get('expenses', [])
-        
-        if expenses_data:
-            for expense_data in expenses_data:
-                # Validate required fields for expense
-                if not expense_data.get('amount'):
-                    db.session.rollback()
-                    return jsonify({
-                        "status": "error",
-                        "message": "Each expense must have an amount"
-                    }), 400
-                
-                if not expense_data.get('currency_id'):
-                    db.session.rollback()
-                    return jsonify({
-                        "status": "error",
-                        "message": "Each expense must have a currency_id"
-                    }), 400
-                
-                if not expense_data.get('category_id'):
-                    db.session.rollback()
-                    return jsonify({
-                        "status": "error",
-                        "message": "Each expense must have a category_id"
-                    }), 400
-                
-                # Get the exchange rate for the currency
-                currency_id = expense_data['currency_id']
-                
-                # Get the most recent exchange rate for this currency
-                exchange_rate_obj = ExchangeRate.query.filter_by(
-                    currency_id=currency_id
-                ).order_by(ExchangeRate.date_set.desc()).first()
-                
-                if not exchange_rate_obj:
-                    db.session.rollback()
-                    return jsonify({
-                        "status": "error",
-                        "message": f"No exchange rate found for currency_id {currency_id}"
-                    }), 400
-                
-                # Calculate PLN amount
-                amount = float(expense_data['amount'])
-                exchange_rate = float(exchange_rate_obj.rate_to_pln)
-                pln_amount = amount * exchange_rate
-                
-                # Parse payed_at if provided
-                payed_at = None
-                if expense_data.get('payed_at'):
-                    try:
-                        payed_at = datetime.strptime(expense_data['payed_at'], '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        try:
-                            payed_at = datetime.strptime(expense_data['payed_at'], '%Y-%m-%d')
-                        except ValueError:
-                            db.session.rollback()
-                            return jsonify({
-                                "status": "error",
-                                "message": "Invalid payed_at format. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS"
-                            }), 400
-                
-                new_expense = Expense(
-                    delegation_id=new_delegation.id,
-                    explanation=expense_data.get('explanation'),
-                    payed_at=payed_at,
-                    amount=amount,
-                    pln_amount=pln_amount,
-                    exchange_rate=exchange_rate,
-                    currency_id=currency_id,
-                    category_id=expense_data['category_id'],
-                    status=expense_data.get('status', 'draft')
-                )
-                
-                db.session.add(new_expense)
-                created_expenses.append(new_expense)
+        # Wszystkie wydatki jednym INSERT ... RETURNING
+        created_expenses = insert_expenses(new_delegation.id, expense_rows)
         
         db.session.commit()
         
@@ -180,17 +306,7 @@ def create_delegation():
                 'city': new_delegation.city,
                 'name': new_delegation.name,
                 'purpose': new_delegation.purpose,
-                'expenses': [{
-                    'id': exp.id,
-                    'explanation': exp.explanation,
-                    'payed_at': exp.payed_at.isoformat() if exp.payed_at else None,
-                    'amount': float(exp.amount),
-                    'pln_amount': float(exp.pln_amount),
-                    'exchange_rate': float(exp.exchange_rate),
-                    'currency_id': exp.currency_id,
-                    'category_id': exp.category_id,
-                    'status': exp.status
-                } for exp in created_expenses]
+                'expenses': [serialize_expense(exp) for exp in created_expenses]
             }
         }), 201
     
@@ -210,19 +326,18 @@ def create_delegation():
 @bp.route('/<int:delegation_id>', methods=['GET'])
 @jwt_required()
 def get_delegation(delegation_id):
-    """Pobranie szczegółów delegacji"""
-    employee_id = int(get_jwt_identity())
-    
+    """Pobranie szczegółów delegacji (ETag, If-None-Match -> 304)"""
     try:
-        delegation = Delegation.query.get(delegation_id)
-        if not delegation:
+        # Najpierw sama wersja - jedno zapytanie po kluczach głównych
+        stamp = load_delegation_stamp(delegation_id)
+        if not stamp:
             return jsonify({
                 "status": "error",
                 "message": "Delegation not found"
             }), 404
         
         # Sprawdź czy użytkownik ma dostęp do tej delegacji
-        employee = get_current_employee()
+        employee = get_current_principal()
         if not employee:
             return jsonify({
                 "status": "error",
@@ -232,26 +347,29 @@ def get_delegation(delegation_id):
         # Pracownik może zobaczyć tylko swoje delegacje
         # Menedżer może zobaczyć delegacje swoich podwładnych
         # Admin może zobaczyć wszystkie delegacje
-        can_access = False
-        if delegation.employee_id == employee_id:
-            can_access = True
-        elif employee.role == 'manager' and delegation.employee.manager_id == employee_id:
-            can_access = True
-        elif employee.role == 'admin':
-            can_access = True
-        
-        if not can_access:
+        if not can_view_delegation(employee, stamp):
             return jsonify({
                 "status": "error",
                 "message": "Access denied",
             }), 403
         
-        # Pobierz dokumenty
-        documents = Document.query.filter_by(delegation_id=delegation_id).all()
-
-        expenses = Expense.query.filter_by(delegation_id=delegation_id).all()
+        etag = make_etag('delegation', *delegation_detail_version(stamp))
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
         
-        return jsonify({
+        # Delegacja z pracownikiem, dokumentami i wydatkami w stałej liczbie zapytań
+        delegation = load_delegation_detail(delegation_id)
+        if not delegation:
+            return jsonify({
+                "status": "error",
+                "message": "Delegation not found"
+            }), 404
+        
+        documents = delegation.documents
+        expenses = delegation.expenses
+        
+        return etag_response({
             "status": "success",
             "delegation": {
                 'id': delegation.id,
@@ -264,13 +382,7 @@ def get_delegation(delegation_id):
                 'name': delegation.name,
                 'purpose': delegation.purpose,
                 'created_at': delegation.created_at.isoformat() if delegation.created_at else None,
-                'documents': [{
-                    'id': doc.id,
-                    'filename': doc.filename,
-                    'file_type': doc.file_type,
-                    'description': doc.description,
-                    'uploaded_at': doc.uploaded_at.isoformat() if doc.uploaded_at else None
-                } for doc in documents],
+                'documents': [serialize_document(doc) for doc in documents],
                 'expenses': [{
                     'id': exp.id,
                     'delegation_id': exp.delegation_id,
@@ -281,7 +393,7 @@ def get_delegation(delegation_id):
                     'explanation': exp.explanation,
                 } for exp in expenses]
             }
-        }), 200
+        }, etag)
     
     except Exception as e:
         return jsonify({
@@ -397,7 +509,7 @@ def submit_delegation(delegation_id):
             }), 403
         
         # Sprawdź czy delegacja ma menedżera
-        employee = Employee.query.get(employee_id)
+        employee = get_current_principal()
         if not employee or not employee.manager_id:
             return jsonify({
                 "status": "error",
@@ -430,14 +542,108 @@ def submit_delegation(delegation_id):
             "message": str(e)
         }), 500
 
+@bp.route('/<int:delegation_id>/expenses', methods=['POST'])
+@jwt_required()
+@idempotent
+def add_expenses(delegation_id):
+    """
+    Dodanie wydatków do delegacji.
+    application/json - jeden wydatek (odpowiedź 201 z wydatkiem),
+    application/x-ndjson - strumień wydatków przetwarzany partiami,
+    odpowiedź to strumień NDJSON z wynikiem dla każdej linii
+    """
+    try:
+        principal = get_current_principal()
+        delegation = db.session.query(Delegation.id, Delegation.employee_id, Delegation.status) \
+            .filter(Delegation.id == delegation_id).first()
+        if not delegation:
+            return jsonify({
+                "status": "error",
+                "message": "Delegation not found"
+            }), 404
+        
+        # Sprawdź czy użytkownik jest właścicielem delegacji
+        if not principal or delegation.employee_id != principal.id:
+            return jsonify({
+                "status": "error",
+                "message": "You can only add expenses to your own delegations"
+            }), 403
+        
+        # Wydatki można dodawać tylko do delegacji w statusie 'draft'
+        if delegation.status != 'draft':
+            return jsonify({
+                "status": "error",
+                "message": f"Cannot add expenses to delegation with status: {delegation.status}. Only 'draft' delegations can be edited."
+            }), 400
+        
+        if request.mimetype in NDJSON_CONTENT_TYPES:
+            lines = iter_ndjson(request.stream, current_app.config.get('EXPENSE_STREAM_MAX_LINE_BYTES', 65536))
+            batch_size = current_app.config.get('EXPENSE_STREAM_BATCH_SIZE', 200)
+            
+            def generate():
+                try:
+                    for result in stream_expenses(delegation_id, lines, batch_size):
+                        yield json.dumps(result) + '\n'
+                except Exception as e:
+                    # Nagłówki są już wysłane - błąd trafia jako ostatnia linia strumienia
+                    db.session.rollback()
+                    yield json.dumps({"status": "error", "message": str(e)}) + '\n'
+            
+            return Response(stream_with_context(generate()), status=200, mimetype='application/x-ndjson')
+        
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({
+                "status": "error",
+                "message": "Expected a JSON object or an application/x-ndjson stream"
+            }), 400
+        
+        rows, errors = validate_expenses([data])
+        if errors:
+            return jsonify({
+                "status": "error",
+                "message": errors[0]['message'],
+                "errors": errors
+            }), 400
+        
+        expense = insert_expenses(delegation_id, rows)[0]
+        db.session.commit()
+        
+        return jsonify(serialize_expense(expense)), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+def _document_expense_error(delegation_id, expense_id):
+    """Odpowiedź błędu gdy expense_id nie jest wydatkiem tej delegacji, inaczej None"""
+    if expense_id is None:
+        return None
+    expense = db.session.query(Expense.id) \
+        .filter(Expense.id == expense_id, Expense.delegation_id == delegation_id).first()
+    if not expense:
+        return jsonify({
+            "status": "error",
+            "message": "Expense not found in this delegation"
+        }), 400
+    return None
+
 @bp.route('/<int:delegation_id>/documents', methods=['POST'])
 @jwt_required()
 def add_document(delegation_id):
-    """Dodanie dokumentu do delegacji"""
-    employee_id = get_jwt_identity()
+    """
+    Dodanie dokumentu do delegacji.
+    multipart/form-data z polem 'file' - plik trafia do magazynu dokumentów,
+    application/json - sam wpis ze ścieżką podaną przez klienta
+    """
+    employee_id = int(get_jwt_identity())
     
     try:
-        delegation = Delegation.query.get(delegation_id)
+        delegation = db.session.query(Delegation.id, Delegation.employee_id) \
+            .filter(Delegation.id == delegation_id).first()
         if not delegation:
             return jsonify({
                 "status": "error",
@@ -451,37 +657,309 @@ def add_document(delegation_id):
                 "message": "You can only add documents to your own delegations"
             }), 403
         
-        data = request.get_json() or {}
+        if request.mimetype == 'multipart/form-data':
+            store = get_storage()
+            if store.max_bytes:
+                # Limit egzekwowany już przy czytaniu treści żądania - werkzeug nie
+                # buforuje na dysk pliku większego niż DOCUMENT_MAX_BYTES (także przy chunked)
+                request.max_content_length = store.max_bytes + MULTIPART_OVERHEAD
+            try:
+                upload = request.files.get('file')
+            except RequestEntityTooLarge:
+                raise DocumentTooLarge(store.max_bytes)
+            if not upload or not upload.filename:
+                return jsonify({
+                    "status": "error",
+                    "message": "file is required"
+                }), 400
+            
+            try:
+                expense_id = int(request.form['expense_id']) if request.form.get('expense_id') else None
+            except ValueError:
+                return jsonify({
+                    "status": "error",
+                    "message": "expense_id must be an integer"
+                }), 400
+            error = _document_expense_error(delegation_id, expense_id)
+            if error:
+                return error
+            
+            # Plik kopiowany porcjami do magazynu, SHA-256 liczony w locie
+            blob = store.save(upload.stream)
+            new_document = Document(
+                delegation_id=delegation_id,
+                expense_id=expense_id,
+                filename=request.form.get('filename') or upload.filename,
+                file_path=blob.relative_path,
+                file_type=request.form.get('file_type') or upload.mimetype,
+                description=request.form.get('description'),
+                content_hash=blob.content_hash,
+                size_bytes=blob.size
+            )
+        else:
+            data = request.get_json() or {}
+            
+            if not data.get('filename') or not data.get('file_path'):
+                return jsonify({
+                    "status": "error",
+                    "message": "filename and file_path are required"
+                }), 400
+            try:
+                expense_id = int(data['expense_id']) if data.get('expense_id') is not None else None
+            except (TypeError, ValueError):
+                return jsonify({
+                    "status": "error",
+                    "message": "expense_id must be an integer"
+                }), 400
+            error = _document_expense_error(delegation_id, expense_id)
+            if error:
+                return error
+            
+            new_document = Document(
+                delegation_id=delegation_id,
+                expense_id=expense_id,
+                filename=data['filename'],
+                file_path=data['file_path'],
+                file_type=data.get('file_type'),
+                description=data.get('description')
+            )
+        
+        db.session.add(new_document)
+        db.session.commit()
+        if new_document.content_hash:
+            # Podgląd generowany w tle, zanim ktoś otworzy listę dokumentów
+            get_previews().schedule(new_document.content_hash, document_mimetype(new_document))
+        
+        return jsonify({
+            "status": "success",
+            "message": "Document added successfully",
+            "document": _serialize_new_document(new_document)
+        }), 201
+    
+    except DocumentTooLarge as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 413
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+def _upload_owner_error(delegation_id, employee_id):
+    """Odpowiedź błędu gdy delegacja nie istnieje lub nie należy do pracownika, inaczej None"""
+    delegation = db.session.query(Delegation.id, Delegation.employee_id) \
+        .filter(Delegation.id == delegation_id).first()
+    if not delegation:
+        return jsonify({
+            "status": "error",
+            "message": "Delegation not found"
+        }), 404
+    if delegation.employee_id != employee_id:
+        return jsonify({
+            "status": "error",
+            "message": "You can only add documents to your own delegations"
+        }), 403
+    return None
+
+def _get_own_upload(delegation_id, upload_id, employee_id):
+    """Sesja uploadu należąca do pracownika i delegacji; UploadNotFound w przeciwnym razie"""
+    meta = get_upload_sessions().get(upload_id)
+    if meta['delegation_id'] != delegation_id or meta['employee_id'] != employee_id:
+        raise UploadNotFound(upload_id)
+    return meta
+
+def _upload_status(upload_id, meta):
+    response = jsonify({
+        "upload_id": upload_id,
+        "offset": meta['offset'],
+        "size": meta['size'],
+        "expires_at": datetime.utcfromtimestamp(meta['expires_at']).isoformat()
+    })
+    response.headers['Upload-Offset'] = str(meta['offset'])
+    response.headers['Upload-Length'] = str(meta['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@bp.route('/<int:delegation_id>/uploads', methods=['POST'])
+@jwt_required()
+def create_upload(delegation_id):
+    """Utworzenie sesji wznawialnego uploadu dokumentu"""
+    employee_id = int(get_jwt_identity())
+    
+    try:
+        error = _upload_owner_error(delegation_id, employee_id)
+        if error:
+            return error
         
-        if not data.get('filename') or not data.get('file_path'):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({
+                "status": "error",
+                "message": "Request body must be a JSON object"
+            }), 400
+        if not data.get('filename') or data.get('size') is None:
+            return jsonify({
+                "status": "error",
+                "message": "filename and size are required"
+            }), 400
+        try:
+            size = int(data['size'])
+            expense_id = int(data['expense_id']) if data.get('expense_id') else None
+        except (TypeError, ValueError):
             return jsonify({
                 "status": "error",
-                "message": "filename and file_path are required"
+                "message": "size and expense_id must be integers"
             }), 400
+        if size <= 0:
+            return jsonify({
+                "status": "error",
+                "message": "size must be greater than 0"
+            }), 400
+        error = _document_expense_error(delegation_id, expense_id)
+        if error:
+            return error
         
-        new_document = Document(
+        upload_id, meta = get_upload_sessions().create(
             delegation_id=delegation_id,
-            expense_id=data.get('expense_id'),
+            employee_id=employee_id,
             filename=data['filename'],
-            file_path=data['file_path'],
+            size=size,
             file_type=data.get('file_type'),
-            description=data.get('description')
+            description=data.get('description'),
+            expense_id=expense_id
+        )
+        meta['offset'] = 0
+        response = _upload_status(upload_id, meta)
+        response.status_code = 201
+        response.headers['Location'] = url_for(
+            'delegations.upload_chunk', delegation_id=delegation_id, upload_id=upload_id
         )
+        return response
+    
+    except DocumentTooLarge as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 413
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/<int:delegation_id>/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload(delegation_id, upload_id):
+    """Bieżący offset sesji uploadu (także HEAD - nagłówki Upload-Offset/Upload-Length)"""
+    try:
+        meta = _get_own_upload(delegation_id, upload_id, int(get_jwt_identity()))
+        return _upload_status(upload_id, meta)
+    except UploadNotFound:
+        return jsonify({
+            "status": "error",
+            "message": "Upload not found or expired"
+        }), 404
+
+@bp.route('/<int:delegation_id>/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+@jwt_required()
+def upload_chunk(delegation_id, upload_id):
+    """Dopisanie fragmentu pliku od pozycji z nagłówka Upload-Offset"""
+    try:
+        _get_own_upload(delegation_id, upload_id, int(get_jwt_identity()))
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return jsonify({
+                "status": "error",
+                "message": "Upload-Offset header is required"
+            }), 400
         
+        # Treść czytana bezpośrednio ze strumienia żądania, porcjami
+        get_upload_sessions().append(upload_id, offset, request.stream, request.content_length)
+        return _upload_status(upload_id, get_upload_sessions().get(upload_id))
+    
+    except UploadNotFound:
+        return jsonify({
+            "status": "error",
+            "message": "Upload not found or expired"
+        }), 404
+    except UploadOffsetMismatch as e:
+        response = jsonify({
+            "status": "error",
+            "message": str(e),
+            "offset": e.offset
+        })
+        response.status_code = 409
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response
+    except UploadBusy:
+        return jsonify({
+            "status": "error",
+            "message": "Another chunk of this upload is being written"
+        }), 409
+    except DocumentTooLarge as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Chunk exceeds the declared upload size of {e.max_bytes} bytes"
+        }), 413
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/<int:delegation_id>/uploads/<upload_id>/complete', methods=['POST'])
+@jwt_required()
+def complete_upload(delegation_id, upload_id):
+    """Zakończenie uploadu - plik trafia do magazynu i powstaje Document"""
+    try:
+        _get_own_upload(delegation_id, upload_id, int(get_jwt_identity()))
+        meta, blob = get_upload_sessions().complete(upload_id)
+        
+        new_document = Document(
+            delegation_id=delegation_id,
+            expense_id=meta.get('expense_id'),
+            filename=meta['filename'],
+            file_path=blob.relative_path,
+            file_type=meta.get('file_type'),
+            description=meta.get('description'),
+            content_hash=blob.content_hash,
+            size_bytes=blob.size
+        )
         db.session.add(new_document)
         db.session.commit()
+        # Sesja znika dopiero po commicie - po błędzie bazy klient może ponowić complete
+        get_upload_sessions().finish(upload_id)
+        if new_document.content_hash:
+            # Podgląd generowany w tle, zanim ktoś otworzy listę dokumentów
+            get_previews().schedule(new_document.content_hash, document_mimetype(new_document))
         
         return jsonify({
             "status": "success",
             "message": "Document added successfully",
-            "document": {
-                'id': new_document.id,
-                'filename': new_document.filename,
-                'file_type': new_document.file_type,
-                'description': new_document.description
-            }
+            "document": _serialize_new_document(new_document)
         }), 201
     
+    except UploadNotFound:
+        return jsonify({
+            "status": "error",
+            "message": "Upload not found or expired"
+        }), 404
+    except UploadIncomplete as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e),
+            "offset": e.offset
+        }), 409
+    except UploadBusy:
+        return jsonify({
+            "status": "error",
+            "message": "Another chunk of this upload is being written"
+        }), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({
@@ -489,6 +967,152 @@ def add_document(delegation_id):
             "message": str(e)
         }), 500
 
+@bp.route('/<int:delegation_id>/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload(delegation_id, upload_id):
+    """Porzucenie sesji uploadu i usunięcie przesłanych fragmentów"""
+    try:
+        _get_own_upload(delegation_id, upload_id, int(get_jwt_identity()))
+        get_upload_sessions().abort(upload_id)
+        return jsonify({
+            "status": "success",
+            "message": "Upload aborted"
+        }), 200
+    except UploadNotFound:
+        return jsonify({
+            "status": "error",
+            "message": "Upload not found or expired"
+        }), 404
+
+def _load_viewable_document(delegation_id, document_id):
+    """(dokument z plikiem w magazynie, None) albo (None, odpowiedź błędu) - z kontrolą dostępu"""
+    delegation = load_delegation_detail(delegation_id, with_documents=False, with_expenses=False)
+    if not delegation:
+        return None, (jsonify({
+            "status": "error",
+            "message": "Delegation not found"
+        }), 404)
+    
+    if not can_view_delegation(get_current_principal(), delegation):
+        return None, (jsonify({
+            "status": "error",
+            "message": "Access denied"
+        }), 403)
+    
+    document = Document.query.filter_by(id=document_id, delegation_id=delegation_id).first()
+    if not document:
+        return None, (jsonify({
+            "status": "error",
+            "message": "Document not found"
+        }), 404)
+    
+    if not document.content_hash or not get_storage().exists(document.content_hash):
+        return None, (jsonify({
+            "status": "error",
+            "message": "Document has no stored file"
+        }), 404)
+    return document, None
+
+@bp.route('/<int:delegation_id>/documents.zip', methods=['GET'])
+@jwt_required()
+def download_documents_zip(delegation_id):
+    """Wszystkie pliki dokumentów delegacji jako archiwum ZIP budowane w locie"""
+    try:
+        delegation = load_delegation_detail(delegation_id, with_expenses=False)
+        if not delegation:
+            return jsonify({
+                "status": "error",
+                "message": "Delegation not found"
+            }), 404
+        
+        if not can_view_delegation(get_current_principal(), delegation):
+            return jsonify({
+                "status": "error",
+                "message": "Access denied"
+            }), 403
+        
+        documents = sorted(delegation.documents, key=lambda d: (d.expense_id or 0, d.id))
+        archive = stream_documents_zip(get_storage(), documents, document_mimetype)
+        response = Response(stream_with_context(archive), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="delegation-{delegation_id}-documents.zip"'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/<int:delegation_id>/documents/<int:document_id>/download', methods=['GET'])
+@jwt_required()
+def download_document(delegation_id, document_id):
+    """
+    Pobranie pliku dokumentu. Obsługuje Range i warunkowe GET (ETag = SHA-256);
+    za nginx z DOCUMENT_ACCEL_REDIRECT_PREFIX plik wysyła nginx (X-Accel-Redirect)
+    """
+    try:
+        document, error = _load_viewable_document(delegation_id, document_id)
+        if error:
+            return error
+        return send_stored_file(get_storage(), document)
+    
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@bp.route('/<int:delegation_id>/documents/<int:document_id>/preview', methods=['GET'])
+@jwt_required()
+def preview_document(delegation_id, document_id):
+    """
+    Pomniejszony podgląd (JPEG) obrazu lub pierwszej strony PDF.
+    Gdy podgląd jeszcze się generuje - 202 z Retry-After
+    """
+    try:
+        document, error = _load_viewable_document(delegation_id, document_id)
+        if error:
+            return error
+        
+        previews = get_previews()
+        mimetype = document_mimetype(document)
+        if not previews.supports(mimetype):
+            return jsonify({
+                "status": "error",
+                "message": "Preview is not available for this document type"
+            }), 404
+        
+        path = previews.get(document.content_hash, mimetype, wait=current_app.config.get('PREVIEW_WAIT_SECONDS', 5))
+        if path is None:
+            return jsonify({
+                "status": "pending",
+                "message": "Preview is being generated"
+            }), 202, {'Retry-After': '1'}
+        
+        response = send_from_store(
+            get_storage(),
+            previews.relative_path(document.content_hash),
+            PREVIEW_MIMETYPE,
+            f'{document.content_hash}-{previews.max_size}'
+        )
+        # Podgląd danej treści nigdy się nie zmienia
+        response.cache_control.no_cache = None
+        response.cache_control.private = True
+        response.cache_control.max_age = 86400
+        return response
+    
+    except PreviewFailed:
+        return jsonify({
+            "status": "error",
+            "message": "Preview could not be generated for this document"
+        }), 404
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
 @bp.route('/<int:delegation_id>/documents/<int:document_id>', methods=['DELETE'])
 @jwt_required()
 def delete_document(delegation_id, document_id):
@@ -0,0 +1,67 @@
+from flask import Blueprint, jsonify, request, current_app
+from services.signed_urls import get_signed_urls
+from services.storage import get_storage, send_from_store
+from services.previews import get_previews, PreviewFailed, PREVIEW_MIMETYPE
+import time
+
+bp = Blueprint('files', __name__)
+
+@bp.route('/<kind>/<content_hash>', methods=['GET'])
+def serve_signed_file(kind, content_hash):
+    """
+    Plik dokumentu lub podgląd pod podpisanym adresem (HMAC) - bez JWT i bez
+    zapytań do bazy; uprawnienia zostały sprawdzone przy wydawaniu adresu
+    """
+    verified = get_signed_urls().verify(kind, content_hash, request.args)
+    if verified is None:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid or expired link"
+        }), 403
+    name, mimetype, expires = verified
+
+    try:
+        store = get_storage()
+        if not store.exists(content_hash):
+            return jsonify({
+                "status": "error",
+                "message": "File not found"
+            }), 404
+
+        if kind == 'preview':
+            previews = get_previews()
+            if not previews.supports(mimetype):
+                return jsonify({
+                    "status": "error",
+                    "message": "Preview is not available for this document type"
+                }), 404
+            if previews.get(content_hash, mimetype, wait=current_app.config.get('PREVIEW_WAIT_SECONDS', 5)) is None:
+                return jsonify({
+                    "status": "pending",
+                    "message": "Preview is being generated"
+                }), 202, {'Retry-After': '1'}
+            response = send_from_store(
+                store, previews.relative_path(content_hash), PREVIEW_MIMETYPE, f'{content_hash}-{previews.max_size}'
+            )
+        else:
+            response = send_from_store(
+                store, store.relative_path(content_hash), mimetype or 'application/octet-stream', content_hash,
+                download_name=name or None, as_attachment=True
+            )
+
+        # Przeglądarka może trzymać plik do końca ważności adresu
+        response.cache_control.no_cache = None
+        response.cache_control.private = True
+        response.cache_control.max_age = max(0, expires - int(time.time()))
+        return response
+
+    except PreviewFailed:
+        return jsonify({
+            "status": "error",
+            "message": "Preview could not be generated for this document"
+        }), 404
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
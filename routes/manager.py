@@ -1,64 +1,35 @@
 from flask import Blueprint, request, jsonify, current_app
-from models import db, Delegation, Employee, Expense, Currency, ExpenseCategory
+from models import db, Delegation, Employee, Expense, Currency, ExpenseCategory, normalize_identifier
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from utils import require_role, get_current_employee
-from datetime import date, timedelta
+from utils import (
+    require_role, get_current_employee, get_current_principal, make_etag, not_modified_response, etag_response
+)
+from services.passwords import hash_password
+from services.delegations import (
+    load_delegation_detail, is_subordinate_delegation, delegation_detail_version, serialize_document
+)
+from services.versioning import load_delegation_stamp
+from services.delegation_status import normalize_status, compute_delegation_status, load_delegation_statuses
+from services.rollups import summarize_rollup, serialize_rollup_summary
+from services.expense_review import parse_decisions, apply_expense_decisions, decide_pending_expenses
+from services.team_overview import load_team_overview, current_periods
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 
 bp = Blueprint('manager', __name__)
 
-VALID_STATUSES = {'PENDING', 'APPROVED', 'REJECTED'}
-
-
-def normalize_status(value):
-    """Ensure status is one of the allowed uppercase values, defaulting to PENDING."""
-    if not value:
-        return 'PENDING'
-    status = str(value).upper()
-    return status if status in VALID_STATUSES else 'PENDING'
-
-
-def compute_delegation_status(expenses):
-    """
-    Oblicza status delegacji na podstawie statusów wydatków.
-    - PENDING: jeśli istnieje przynajmniej jeden wydatek pending
-    - REJECTED: tylko jeśli wszystkie wydatki są rejected (i jest ich > 0)
-    - APPROVED: jeśli pending = 0 i przynajmniej jeden wydatek jest approved
-    - Jeśli brak wydatków: zwraca 'PENDING' (fallback)
-    """
-    if not expenses:
-        return 'PENDING'
-    
-    normalized_statuses = [normalize_status(e.status) for e in expenses]
-    pending_count = sum(1 for s in normalized_statuses if s == 'PENDING')
-    approved_count = sum(1 for s in normalized_statuses if s == 'APPROVED')
-    rejected_count = sum(1 for s in normalized_statuses if s == 'REJECTED')
-    total_count = len(expenses)
-    
-    # Jeśli jest przynajmniej jeden pending -> PENDING
-    if pending_count > 0:
-        return 'PENDING'
-    
-    # Jeśli wszystkie są rejected -> REJECTED
-    if rejected_count == total_count:
-        return 'REJECTED'
-    
-    # Jeśli pending = 0 i przynajmniej jeden approved -> APPROVED
-    if approved_count > 0:
-        return 'APPROVED'
-    
-    # Fallback
-    return 'PENDING'
-
-
 @bp.route('/employees', methods=['GET'])
 @jwt_required()
 @require_role('manager')
 def get_my_employees():
-    """Pobranie listy pracowników przypisanych do menedżera"""
+    """
+    Pobranie listy pracowników przypisanych do menedżera.
+    ?include=stats - dla każdego liczniki delegacji wg statusu, wydatki PENDING
+    i wydatki PLN w bieżącym miesiącu i roku (jedno zapytanie dla całego zespołu)
+    """
     try:
         manager_id = get_jwt_identity()
-        manager = Employee.query.get(manager_id)
+        manager = get_current_principal()
         
         if not manager:
             return jsonify({
@@ -66,15 +37,27 @@ def get_my_employees():
                 "message": "Manager not found"
             }), 404
         
-        # Pobierz pracowników przypisanych do menedżera
-        employees = Employee.query.filter_by(manager_id=manager_id).all()
+        include = {part.strip() for part in request.args.get('include', '').split(',') if part.strip()}
+        with_stats = 'stats' in include
+        now = datetime.utcnow()
+        
+        # Pobierz pracowników przypisanych do menedżera (z licznikami w tym samym zapytaniu)
+        if with_stats:
+            overview = load_team_overview(manager.id, now)
+            employees = [emp for emp, _ in overview]
+        else:
+            employees = Employee.query.filter_by(manager_id=manager_id).all()
         
         # Jeśli brak pracowników i DEV_SEED jest włączony, utwórz testowych
         if not employees and current_app.config.get('DEV_SEED', 'false').lower() == 'true':
             employees = _create_test_employees_for_manager(manager_id)
+            if with_stats:
+                overview = load_team_overview(manager.id, now)
+        stats_by_id = {emp.id: stats for emp, stats in overview} if with_stats else {}
         
-        employees_data = [
-            {
+        employees_data = []
+        for emp in employees:
+            emp_data = {
                 'id': emp.id,
                 'username': emp.username,
                 'first_name': emp.first_name,
@@ -83,13 +66,21 @@ def get_my_employees():
                 'role': emp.role,
                 'is_active': emp.is_active
             }
-            for emp in employees
-        ]
+            if with_stats:
+                emp_data['stats'] = stats_by_id.get(emp.id)
+            employees_data.append(emp_data)
         
-        return jsonify({
+        response = {
             "status": "success",
             "employees": employees_data
-        }), 200
+        }
+        if with_stats:
+            month_start, year_start, _ = current_periods(now)
+            response["period"] = {
+                "month": month_start.strftime('%Y-%m'),
+                "year": year_start.year
+            }
+        return jsonify(response), 200
     
     except Exception as e:
         return jsonify({
@@ -103,10 +94,6 @@ def _create_test_employees_for_manager(manager_id):
     Helper: tworzy testowych pracowników dla menedżera (tylko w DEV)
     Idempotentny - sprawdza czy użytkownicy już istnieją
     """
-    bcrypt = current_app.extensions.get('bcrypt')
-    if not bcrypt:
-        return []
-    
     test_employees_data = [
         {
             'username': f'pracownik_test1',
@@ -135,14 +122,14 @@ def _create_test_employees_for_manager(manager_id):
     
     for emp_data in test_employees_data:
         # Sprawdź czy użytkownik już istnieje
-        existing = Employee.query.filter_by(email=emp_data['email']).first()
+        existing = Employee.query.filter(Employee.email_key == normalize_identifier(emp_data['email'])).first()
         
         if existing:
             created_employees.append(existing)
             continue
         
         # Hashuj hasło
-        hashed_password = bcrypt.generate_password_hash(emp_data['password']).decode('utf-8')
+        hashed_password = hash_password(emp_data['password'])
         
         # Utwórz nowego pracownika
         new_employee = Employee(
@@ -188,12 +175,13 @@ def get_employee_details(employee_id):
                 "message": "You can only view employees assigned to you"
             }), 403
         
-        # Pobierz delegacje pracownika
-        delegations = Delegation.query.filter_by(employee_id=employee_id).all()
+        # Delegacje pracownika ze statusem wyliczonym z wydatków - jedno zapytanie grupowane
+        delegations = load_delegation_statuses(Delegation.employee_id == employee_id)
         
         # Jeśli brak delegacji i DEV_SEED jest włączony, utwórz testowe
         if not delegations and current_app.config.get('DEV_SEED', 'false').lower() == 'true':
-            delegations = _create_test_delegations_for_employee(employee_id)
+            _create_test_delegations_for_employee(employee_id)
+            delegations = load_delegation_statuses(Delegation.employee_id == employee_id)
         
         employee_data = {
             'id': employee.id,
@@ -206,11 +194,7 @@ def get_employee_details(employee_id):
         }
         
         delegations_data = []
-        for d in delegations:
-            # Pobierz wydatki delegacji i oblicz status (jedno źródło prawdy)
-            expenses = Expense.query.filter_by(delegation_id=d.id).all()
-            derived_status = compute_delegation_status(expenses)
-            
+        for d, _, derived_status, _ in delegations:
             delegations_data.append({
                 'id': d.id,
                 'employee_id': d.employee_id,
@@ -315,34 +299,46 @@ def _create_test_delegations_for_employee(employee_id):
 @jwt_required()
 @require_role('manager')
 def get_delegation_details(delegation_id):
-    """Pobranie szczegółów delegacji wraz z wydatkami"""
+    """Pobranie szczegółów delegacji wraz z wydatkami (ETag, If-None-Match -> 304)"""
     try:
-        manager_id = int(get_jwt_identity())
-        delegation = Delegation.query.get(delegation_id)
+        # Najpierw sama wersja - jedno zapytanie po kluczach głównych
+        stamp = load_delegation_stamp(delegation_id)
         
-        if not delegation:
+        if not stamp:
             return jsonify({
                 "status": "error",
                 "message": "Delegation not found"
             }), 404
         
         # Sprawdź czy delegacja należy do pracownika tego menedżera
-        employee = Employee.query.get(delegation.employee_id)
-        if not employee or employee.manager_id != manager_id:
+        if not is_subordinate_delegation(get_current_principal(), stamp):
             return jsonify({
                 "status": "error",
                 "message": "You can only view delegations of your subordinates"
             }), 403
         
-        # Pobierz wydatki delegacji
-        expenses = Expense.query.filter_by(delegation_id=delegation_id).all()
+        etag = make_etag('manager-delegation', *delegation_detail_version(stamp))
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        
+        # Delegacja z pracownikiem, wydatkami i dokumentami w stałej liczbie zapytań
+        delegation = load_delegation_detail(delegation_id)
+        if not delegation:
+            return jsonify({
+                "status": "error",
+                "message": "Delegation not found"
+            }), 404
+        employee = delegation.employee
+        
+        expenses = list(delegation.expenses)
         
         # Jeśli brak wydatków i DEV_SEED jest włączony, utwórz testowe
         if not expenses and current_app.config.get('DEV_SEED', 'false').lower() == 'true':
             expenses = _create_test_expenses_for_delegation(delegation_id)
         
-        # Oblicz status delegacji na podstawie wydatków (jedno źródło prawdy)
-        derived_status = compute_delegation_status(expenses)
+        # Status i sumy z rollupu delegacji - bez przeliczania wszystkich wydatków
+        summary = summarize_rollup(delegation.rollup)
         
         delegation_data = {
             'id': delegation.id,
@@ -352,7 +348,7 @@ def get_delegation_details(delegation_id):
             'purpose': delegation.purpose,
             'start_date': delegation.start_date.isoformat() if delegation.start_date else None,
             'end_date': delegation.end_date.isoformat() if delegation.end_date else None,
-            'status': derived_status,
+            'status': summary.status,
             'employee_id': delegation.employee_id
         }
         
@@ -364,12 +360,7 @@ def get_delegation_details(delegation_id):
             'email': employee.email
         }
         
-        # Przygotuj dane wydatków z obliczonymi sumami
         expenses_data = []
-        total_amount = Decimal('0')
-        pending_amount = Decimal('0')
-        approved_amount = Decimal('0')
-        rejected_amount = Decimal('0')
         
         for exp in expenses:
             amount = exp.pln_amount or exp.amount or Decimal('0')
@@ -384,27 +375,15 @@ def get_delegation_details(delegation_id):
                 'category_id': exp.category_id,
                 'created_at': exp.created_at.isoformat() if exp.created_at else None
             })
-            
-            total_amount += amount
-            if status == 'PENDING':
-                pending_amount += amount
-            elif status == 'APPROVED':
-                approved_amount += amount
-            elif status == 'REJECTED':
-                rejected_amount += amount
         
-        return jsonify({
+        return etag_response({
             "status": "success",
             "delegation": delegation_data,
             "employee": employee_data,
             "items": expenses_data,
-            "summary": {
-                "total": float(total_amount),
-                "pending": float(pending_amount),
-                "approved": float(approved_amount),
-                "rejected": float(rejected_amount)
-            }
-        }), 200
+            "documents": [serialize_document(doc) for doc in delegation.documents],
+            "summary": serialize_rollup_summary(summary)
+        }, etag)
     
     except Exception as e:
         return jsonify({
@@ -494,8 +473,7 @@ def _create_test_expenses_for_delegation(delegation_id):
 def get_subordinates_delegations():
     """Pobranie delegacji podwładnych pracowników (tylko menedżer)"""
     try:
-        manager_id = get_jwt_identity()
-        manager = Employee.query.get(manager_id)
+        manager = get_current_principal()
         
         if not manager:
             return jsonify({
@@ -503,21 +481,11 @@ def get_subordinates_delegations():
                 "message": "Manager not found"
             }), 404
         
-        # Pobierz wszystkich podwładnych
-        subordinates = Employee.query.filter_by(manager_id=manager_id).all()
-        subordinate_ids = [sub.id for sub in subordinates]
-        
-        # Pobierz delegacje podwładnych
-        delegations = Delegation.query.filter(
-            Delegation.employee_id.in_(subordinate_ids)
-        ).all()
+        # Delegacje podwładnych z pracownikiem i statusem z wydatków - jedno zapytanie grupowane
+        delegations = load_delegation_statuses(Employee.manager_id == manager.id)
         
         delegations_data = []
-        for d in delegations:
-            employee = Employee.query.get(d.employee_id)
-            expenses = Expense.query.filter_by(delegation_id=d.id).all()
-            derived_status = compute_delegation_status(expenses)
-
+        for d, employee, derived_status, _ in delegations:
             delegations_data.append({
                 'id': d.id,
                 'employee_id': d.employee_id,
@@ -545,6 +513,57 @@ def get_subordinates_delegations():
         }), 500
 
 
+@bp.route('/items/decisions', methods=['POST'])
+@jwt_required()
+@require_role('manager')
+def decide_expense_items():
+    """
+    Zatwierdzenie/odrzucenie wielu wydatków z różnych delegacji podwładnych jednym żądaniem.
+    Body: {"decisions": [{"expense_id": int, "decision": "approve" | "reject"}, ...]}.
+    Poprawne pozycje zapisywane w jednej transakcji, błędne opisane w raporcie per pozycja
+    """
+    try:
+        manager_id = int(get_jwt_identity())
+        data = request.get_json(silent=True)
+        items = data.get('decisions') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({
+                "status": "error",
+                "message": "decisions must be a non-empty list"
+            }), 400
+        
+        max_items = current_app.config.get('MANAGER_DECISIONS_MAX_ITEMS', 1000)
+        if len(items) > max_items:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many decisions. Maximum is {max_items} per request"
+            }), 413
+        
+        decisions, errors = parse_decisions(items)
+        results, delegation_statuses = apply_expense_decisions(manager_id, decisions)
+        db.session.commit()
+        
+        results = sorted(results + errors, key=lambda r: r['index'])
+        updated = sum(1 for r in results if r['status'] != 'error')
+        return jsonify({
+            "status": "success" if updated else "error",
+            "updated": updated,
+            "failed": len(results) - updated,
+            "results": results,
+            "delegations": [
+                {"id": delegation_id, "status": status}
+                for delegation_id, status in sorted(delegation_statuses.items())
+            ]
+        }), 200 if updated else 400
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
 @bp.route('/delegations/<int:delegation_id>/items/<int:item_id>/approve', methods=['POST'])
 @jwt_required()
 @require_role('manager')
@@ -664,76 +683,7 @@ def reject_expense_item(delegation_id, item_id):
 @require_role('manager')
 def approve_all_pending_items(delegation_id):
     """Zatwierdzenie wszystkich wydatków w statusie PENDING"""
-    try:
-        manager_id = int(get_jwt_identity())
-        
-        # Sprawdź delegację i uprawnienia
-        delegation = Delegation.query.get(delegation_id)
-        if not delegation:
-            return jsonify({
-                "status": "error",
-                "message": "Delegation not found"
-            }), 404
-        
-        employee = Employee.query.get(delegation.employee_id)
-        if not employee or employee.manager_id != manager_id:
-            return jsonify({
-                "status": "error",
-                "message": "You can only approve items of your subordinates' delegations"
-            }), 403
-        
-        # Znajdź wszystkie wydatki PENDING
-        pending_expenses = Expense.query.filter_by(
-            delegation_id=delegation_id
-        ).filter(db.func.upper(Expense.status) == 'PENDING').all()
-        
-        count = 0
-        for expense in pending_expenses:
-            expense.status = 'APPROVED'
-            count += 1
-        
-        # Przelicz status delegacji na podstawie wszystkich wydatków
-        all_expenses = Expense.query.filter_by(delegation_id=delegation_id).all()
-        delegation.status = compute_delegation_status(all_expenses)
-        
-        # Oblicz summary
-        total_amount = Decimal('0')
-        pending_amount = Decimal('0')
-        approved_amount = Decimal('0')
-        rejected_amount = Decimal('0')
-        
-        for exp in all_expenses:
-            amount = exp.pln_amount or exp.amount or Decimal('0')
-            status = normalize_status(exp.status)
-            total_amount += amount
-            if status == 'PENDING':
-                pending_amount += amount
-            elif status == 'APPROVED':
-                approved_amount += amount
-            elif status == 'REJECTED':
-                rejected_amount += amount
-        
-        db.session.commit()
-        
-        return jsonify({
-            "status": "success",
-            "message": f"Approved {count} pending items",
-            "count": count,
-            "delegation_status": delegation.status,
-            "summary": {
-                "total": float(total_amount),
-                "pending": float(pending_amount),
-                "approved": float(approved_amount),
-                "rejected": float(rejected_amount)
-            }
-        }), 200
-    
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({
-            "status": "error",
-            "message": str(e)
-        }), 500
+    return _decide_all_pending_items(delegation_id, 'APPROVED')
 
 
 @bp.route('/delegations/<int:delegation_id>/items/reject_all', methods=['POST'])
@@ -741,68 +691,41 @@ def approve_all_pending_items(delegation_id):
 @require_role('manager')
 def reject_all_pending_items(delegation_id):
     """Odrzucenie wszystkich wydatków w statusie PENDING"""
+    return _decide_all_pending_items(delegation_id, 'REJECTED')
+
+
+def _decide_all_pending_items(delegation_id, status):
+    """
+    Helper: approve_all / reject_all - jeden UPDATE ... RETURNING na wydatkach
+    PENDING, status i summary z rollupu delegacji w tej samej transakcji
+    """
+    verb, past = ('approve', 'Approved') if status == 'APPROVED' else ('reject', 'Rejected')
     try:
         manager_id = int(get_jwt_identity())
         
-        # Sprawdź delegację i uprawnienia
-        delegation = Delegation.query.get(delegation_id)
-        if not delegation:
+        # Sprawdź delegację i uprawnienia (jedno zapytanie)
+        stamp = load_delegation_stamp(delegation_id)
+        if not stamp:
             return jsonify({
                 "status": "error",
                 "message": "Delegation not found"
             }), 404
         
-        employee = Employee.query.get(delegation.employee_id)
-        if not employee or employee.manager_id != manager_id:
+        if stamp.manager_id != manager_id:
             return jsonify({
                 "status": "error",
-                "message": "You can only reject items of your subordinates' delegations"
+                "message": f"You can only {verb} items of your subordinates' delegations"
             }), 403
         
-        # Znajdź wszystkie wydatki PENDING
-        pending_expenses = Expense.query.filter_by(
-            delegation_id=delegation_id
-        ).filter(db.func.upper(Expense.status) == 'PENDING').all()
-        
-        count = 0
-        for expense in pending_expenses:
-            expense.status = 'REJECTED'
-            count += 1
-        
-        # Przelicz status delegacji na podstawie wszystkich wydatków
-        all_expenses = Expense.query.filter_by(delegation_id=delegation_id).all()
-        delegation.status = compute_delegation_status(all_expenses)
-        
-        # Oblicz summary
-        total_amount = Decimal('0')
-        pending_amount = Decimal('0')
-        approved_amount = Decimal('0')
-        rejected_amount = Decimal('0')
-        
-        for exp in all_expenses:
-            amount = exp.pln_amount or exp.amount or Decimal('0')
-            status = normalize_status(exp.status)
-            total_amount += amount
-            if status == 'PENDING':
-                pending_amount += amount
-            elif status == 'APPROVED':
-                approved_amount += amount
-            elif status == 'REJECTED':
-                rejected_amount += amount
-        
+        count, summary = decide_pending_expenses(delegation_id, status)
         db.session.commit()
         
         return jsonify({
             "status": "success",
-            "message": f"Rejected {count} pending items",
+            "message": f"{past} {count} pending items",
             "count": count,
-            "delegation_status": delegation.status,
-            "summary": {
-                "total": float(total_amount),
-                "pending": float(pending_amount),
-                "approved": float(approved_amount),
-                "rejected": float(rejected_amount)
-            }
+            "delegation_status": summary.status,
+            "summary": serialize_rollup_summary(summary)
         }), 200
     
     except Exception as e:
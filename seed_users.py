@@ -2,8 +2,9 @@
 DEV-ONLY: Seed script to create test users
 Only runs when DEV_SEED=true environment variable is set
 """
-from models import db, Employee, ExpenseCategory, Currency, ExchangeRate
+from models import db, Employee, ExpenseCategory, Currency, ExchangeRate, normalize_identifier
 from flask import current_app
+from services.passwords import hash_password
 from datetime import date
 
 
@@ -137,25 +138,20 @@ def seed_users():
         }
     ]
     
-    bcrypt = current_app.extensions.get('bcrypt')
-    if not bcrypt:
-        print("[SEED] ERROR: Bcrypt not initialized")
-        return
-    
     # Najpierw utwórz wszystkich użytkowników
     created_users = {}
     
     for user_data in test_users:
         # Check if user already exists
-        existing_user = Employee.query.filter_by(email=user_data['email']).first()
+        existing_user = Employee.query.filter(Employee.email_key == normalize_identifier(user_data['email'])).first()
         
         if existing_user:
             print(f"[SEED] User '{user_data['username']}' ({user_data['email']}) already exists, skipping")
             created_users[user_data['role']] = existing_user
             continue
         
-        # Hash password using the same logic as /api/auth/register
-        hashed_password = bcrypt.generate_password_hash(user_data['password']).decode('utf-8')
+        # Hash password using the same logic as /api/auth/register (process pool)
+        hashed_password = hash_password(user_data['password'])
         
         # Create new user
         new_user = Employee(
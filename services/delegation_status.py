@@ -0,0 +1,104 @@
+"""
+Derived delegation status (PENDING / APPROVED / REJECTED) computed from the
+statuses of its expenses - shared by the manager and admin blueprints.
+
+List views read per-status expense counts from delegation_rollup (kept up
+to date by services.rollups) with one query and apply the rules to the
+counts in Python. Expense statuses are normalized the same way in SQL and
+in Python, including the legacy Polish/English aliases.
+"""
+from collections import namedtuple
+
+from sqlalchemy import case, func, or_
+
+from models import db, Delegation, DelegationRollup, Employee, Expense
+
+APPROVED_ALIASES = ('APPROVED', 'ACCEPTED', 'ZAAKCEPTOWANY')
+REJECTED_ALIASES = ('REJECTED', 'ODRZUCONY', 'DENIED')
+
+StatusCounts = namedtuple('StatusCounts', 'total pending approved rejected')
+DelegationStatus = namedtuple('DelegationStatus', 'delegation employee status counts')
+
+
+def normalize_status(value):
+    """Normalizuje status wydatku do PENDING | APPROVED | REJECTED (stare wartości też)"""
+    if not value:
+        return 'PENDING'
+    status = str(value).upper().strip()
+    if status in APPROVED_ALIASES:
+        return 'APPROVED'
+    if status in REJECTED_ALIASES:
+        return 'REJECTED'
+    return 'PENDING'
+
+
+def normalized_status_expr(column=Expense.status):
+    """normalize_status jako wyrażenie SQL (CASE)"""
+    status = func.upper(func.trim(column))
+    return case(
+        (status.in_(APPROVED_ALIASES), 'APPROVED'),
+        (status.in_(REJECTED_ALIASES), 'REJECTED'),
+        else_='PENDING'
+    )
+
+
+def derive_status(counts):
+    """
+    Status delegacji z liczników wydatków:
+    - PENDING: jest przynajmniej jeden wydatek pending (albo brak wydatków)
+    - REJECTED: wszystkie wydatki są rejected
+    - APPROVED: brak pending i przynajmniej jeden approved
+    """
+    if counts.total == 0 or counts.pending > 0:
+        return 'PENDING'
+    if counts.rejected == counts.total:
+        return 'REJECTED'
+    if counts.approved > 0:
+        return 'APPROVED'
+    return 'PENDING'
+
+
+def count_statuses(expenses):
+    statuses = [normalize_status(e.status) for e in expenses]
+    return StatusCounts(
+        total=len(statuses),
+        pending=statuses.count('PENDING'),
+        approved=statuses.count('APPROVED'),
+        rejected=statuses.count('REJECTED')
+    )
+
+
+def compute_delegation_status(expenses):
+    """Status delegacji z już załadowanych wydatków (widoki szczegółów)"""
+    return derive_status(count_statuses(expenses))
+
+
+def load_delegation_statuses(*criteria, order_by=(Delegation.id,)):
+    """
+    Delegacje spełniające criteria z pracownikiem i statusem wyliczonym z liczników
+    w delegation_rollup - jedno zapytanie bez czytania wydatków. Zwraca listę DelegationStatus
+    """
+    rows = db.session.query(
+        Delegation, Employee, DelegationRollup.total_count, DelegationRollup.pending_count,
+        DelegationRollup.approved_count, DelegationRollup.rejected_count
+    ).join(Employee, Employee.id == Delegation.employee_id) \
+        .outerjoin(DelegationRollup, DelegationRollup.delegation_id == Delegation.id) \
+        .filter(*criteria) \
+        .order_by(*order_by) \
+        .all()
+    result = []
+    for delegation, employee, *row_counts in rows:
+        # Brak wiersza rollupu (delegacja sprzed migracji) liczymy jak brak wydatków
+        counts = StatusCounts(*(count or 0 for count in row_counts))
+        result.append(DelegationStatus(delegation, employee, derive_status(counts), counts))
+    return result
+
+
+def derived_status_expr(total, pending, approved, rejected):
+    """derive_status jako wyrażenie SQL nad licznikami (np. kolumnami delegation_rollup)"""
+    return case(
+        (or_(total == 0, pending > 0), 'PENDING'),
+        (rejected == total, 'REJECTED'),
+        (approved > 0, 'APPROVED'),
+        else_='PENDING'
+    )
@@ -0,0 +1,88 @@
+"""
+Shared loading and access rules for delegation detail views.
+
+The delegation is fetched together with its employee (joined) and its
+expenses and documents (select-in), so a detail page needs a fixed number of
+queries regardless of how many items the delegation has. Access checks run on
+the loaded objects (or on a version stamp) without further lazy loads.
+"""
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import Delegation
+from services.previews import get_previews
+from services.signed_urls import get_signed_urls, signed_file_url
+from services.storage import document_mimetype
+from services.versioning import DelegationStamp
+
+
+def load_delegation_detail(delegation_id, with_documents=True, with_expenses=True):
+    """Delegacja z pracownikiem, rollupem, wydatkami i (opcjonalnie) dokumentami albo None"""
+    options = [joinedload(Delegation.employee), joinedload(Delegation.rollup)]
+    if with_expenses:
+        options.append(selectinload(Delegation.expenses))
+    if with_documents:
+        options.append(selectinload(Delegation.documents))
+    return Delegation.query.options(*options).filter(Delegation.id == delegation_id).first()
+
+
+def _employee_manager_id(delegation):
+    if isinstance(delegation, DelegationStamp):
+        return delegation.manager_id
+    return delegation.employee.manager_id if delegation.employee is not None else None
+
+
+def is_subordinate_delegation(principal, delegation):
+    """Delegacja (obiekt lub DelegationStamp) należy do podwładnego menedżera principal"""
+    manager_id = _employee_manager_id(delegation)
+    return manager_id is not None and manager_id == principal.id
+
+
+def can_view_delegation(principal, delegation):
+    """
+    Pracownik widzi swoje delegacje, menedżer także delegacje podwładnych,
+    admin wszystkie
+    """
+    if principal is None:
+        return False
+    if delegation.employee_id == principal.id or principal.role == 'admin':
+        return True
+    return principal.role == 'manager' and is_subordinate_delegation(principal, delegation)
+
+
+def delegation_detail_version(stamp):
+    """
+    Składniki ETagu szczegółów delegacji: wersje delegacji i pracownika oraz
+    koniec ważności podpisanych URL-i dokumentów (zmienia się co SIGNED_URL_BUCKET)
+    """
+    return stamp.id, stamp.version, stamp.employee_version, get_signed_urls().expiry()
+
+
+def document_urls(document):
+    """
+    Podpisane, krótko ważne adresy pliku i podglądu dokumentu (None dla
+    dokumentów bez pliku w magazynie). Wywołujący sprawdził już dostęp do delegacji
+    """
+    if not document.content_hash:
+        return None, None
+    mimetype = document_mimetype(document)
+    download_url = signed_file_url('document', document.content_hash, document.filename, mimetype)
+    preview_url = None
+    if get_previews().available(document.content_hash, mimetype):
+        preview_url = signed_file_url('preview', document.content_hash, None, mimetype)
+    return download_url, preview_url
+
+
+def serialize_document(document):
+    """Dokument na liście w szczegółach delegacji"""
+    download_url, preview_url = document_urls(document)
+    return {
+        'id': document.id,
+        'expense_id': document.expense_id,
+        'filename': document.filename,
+        'file_type': document.file_type,
+        'description': document.description,
+        'uploaded_at': document.uploaded_at.isoformat() if document.uploaded_at else None,
+        'size_bytes': document.size_bytes,
+        'download_url': download_url,
+        'preview_url': preview_url
+    }
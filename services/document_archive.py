@@ -0,0 +1,94 @@
+"""
+ZIP archive of delegation documents streamed while it is being built.
+
+zipfile writes into a non-seekable in-memory sink (entries get data
+descriptors instead of patched headers) that is drained after every chunk,
+so a response never holds more than one read chunk plus the central
+directory in memory and nothing is written to temporary files.
+"""
+import io
+import os
+import re
+import zipfile
+
+from services.storage import CHUNK_SIZE
+
+# Formaty już skompresowane - pakowane bez kompresji, żeby nie palić CPU
+STORED_MIMETYPES = ('image/', 'application/pdf', 'application/zip', 'video/', 'audio/')
+
+_UNSAFE_CHARS = re.compile(r'[\x00-\x1f\x7f/\\:*?"<>|]+')
+
+
+class _DrainingSink(io.RawIOBase):
+    """Niewspierający seek bufor, z którego generator odbiera zapisane bajty"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _safe_filename(filename, fallback):
+    name = _UNSAFE_CHARS.sub('_', (filename or '').strip()).strip('. ')
+    return name or fallback
+
+
+def archive_entry_names(documents):
+    """
+    Nazwy plików w archiwum: expense-<id>/<filename> dla dokumentów wydatków,
+    <filename> dla dokumentów delegacji; powtórzenia dostają sufiks ' (2)', ' (3)'...
+    """
+    used = set()
+    names = []
+    for document in documents:
+        filename = _safe_filename(document.filename, f'document-{document.id}')
+        directory = f'expense-{document.expense_id}/' if document.expense_id else ''
+        base, ext = os.path.splitext(filename)
+        name = directory + filename
+        counter = 2
+        while name.lower() in used:
+            name = f'{directory}{base} ({counter}){ext}'
+            counter += 1
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+def stream_documents_zip(store, documents, mimetype_for):
+    """
+    Generator bajtów archiwum ZIP z plikami dokumentów (w kolejności documents).
+    Dokumenty bez pliku w magazynie są pomijane.
+    """
+    documents = [d for d in documents if d.content_hash and store.exists(d.content_hash)]
+    sink = _DrainingSink()
+    with zipfile.ZipFile(sink, mode='w', allowZip64=True) as archive:
+        for document, name in zip(documents, archive_entry_names(documents)):
+            info = zipfile.ZipInfo(name, date_time=(document.uploaded_at.timetuple()[:6]
+                                                    if document.uploaded_at else (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = zipfile.ZIP_STORED \
+                if mimetype_for(document).startswith(STORED_MIMETYPES) else zipfile.ZIP_DEFLATED
+            path = store.path_for(document.content_hash)
+            # Znany rozmiar pozwala zipfile samemu zdecydować o rozszerzeniach ZIP64
+            info.file_size = os.path.getsize(path)
+            with open(path, 'rb') as source, archive.open(info, mode='w') as entry:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Katalog centralny zapisywany przy zamknięciu archiwum
+    yield sink.drain()
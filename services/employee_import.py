@@ -0,0 +1,256 @@
+"""
+Bulk employee import (CSV or NDJSON) used by POST /api/admin/employees/bulk.
+
+The whole file is handled set-based: one query finds existing usernames and
+emails, one query resolves managers, passwords are hashed in parallel in the
+password pool and all rows are inserted with a single executemany INSERT.
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import bindparam, insert, or_, update
+
+from models import db, Employee, normalize_identifier
+from services.passwords import hash_passwords
+
+ALLOWED_ROLES = ['employee', 'manager', 'accountant', 'admin']
+
+CSV_CONTENT_TYPES = ('text/csv', 'application/csv')
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+class ImportFormatError(ValueError):
+    """Plik importu ma nieobsługiwany format lub nie da się go sparsować"""
+
+
+def parse_rows(content_type, body):
+    """Parsuje treść żądania (CSV z nagłówkiem albo NDJSON) do listy słowników"""
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+    text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+
+    if mimetype in CSV_CONTENT_TYPES:
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames:
+            raise ImportFormatError("CSV header row is required")
+        return [{(k or '').strip(): v for k, v in row.items()} for row in reader]
+
+    if mimetype in NDJSON_CONTENT_TYPES:
+        rows = []
+        for line_no, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise ImportFormatError(f"Invalid JSON in line {line_no}: {e}")
+            if not isinstance(row, dict):
+                raise ImportFormatError(f"Line {line_no} must be a JSON object")
+            rows.append(row)
+        return rows
+
+    raise ImportFormatError("Unsupported Content-Type. Use text/csv or application/x-ndjson")
+
+
+def _text(value):
+    return str(value).strip() if value is not None else ''
+
+
+def _parse_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 't')
+
+
+def import_employees(rows):
+    """
+    Importuje pracowników i zwraca raport per wiersz:
+    {"row": n, "status": "created" | "error", "employee_id": ..., "errors": [...]}
+    Wiersze z błędami są pomijane, poprawne wstawiane w jednej transakcji.
+    """
+    results = [{"row": i, "status": "error", "errors": []} for i in range(1, len(rows) + 1)]
+    candidates = []
+    seen_usernames = {}
+    seen_emails = {}
+
+    # 1. Walidacja wierszy i duplikaty w obrębie pliku
+    for index, raw in enumerate(rows):
+        errors = results[index]["errors"]
+        username = _text(raw.get('username'))
+        email = _text(raw.get('email')).lower()
+        password = raw.get('password')
+        role = _text(raw.get('role')) or 'employee'
+
+        if not username or not email or not password:
+            errors.append("Username, email and password are required")
+        if role not in ALLOWED_ROLES:
+            errors.append("Invalid role. Allowed roles: employee, manager, accountant, admin")
+
+        manager_id = raw.get('manager_id')
+        if manager_id not in (None, ''):
+            try:
+                manager_id = int(manager_id)
+            except (TypeError, ValueError):
+                errors.append("manager_id must be an integer")
+                manager_id = None
+        else:
+            manager_id = None
+
+        username_key = username.lower()
+        if username_key and username_key in seen_usernames:
+            errors.append(f"Duplicate username in file (row {seen_usernames[username_key]})")
+        if email and email in seen_emails:
+            errors.append(f"Duplicate email in file (row {seen_emails[email]})")
+        if username_key:
+            seen_usernames.setdefault(username_key, index + 1)
+        if email:
+            seen_emails.setdefault(email, index + 1)
+
+        if errors:
+            continue
+
+        candidates.append({
+            "index": index,
+            "username": username,
+            "email": email,
+            "password": str(password),
+            "first_name": _text(raw.get('first_name')) or username,
+            "last_name": _text(raw.get('last_name')) or 'User',
+            "role": role,
+            "is_active": _parse_bool(raw.get('is_active')),
+            "manager_id": manager_id,
+            "manager_email": _text(raw.get('manager_email')).lower() or None
+        })
+
+    if not candidates:
+        return results, 0
+
+    # 2. Duplikaty w bazie - jedno zapytanie dla całego pliku
+    usernames = [c["username"].lower() for c in candidates]
+    emails = [c["email"] for c in candidates]
+    existing = db.session.query(Employee.username_key, Employee.email_key).filter(or_(
+        Employee.username_key.in_(usernames),
+        Employee.email_key.in_(emails)
+    )).all()
+    taken_usernames = {row[0] for row in existing}
+    taken_emails = {row[1] for row in existing}
+
+    # 3. Menedżerowie - jedno zapytanie po id i emailach; menedżer może też być w tym samym pliku
+    manager_ids = {c["manager_id"] for c in candidates if c["manager_id"]}
+    manager_emails = {c["manager_email"] for c in candidates if c["manager_email"]}
+    managers_by_id = {}
+    managers_by_email = {}
+    if manager_ids or manager_emails:
+        conditions = []
+        if manager_ids:
+            conditions.append(Employee.id.in_(manager_ids))
+        if manager_emails:
+            conditions.append(Employee.email_key.in_(manager_emails))
+        for manager in db.session.query(Employee.id, Employee.email, Employee.role).filter(or_(*conditions)):
+            managers_by_id[manager.id] = manager
+            managers_by_email[normalize_identifier(manager.email)] = manager
+    file_managers = {c["email"] for c in candidates if c["role"] == 'manager'}
+
+    valid = []
+    for c in candidates:
+        errors = results[c["index"]]["errors"]
+        if c["username"].lower() in taken_usernames:
+            errors.append("Username already exists")
+        if c["email"] in taken_emails:
+            errors.append("Email already exists")
+        if c["manager_id"]:
+            manager = managers_by_id.get(c["manager_id"])
+            if not manager:
+                errors.append("Manager not found")
+            elif manager.role != 'manager':
+                errors.append("Assigned manager must have 'manager' role")
+        elif c["manager_email"]:
+            manager = managers_by_email.get(c["manager_email"])
+            if manager:
+                if manager.role != 'manager':
+                    errors.append("Assigned manager must have 'manager' role")
+                else:
+                    c["manager_id"] = manager.id
+            elif c["manager_email"] not in file_managers:
+                errors.append("Manager not found")
+        if not errors:
+            valid.append(c)
+
+    # Menedżer z pliku, który sam okazał się błędny, nie może zostać przypisany - także
+    # pośrednio (A zarządza B, B zarządza C; błąd A odrzuca B i C). Każdy wiersz odwiedzany raz
+    valid_by_email = {c["email"]: c for c in valid}
+    importable = {}
+    for c in valid:
+        path = []
+        email = c["email"]
+        while True:
+            if email in importable:
+                resolved = importable[email]
+                break
+            row = valid_by_email.get(email)
+            if row is None:
+                resolved = False
+                break
+            if email in path:
+                # Cykl w pliku - wszyscy są wstawiani, menedżerowie przypisywani po INSERT
+                resolved = True
+                break
+            path.append(email)
+            if row["manager_id"] or not row["manager_email"]:
+                resolved = True
+                break
+            email = row["manager_email"]
+        for email in path:
+            importable[email] = resolved
+    for c in valid:
+        if not importable[c["email"]]:
+            results[c["index"]]["errors"].append("Manager row in file was not imported")
+    valid = [c for c in valid if not results[c["index"]]["errors"]]
+
+    if not valid:
+        return results, 0
+
+    # 4. Hashowanie równolegle w puli procesów
+    hashes = hash_passwords([c["password"] for c in valid])
+
+    # 5. Jeden INSERT (executemany) dla wszystkich wierszy
+    params = [{
+        "username": c["username"],
+        "email": c["email"],
+        "password": pw_hash,
+        "first_name": c["first_name"],
+        "last_name": c["last_name"],
+        "role": c["role"],
+        "is_active": c["is_active"],
+        "manager_id": c["manager_id"]
+    } for c, pw_hash in zip(valid, hashes)]
+    inserted = db.session.execute(
+        insert(Employee).returning(Employee.id, Employee.email, sort_by_parameter_order=True),
+        params
+    ).all()
+    ids_by_email = {row.email: row.id for row in inserted}
+
+    # 6. Przypisanie menedżerów zaimportowanych w tym samym pliku (executemany UPDATE)
+    pending_managers = [
+        {"b_employee_id": ids_by_email[c["email"]], "b_manager_id": ids_by_email[c["manager_email"]]}
+        for c in valid if not c["manager_id"] and c["manager_email"] in ids_by_email
+    ]
+    if pending_managers:
+        db.session.execute(
+            update(Employee.__table__)
+            .where(Employee.__table__.c.id == bindparam('b_employee_id'))
+            .values(manager_id=bindparam('b_manager_id')),
+            pending_managers
+        )
+
+    for c in valid:
+        results[c["index"]] = {
+            "row": c["index"] + 1,
+            "status": "created",
+            "employee_id": ids_by_email[c["email"]],
+            "username": c["username"],
+            "email": c["email"]
+        }
+    return results, len(valid)
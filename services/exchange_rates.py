@@ -0,0 +1,158 @@
+"""
+In-process cache of exchange-rate histories with "as-of" lookups.
+
+Rates change at most daily, so the history of every used currency is kept in
+memory as two parallel arrays sorted by date_set. The rate effective on a
+payment date is found by binary search. Histories of all currencies missing
+from the cache are loaded with one query; after EXCHANGE_RATE_CACHE_TTL
+seconds only rows newer than the last seen id are fetched, and the whole
+history is reloaded once a day. Inserting, updating or deleting an
+ExchangeRate drops the cached currency after the transaction commits.
+"""
+import bisect
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import and_, event, or_
+from sqlalchemy.orm import object_session
+
+from models import db, ExchangeRate
+
+FULL_RELOAD_INTERVAL = 24 * 3600
+
+
+class _RateHistory:
+    """Historia kursów jednej waluty posortowana po date_set"""
+
+    __slots__ = ('dates', 'rates', 'last_id', 'loaded_at', 'refreshed_at')
+
+    def __init__(self, now):
+        self.dates = []
+        self.rates = []
+        self.last_id = 0
+        self.loaded_at = now
+        self.refreshed_at = now
+
+    def add(self, row_id, date_set, rate):
+        index = bisect.bisect_left(self.dates, date_set)
+        if index < len(self.dates) and self.dates[index] == date_set:
+            self.rates[index] = rate
+        else:
+            self.dates.insert(index, date_set)
+            self.rates.insert(index, rate)
+        self.last_id = max(self.last_id, row_id)
+
+    def rate_on(self, day):
+        """
+        Kurs obowiązujący w danym dniu (ostatni z date_set <= day).
+        Bez daty - najnowszy kurs; dzień sprzed pierwszego kursu - najstarszy znany kurs.
+        """
+        if not self.rates:
+            return None
+        if day is None:
+            return self.rates[-1]
+        index = bisect.bisect_right(self.dates, day) - 1
+        return self.rates[max(index, 0)]
+
+
+class RateResolver:
+    """Historie kursów załadowane dla jednego żądania - wyszukiwanie bez zapytań do bazy"""
+
+    def __init__(self, histories):
+        self._histories = histories
+
+    def rate_on(self, currency_id, day=None):
+        history = self._histories.get(currency_id)
+        return history.rate_on(day) if history is not None else None
+
+
+class ExchangeRateService:
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._histories = {}
+        self._lock = threading.Lock()
+
+    def resolver(self, currency_ids):
+        """
+        Zwraca RateResolver dla podanych walut. Brakujące waluty i przyrosty
+        wygasłych historii są pobierane jednym zapytaniem.
+        """
+        now = time.monotonic()
+        currency_ids = set(currency_ids)
+        with self._lock:
+            histories = {cid: self._histories.get(cid) for cid in currency_ids}
+
+        missing = [cid for cid, h in histories.items()
+                   if h is None or now - h.loaded_at >= FULL_RELOAD_INTERVAL]
+        stale = {cid: h for cid, h in histories.items()
+                 if cid not in missing and now - h.refreshed_at >= self.ttl}
+
+        if missing or stale:
+            conditions = []
+            if missing:
+                conditions.append(ExchangeRate.currency_id.in_(missing))
+            for cid, history in stale.items():
+                conditions.append(and_(ExchangeRate.currency_id == cid, ExchangeRate.id > history.last_id))
+            rows = db.session.query(
+                ExchangeRate.id, ExchangeRate.currency_id, ExchangeRate.date_set, ExchangeRate.rate_to_pln
+            ).filter(or_(*conditions)).order_by(ExchangeRate.date_set).all()
+
+            with self._lock:
+                loaded = {cid: _RateHistory(now) for cid in missing}
+                for cid, history in stale.items():
+                    # Kopia, żeby równoległe żądania nie widziały częściowo zaktualizowanej historii
+                    refreshed = _RateHistory(history.loaded_at)
+                    refreshed.dates = list(history.dates)
+                    refreshed.rates = list(history.rates)
+                    refreshed.last_id = history.last_id
+                    refreshed.refreshed_at = now
+                    loaded[cid] = refreshed
+                for row in rows:
+                    loaded[row.currency_id].add(row.id, row.date_set, row.rate_to_pln)
+                self._histories.update(loaded)
+            histories.update(loaded)
+
+        return RateResolver(histories)
+
+    def invalidate(self, currency_ids=None):
+        with self._lock:
+            if currency_ids is None:
+                self._histories.clear()
+            else:
+                for currency_id in currency_ids:
+                    self._histories.pop(currency_id, None)
+
+
+def _remember_changed_rate(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_rate_currencies', set()).add(target.currency_id)
+
+
+def _invalidate_after_commit(session):
+    changed = session.info.pop('changed_rate_currencies', None)
+    if changed:
+        service = current_app.extensions.get('exchange_rates')
+        if service is not None:
+            service.invalidate(changed)
+
+
+def _forget_after_rollback(session, previous_transaction):
+    session.info.pop('changed_rate_currencies', None)
+
+
+def init_exchange_rates(app):
+    """Tworzy cache kursów i podpina unieważnianie po zmianach w exchange_rate"""
+    service = ExchangeRateService(ttl=int(app.config.get('EXCHANGE_RATE_CACHE_TTL', 3600)))
+    app.extensions['exchange_rates'] = service
+    if not event.contains(ExchangeRate, 'after_insert', _remember_changed_rate):
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(ExchangeRate, name, _remember_changed_rate)
+        event.listen(db.session, 'after_commit', _invalidate_after_commit)
+        event.listen(db.session, 'after_soft_rollback', _forget_after_rollback)
+    return service
+
+
+def get_exchange_rates():
+    return current_app.extensions['exchange_rates']
@@ -0,0 +1,158 @@
+"""
+Set-based approval and rejection of expenses by a manager.
+
+A batch of (expense_id, decision) pairs spanning many delegations is
+authorized by one query that joins expense -> delegation -> employee and
+locks the matching expense rows (FOR UPDATE, in id order). The changes are
+written with one UPDATE per target status. delegation_rollup gets the
+resulting deltas, and each affected delegation's status is re-derived once
+from its rollup row and written with one UPDATE per resulting status. The
+delegation UPDATE also bumps its version and change_seq (ETag, delta sync).
+
+approve_all / reject_all of one delegation is a single
+UPDATE ... WHERE status = 'PENDING' RETURNING; the returned rows feed the
+rollup delta and the summary is read back from the rollup row.
+"""
+from sqlalchemy import func, select, update
+
+from models import db, Delegation, DelegationRollup, Employee, Expense
+from services.delegation_status import StatusCounts, derive_status, normalize_status
+from services.rollups import RollupDeltas, apply_rollup_deltas, summarize_rollup
+
+DECISIONS = {
+    'approve': 'APPROVED',
+    'approved': 'APPROVED',
+    'reject': 'REJECTED',
+    'rejected': 'REJECTED',
+}
+NOT_FOUND_MESSAGE = "Item not found in your subordinates' delegations"
+
+
+def parse_decisions(items):
+    """
+    Waliduje listę {"expense_id": int, "decision": "approve" | "reject"}.
+    Zwraca (słownik expense_id -> (index, status docelowy), lista błędów per pozycja)
+    """
+    decisions = {}
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "expense_id": None, "status": "error",
+                           "message": "Each decision must be an object"})
+            continue
+        expense_id = item.get('expense_id')
+        decision = item.get('decision')
+        if isinstance(expense_id, bool) or not isinstance(expense_id, int):
+            message = "expense_id must be an integer"
+        elif not isinstance(decision, str) or decision.strip().lower() not in DECISIONS:
+            message = "decision must be 'approve' or 'reject'"
+        elif expense_id in decisions:
+            message = f"Duplicate expense_id (index {decisions[expense_id][0]})"
+        else:
+            decisions[expense_id] = (index, DECISIONS[decision.strip().lower()])
+            continue
+        errors.append({"index": index, "expense_id": expense_id, "status": "error", "message": message})
+    return decisions, errors
+
+
+def lock_subordinate_expenses(manager_id, expense_ids):
+    """
+    Wydatki z expense_ids należące do delegacji podwładnych menedżera - jedno
+    zapytanie, wiersze wydatków zablokowane do końca transakcji (w kolejności id)
+    """
+    if not expense_ids:
+        return []
+    return db.session.execute(
+        select(Expense.id, Expense.delegation_id, Expense.status, Expense.pln_amount, Expense.amount)
+        .join(Delegation, Delegation.id == Expense.delegation_id)
+        .join(Employee, Employee.id == Delegation.employee_id)
+        .where(Expense.id.in_(sorted(expense_ids)), Employee.manager_id == manager_id)
+        .order_by(Expense.id)
+        .with_for_update(of=Expense.__table__)
+    ).all()
+
+
+def refresh_delegation_statuses(delegation_ids):
+    """
+    Wylicza status delegacji z ich wierszy rollupu i zapisuje go jednym UPDATE
+    na wynikowy status. Zwraca słownik delegation_id -> status
+    """
+    delegation_ids = sorted(set(delegation_ids))
+    if not delegation_ids:
+        return {}
+    rows = db.session.execute(
+        select(Delegation.id, DelegationRollup.total_count, DelegationRollup.pending_count,
+               DelegationRollup.approved_count, DelegationRollup.rejected_count)
+        .outerjoin(DelegationRollup, DelegationRollup.delegation_id == Delegation.id)
+        .where(Delegation.id.in_(delegation_ids))
+    ).all()
+    statuses = {row[0]: derive_status(StatusCounts(*(count or 0 for count in row[1:]))) for row in rows}
+
+    by_status = {}
+    for delegation_id, status in statuses.items():
+        by_status.setdefault(status, []).append(delegation_id)
+    table = Delegation.__table__
+    for status, ids in sorted(by_status.items()):
+        db.session.execute(update(table).where(table.c.id.in_(sorted(ids))).values(status=status))
+    return statuses
+
+
+def apply_expense_decisions(manager_id, decisions):
+    """
+    Zapisuje decyzje (expense_id -> (index, status)) dla wydatków podwładnych
+    menedżera, bez commitu. Zwraca (wyniki per pozycja, słownik delegation_id -> status)
+    """
+    rows = lock_subordinate_expenses(manager_id, decisions.keys())
+    found = {row.id: row for row in rows}
+
+    results = []
+    targets = {}
+    deltas = RollupDeltas()
+    for expense_id, (index, status) in decisions.items():
+        row = found.get(expense_id)
+        if row is None:
+            results.append({"index": index, "expense_id": expense_id, "status": "error",
+                            "message": NOT_FOUND_MESSAGE})
+            continue
+        results.append({"index": index, "expense_id": expense_id, "status": status,
+                        "delegation_id": row.delegation_id})
+        if row.status != status:
+            targets.setdefault(status, []).append(expense_id)
+            if normalize_status(row.status) != status:
+                deltas.add_expense(row, -1)
+                deltas.add(row.delegation_id, status, row.pln_amount, row.amount)
+
+    table = Expense.__table__
+    for status, ids in sorted(targets.items()):
+        db.session.execute(update(table).where(table.c.id.in_(sorted(ids))).values(status=status))
+    apply_rollup_deltas(deltas)
+
+    changed_ids = {expense_id for ids in targets.values() for expense_id in ids}
+    statuses = refresh_delegation_statuses(found[expense_id].delegation_id for expense_id in changed_ids)
+    return results, statuses
+
+
+def decide_pending_expenses(delegation_id, status):
+    """
+    Zmienia wszystkie wydatki PENDING delegacji na status jednym
+    UPDATE ... RETURNING (bez commitu). Równoległe wywołania blokują te same
+    wiersze, a WHERE jest sprawdzane ponownie po zwolnieniu blokady - każdy
+    wydatek zmienia tylko jedna transakcja i tylko ona liczy go w delcie rollupu.
+    Zwraca (liczba zmienionych wydatków, RollupSummary delegacji)
+    """
+    table = Expense.__table__
+    changed = db.session.execute(
+        update(table)
+        .where(table.c.delegation_id == delegation_id, func.upper(table.c.status) == 'PENDING')
+        .values(status=status)
+        .returning(table.c.pln_amount, table.c.amount)
+    ).all()
+    if changed:
+        deltas = RollupDeltas()
+        for row in changed:
+            deltas.add(delegation_id, 'PENDING', row.pln_amount, row.amount, -1)
+            deltas.add(delegation_id, status, row.pln_amount, row.amount)
+        apply_rollup_deltas(deltas)
+        refresh_delegation_statuses([delegation_id])
+    # Wiersz rollupu zablokowany przez deltę - suma odpowiada stanowi po tej zmianie
+    return len(changed), summarize_rollup(db.session.get(DelegationRollup, delegation_id))
@@ -0,0 +1,257 @@
+"""
+Set-based validation and insertion of expenses.
+
+The whole payload is validated first (all errors are collected, not only the
+first one), exchange rates come from the in-memory rate cache and the valid
+rows are written with a single executemany INSERT ... RETURNING.
+
+Streamed NDJSON uploads go through the same path in fixed-size batches, so
+memory use depends on the batch size and not on the number of lines.
+"""
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import insert
+
+from models import db, Expense, ExpenseCategory
+from services.exchange_rates import get_exchange_rates
+from services.rollups import RollupDeltas, apply_rollup_deltas
+from services.versioning import touch_delegations
+
+PLN_PRECISION = Decimal('0.01')
+
+EXPENSE_COLUMNS = (
+    Expense.id, Expense.explanation, Expense.payed_at, Expense.amount, Expense.pln_amount,
+    Expense.exchange_rate, Expense.currency_id, Expense.category_id, Expense.status
+)
+
+
+def parse_payed_at(value):
+    """'YYYY-MM-DD HH:MM:SS' albo 'YYYY-MM-DD' -> datetime; ValueError dla innego formatu"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return datetime.strptime(value, '%Y-%m-%d')
+
+
+def _parse_id(value):
+    if isinstance(value, bool):
+        raise ValueError
+    return int(value)
+
+
+def validate_expenses(items, first_index=0):
+    """
+    Waliduje listę wydatków i przelicza kwoty na PLN po kursie z dnia płatności.
+    Zwraca (rows, errors): rows to słowniki gotowe do insert_expenses (z kluczem
+    index), errors to lista {"index", "field", "message"} dla wszystkich błędów.
+    """
+    rows = []
+    errors = []
+    parsed = []
+
+    def error(index, field, message):
+        errors.append({"index": index, "field": field, "message": message})
+
+    # 1. Walidacja pól każdego wydatku
+    for offset, item in enumerate(items):
+        index = first_index + offset
+        if not isinstance(item, dict):
+            error(index, None, "Each expense must be a JSON object")
+            continue
+        ok = True
+
+        amount = None
+        if item.get('amount') in (None, ''):
+            error(index, 'amount', "Each expense must have an amount")
+            ok = False
+        else:
+            try:
+                amount = Decimal(str(item['amount']))
+                if not amount.is_finite():
+                    raise InvalidOperation
+            except (InvalidOperation, ValueError):
+                error(index, 'amount', "amount must be a number")
+                ok = False
+
+        currency_id = None
+        if not item.get('currency_id'):
+            error(index, 'currency_id', "Each expense must have a currency_id")
+            ok = False
+        else:
+            try:
+                currency_id = _parse_id(item['currency_id'])
+            except (TypeError, ValueError):
+                error(index, 'currency_id', "currency_id must be an integer")
+                ok = False
+
+        category_id = None
+        if not item.get('category_id'):
+            error(index, 'category_id', "Each expense must have a category_id")
+            ok = False
+        else:
+            try:
+                category_id = _parse_id(item['category_id'])
+            except (TypeError, ValueError):
+                error(index, 'category_id', "category_id must be an integer")
+                ok = False
+
+        payed_at = None
+        if item.get('payed_at'):
+            try:
+                payed_at = parse_payed_at(item['payed_at'])
+            except (TypeError, ValueError):
+                error(index, 'payed_at', "Invalid payed_at format. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+                ok = False
+
+        if ok:
+            parsed.append((index, item, amount, currency_id, category_id, payed_at))
+
+    if not parsed:
+        return rows, errors
+
+    # 2. Kursy i kategorie dla całej partii naraz
+    rates = get_exchange_rates().resolver(p[3] for p in parsed)
+    category_ids = {p[4] for p in parsed}
+    known_categories = {
+        row[0] for row in db.session.query(ExpenseCategory.id).filter(ExpenseCategory.id.in_(category_ids))
+    }
+
+    for index, item, amount, currency_id, category_id, payed_at in parsed:
+        ok = True
+        if category_id not in known_categories:
+            error(index, 'category_id', f"Expense category {category_id} not found")
+            ok = False
+        rate_to_pln = rates.rate_on(currency_id, payed_at.date() if payed_at else None)
+        if rate_to_pln is None:
+            error(index, 'currency_id', f"No exchange rate found for currency_id {currency_id}")
+            ok = False
+        if not ok:
+            continue
+        rows.append({
+            'index': index,
+            'explanation': item.get('explanation'),
+            'payed_at': payed_at,
+            'amount': amount,
+            'pln_amount': (amount * rate_to_pln).quantize(PLN_PRECISION),
+            'exchange_rate': rate_to_pln,
+            'currency_id': currency_id,
+            'category_id': category_id,
+            # Status ustala tylko menedżer - wartość od klienta jest ignorowana
+            'status': 'draft'
+        })
+
+    errors.sort(key=lambda e: e['index'])
+    return rows, errors
+
+
+def insert_expenses(delegation_id, rows):
+    """Wstawia zwalidowane wydatki jednym INSERT ... RETURNING (executemany), w kolejności rows"""
+    if not rows:
+        return []
+    params = [{**{k: v for k, v in row.items() if k != 'index'}, 'delegation_id': delegation_id} for row in rows]
+    inserted = db.session.execute(
+        insert(Expense).returning(*EXPENSE_COLUMNS, sort_by_parameter_order=True),
+        params
+    ).all()
+    # INSERT przez Core omija zdarzenia sesji - wersję delegacji i jej rollup aktualizujemy sami
+    touch_delegations([delegation_id])
+    deltas = RollupDeltas()
+    for row in inserted:
+        deltas.add(delegation_id, row.status, row.pln_amount, row.amount)
+    apply_rollup_deltas(deltas)
+    return inserted
+
+
+def serialize_expense(expense):
+    return {
+        'id': expense.id,
+        'explanation': expense.explanation,
+        'payed_at': expense.payed_at.isoformat() if expense.payed_at else None,
+        'amount': float(expense.amount),
+        'pln_amount': float(expense.pln_amount),
+        'exchange_rate': float(expense.exchange_rate),
+        'currency_id': expense.currency_id,
+        'category_id': expense.category_id,
+        'status': expense.status
+    }
+
+
+def iter_ndjson(stream, max_line_bytes=65536):
+    """
+    Czyta NDJSON linia po linii ze strumienia żądania.
+    Zwraca (numer linii, obiekt, błąd) dla każdej niepustej linii.
+    """
+    line_no = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            break
+        line_no += 1
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            # Pomijamy resztę zbyt długiej linii bez wczytywania jej do pamięci
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_bytes + 1)
+            yield line_no, None, f"Line exceeds {max_line_bytes} bytes"
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"Invalid JSON: {e}"
+            continue
+        yield line_no, item, None
+
+
+def _process_batch(delegation_id, batch):
+    items = [item for _, item, error in batch if error is None]
+    rows, errors = validate_expenses(items)
+    inserted = insert_expenses(delegation_id, rows)
+    db.session.commit()
+
+    errors_by_index = {}
+    for e in errors:
+        errors_by_index.setdefault(e['index'], []).append({"field": e['field'], "message": e['message']})
+    ids_by_index = {row['index']: expense.id for row, expense in zip(rows, inserted)}
+
+    index = 0
+    for line_no, _, parse_error in batch:
+        if parse_error is not None:
+            yield {"line": line_no, "status": "error", "errors": [{"field": None, "message": parse_error}]}
+            continue
+        if index in ids_by_index:
+            yield {"line": line_no, "status": "created", "expense_id": ids_by_index[index]}
+        else:
+            yield {"line": line_no, "status": "error", "errors": errors_by_index.get(index, [])}
+        index += 1
+
+
+def stream_expenses(delegation_id, lines, batch_size=200):
+    """
+    Waliduje i zapisuje wydatki z iteratora iter_ndjson partiami po batch_size
+    (commit po każdej partii). Zwraca wyniki per linia, na końcu podsumowanie.
+    """
+    created = failed = 0
+    batch = []
+
+    def flush():
+        nonlocal created, failed
+        for result in _process_batch(delegation_id, batch):
+            if result['status'] == 'created':
+                created += 1
+            else:
+                failed += 1
+            yield result
+        batch.clear()
+
+    for entry in lines:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+
+    yield {"summary": {"created": created, "failed": failed}}
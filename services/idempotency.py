@@ -0,0 +1,201 @@
+"""
+Idempotency-Key support for POST endpoints that create resources.
+
+The first request with a given key reserves it (SET NX in Redis, or the
+in-process store when Redis is not configured) and its response - status,
+body and a few headers - is saved under the key for IDEMPOTENCY_KEY_TTL
+seconds. Retries with the same key and the same body get the saved response
+back without running the view, so they never touch the delegation tables.
+Keys are scoped by employee, method and path; reusing a key with a different
+body is rejected with 422, a retry arriving while the first request is still
+running gets 409. Server errors (5xx) release the key so the client can retry.
+Streamed requests and responses (NDJSON) cannot be fingerprinted or
+snapshotted without buffering them, so they are passed through unrecorded.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+from services.employee_import import NDJSON_CONTENT_TYPES
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+KEY_RE = re.compile(r'^[\x21-\x7e]{1,255}$')
+# Nagłówki odtwarzane razem z zapisaną odpowiedzią
+REPLAYED_RESPONSE_HEADERS = ('Content-Type', 'Location')
+
+
+class LocalIdempotencyStore:
+    """Klucze w pamięci procesu (bez Redisa chronią tylko przed powtórkami do tego samego workera)"""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def reserve(self, key, record, ttl):
+        """Zapisuje record gdy klucza nie ma; zwraca None albo istniejący record"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get_live(key, now)
+            if entry is not None:
+                return entry[0]
+            self._entries[key] = (record, now + ttl)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+            return None
+
+    def save(self, key, record, ttl):
+        with self._lock:
+            self._entries[key] = (record, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisIdempotencyStore:
+    key_prefix = 'idempotency:'
+
+    def __init__(self, client):
+        self.client = client
+
+    def reserve(self, key, record, ttl):
+        redis_key = f'{self.key_prefix}{key}'
+        if self.client.set(redis_key, json.dumps(record), nx=True, ex=int(ttl)):
+            return None
+        raw = self.client.get(redis_key)
+        # None: klucz wygasł między SET a GET - klient ponowi żądanie po 409
+        return json.loads(raw) if raw is not None else {'state': 'pending'}
+
+    def save(self, key, record, ttl):
+        self.client.set(f'{self.key_prefix}{key}', json.dumps(record), ex=int(ttl))
+
+    def release(self, key):
+        self.client.delete(f'{self.key_prefix}{key}')
+
+
+class IdempotencyService:
+    def __init__(self, store, ttl=86400, lock_ttl=60, fallback_store=None):
+        self.store = store
+        self.fallback_store = fallback_store or store
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+
+    def _call(self, method, *args):
+        try:
+            return getattr(self.store, method)(*args)
+        except Exception as e:
+            # Redis niedostępny - lepiej chronić przed duplikatami lokalnie niż wcale
+            print(f"[IDEMPOTENCY] Warning: store failed, using local store: {e}")
+            return getattr(self.fallback_store, method)(*args)
+
+    def reserve(self, key, fingerprint):
+        return self._call('reserve', key, {'state': 'pending', 'fingerprint': fingerprint}, self.lock_ttl)
+
+    def save(self, key, fingerprint, response):
+        self._call('save', key, {
+            'state': 'done',
+            'fingerprint': fingerprint,
+            'status': response.status_code,
+            'body': response.get_data(as_text=True),
+            'headers': {name: response.headers[name] for name in REPLAYED_RESPONSE_HEADERS if name in response.headers}
+        }, self.ttl)
+
+    def release(self, key):
+        self._call('release', key)
+
+
+def _scoped_key(idempotency_key):
+    """Klucz w magazynie: pracownik + metoda + ścieżka + klucz klienta (zahashowane)"""
+    scope = '\n'.join((str(get_jwt_identity()), request.method, request.path, idempotency_key))
+    return hashlib.sha256(scope.encode('utf-8')).hexdigest()
+
+
+def _replay(record):
+    response = current_app.response_class(record['body'], status=record['status'])
+    for name, value in record.get('headers', {}).items():
+        response.headers[name] = value
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Dekorator widoku POST obsługujący nagłówek Idempotency-Key (bez nagłówka
+    i dla strumieni NDJSON widok działa jak dotąd). Musi stać pod @jwt_required()
+    """
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        # Strumień NDJSON trzeba by zbuforować w całości, żeby policzyć odcisk treści
+        if idempotency_key is None or request.mimetype in NDJSON_CONTENT_TYPES:
+            return view(*args, **kwargs)
+        if not KEY_RE.match(idempotency_key):
+            return jsonify({
+                "status": "error",
+                "message": "Idempotency-Key must be 1-255 visible ASCII characters"
+            }), 400
+
+        service = get_idempotency()
+        key = _scoped_key(idempotency_key)
+        fingerprint = hashlib.sha256(request.get_data(cache=True)).hexdigest()
+
+        existing = service.reserve(key, fingerprint)
+        if existing is not None:
+            if existing.get('fingerprint') not in (None, fingerprint):
+                return jsonify({
+                    "status": "error",
+                    "message": "Idempotency-Key was already used with a different request body"
+                }), 422
+            if existing.get('state') != 'done':
+                return jsonify({
+                    "status": "error",
+                    "message": "A request with this Idempotency-Key is still being processed"
+                }), 409, {'Retry-After': '1'}
+            return _replay(existing)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            service.release(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            service.release(key)
+        else:
+            service.save(key, fingerprint, response)
+        return response
+    return decorated_function
+
+
+def init_idempotency(app):
+    """Magazyn kluczy idempotencji (Redis jeśli dostępny, w przeciwnym razie pamięć procesu)"""
+    local_store = LocalIdempotencyStore(max_keys=int(app.config.get('IDEMPOTENCY_LOCAL_MAX_KEYS', 10000)))
+    client = app.extensions.get('redis')
+    service = IdempotencyService(
+        RedisIdempotencyStore(client) if client is not None else local_store,
+        ttl=int(app.config.get('IDEMPOTENCY_KEY_TTL', 86400)),
+        lock_ttl=int(app.config.get('IDEMPOTENCY_LOCK_TTL', 60)),
+        fallback_store=local_store
+    )
+    app.extensions['idempotency'] = service
+    return service
+
+
+def get_idempotency():
+    return current_app.extensions['idempotency']
@@ -0,0 +1,182 @@
+"""
+Password hashing offloaded to a bounded process pool.
+
+bcrypt is CPU-bound and takes hundreds of milliseconds at production cost
+factors, so hashes and checks run in a dedicated ProcessPoolExecutor instead
+of on the request thread. The number of calls waiting for the pool is
+limited - when it is full PasswordHasherBusy is raised and the endpoint
+answers 503 with Retry-After instead of queueing more work.
+"""
+import atexit
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+from flask import current_app
+
+
+class PasswordHasherBusy(Exception):
+    """Kolejka hashowania jest pełna - klient powinien ponowić żądanie po retry_after sekundach"""
+
+    def __init__(self, retry_after=1):
+        super().__init__("Password hashing is overloaded, try again later")
+        self.retry_after = retry_after
+
+
+def _hash_password(password, rounds, prefix):
+    salt = bcrypt.gensalt(rounds=rounds, prefix=prefix)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check_password(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        # Niepoprawny format hasha w bazie
+        return False
+
+
+def hash_cost(pw_hash):
+    """Odczytuje cost factor z hasha bcrypt ($2b$12$...), None gdy format jest nieznany"""
+    parts = (pw_hash or '').split('$')
+    if len(parts) < 4:
+        return None
+    try:
+        return int(parts[2])
+    except ValueError:
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, max_workers=None, max_pending=None, rounds=12, prefix='2b',
+                 timeout=10, retry_after=1):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 4
+        self.rounds = rounds
+        self.prefix = prefix.encode('ascii') if isinstance(prefix, str) else prefix
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Pula tworzona leniwie, żeby nie forkować procesów przy imporcie aplikacji
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _release_when_done(self, futures):
+        """
+        Zwalnia slot dopiero gdy wszystkie zadania naprawdę się zakończą -
+        cancel() nie przerywa zadania, które worker już wykonuje
+        """
+        if not futures:
+            self._slots.release()
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._slots.release()
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy(self.retry_after)
+        futures = []
+        try:
+            futures.append(self._get_executor().submit(fn, *args))
+            return futures[0].result(timeout=self.timeout)
+        except FutureTimeoutError:
+            futures[0].cancel()
+            raise PasswordHasherBusy(self.retry_after)
+        finally:
+            self._release_when_done(futures)
+
+    def hash(self, password):
+        return self._run(_hash_password, password, self.rounds, self.prefix)
+
+    def check(self, pw_hash, password):
+        if not pw_hash or password is None:
+            return False
+        return self._run(_check_password, pw_hash, password)
+
+    def hash_many(self, passwords):
+        """
+        Hashuje listę haseł równolegle na wszystkich workerach.
+        Zadania są wysyłane falami po max_workers, więc pojedyncze logowania
+        czekają najwyżej na jedną falę, a nie na cały import.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy(self.retry_after)
+        futures = []
+        try:
+            executor = self._get_executor()
+            hashes = []
+            for start in range(0, len(passwords), self.max_workers):
+                wave = passwords[start:start + self.max_workers]
+                futures = []
+                for p in wave:
+                    futures.append(executor.submit(_hash_password, p, self.rounds, self.prefix))
+                hashes.extend(f.result(timeout=self.timeout) for f in futures)
+            return hashes
+        except FutureTimeoutError:
+            for f in futures:
+                f.cancel()
+            raise PasswordHasherBusy(self.retry_after)
+        finally:
+            # Zadania fali, które już ruszyły, nadal zajmują workery
+            self._release_when_done(futures)
+
+    def needs_rehash(self, pw_hash):
+        """Hash utworzony z innym cost factorem niż skonfigurowany"""
+        return hash_cost(pw_hash) != self.rounds
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def init_password_hasher(app):
+    """Tworzy pulę hashującą z konfiguracji aplikacji i zapisuje ją w app.extensions"""
+    hasher = PasswordHasher(
+        max_workers=app.config.get('PASSWORD_HASH_WORKERS'),
+        max_pending=app.config.get('PASSWORD_HASH_MAX_PENDING'),
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        prefix=app.config.get('BCRYPT_HASH_PREFIX', '2b'),
+        timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10),
+        retry_after=app.config.get('PASSWORD_HASH_RETRY_AFTER', 1)
+    )
+    app.extensions['password_hasher'] = hasher
+    atexit.register(hasher.shutdown)
+    return hasher
+
+
+def get_password_hasher():
+    return current_app.extensions['password_hasher']
+
+
+def hash_password(password):
+    """Zwraca hash bcrypt hasła (liczony w puli procesów)"""
+    return get_password_hasher().hash(password)
+
+
+def check_password(pw_hash, password):
+    """Weryfikuje hasło względem hasha bcrypt (liczone w puli procesów)"""
+    return get_password_hasher().check(pw_hash, password)
+
+
+def hash_passwords(passwords):
+    """Zwraca hashe bcrypt dla listy haseł (równolegle w puli procesów)"""
+    return get_password_hasher().hash_many(passwords)
@@ -0,0 +1,182 @@
+"""
+Background generation of downscaled previews for uploaded documents.
+
+Previews are JPEG files kept next to the document store in
+<DOCUMENT_STORAGE_ROOT>/previews/ab/cd/<sha256>-<size>.jpg, so identical
+receipts share one preview and a preview never has to be invalidated.
+Generation runs in a small thread pool (Pillow releases the GIL while
+decoding and resampling) and is scheduled right after upload; a preview
+requested before it is ready is generated on demand. A file that cannot be
+decoded leaves a <sha256>-<size>.failed marker instead, so it is not decoded
+again on every request. Only JPEG can be downscaled while decoding, so other
+images larger than max_pixels are refused before decoding instead of being
+loaded whole into memory.
+
+Images need Pillow; PDFs additionally need PyMuPDF (first page is rendered).
+Without them preview_url is simply not offered.
+"""
+import atexit
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from flask import current_app
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow jest opcjonalny
+    Image = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # pragma: no cover - PyMuPDF jest opcjonalny
+    fitz = None
+
+PREVIEW_MIMETYPE = 'image/jpeg'
+# Formaty rastrowe dekodowane przez Pillow (bez SVG - to nie jest obraz rastrowy)
+IMAGE_MIMETYPES = frozenset({
+    'image/jpeg', 'image/pjpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'
+})
+
+
+class PreviewFailed(Exception):
+    """Nie udało się wygenerować podglądu (uszkodzony lub nieobsługiwany plik)"""
+
+
+class PreviewService:
+    def __init__(self, store, max_size=480, workers=2, max_pixels=25_000_000):
+        self.store = store
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.root = os.path.join(store.root, 'previews')
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def supports(self, mimetype):
+        if Image is None or not mimetype:
+            return False
+        if mimetype == 'application/pdf':
+            return fitz is not None
+        return mimetype in IMAGE_MIMETYPES
+
+    def available(self, content_hash, mimetype):
+        """Typ jest obsługiwany, a wcześniejsze generowanie podglądu tej treści nie zakończyło się błędem"""
+        return self.supports(mimetype) and not os.path.isfile(self.failed_marker_path(content_hash))
+
+    def relative_path(self, content_hash):
+        return os.path.join('previews', content_hash[:2], content_hash[2:4], f'{content_hash}-{self.max_size}.jpg')
+
+    def path_for(self, content_hash):
+        return os.path.join(self.store.root, self.relative_path(content_hash))
+
+    def failed_marker_path(self, content_hash):
+        return os.path.join(os.path.dirname(self.path_for(content_hash)), f'{content_hash}-{self.max_size}.failed')
+
+    def schedule(self, content_hash, mimetype):
+        """
+        Zleca wygenerowanie podglądu w tle; zwraca Future albo None gdy podgląd
+        istnieje, typ nie jest obsługiwany lub generowanie już się nie powiodło
+        """
+        if not self.available(content_hash, mimetype) or os.path.isfile(self.path_for(content_hash)):
+            return None
+        with self._lock:
+            future = self._pending.get(content_hash)
+            if future is None:
+                future = self._executor.submit(self._generate, content_hash, mimetype)
+                self._pending[content_hash] = future
+                future.add_done_callback(lambda _: self._forget(content_hash))
+        return future
+
+    def _forget(self, content_hash):
+        with self._lock:
+            self._pending.pop(content_hash, None)
+
+    def get(self, content_hash, mimetype, wait=0):
+        """
+        Ścieżka gotowego podglądu. Gdy go nie ma, zleca generowanie i czeka
+        najwyżej wait sekund; None jeśli podgląd nie zdążył powstać,
+        PreviewFailed gdy pliku nie da się zdekodować
+        """
+        path = self.path_for(content_hash)
+        if os.path.isfile(path):
+            return path
+        future = self.schedule(content_hash, mimetype)
+        if future is None:
+            if os.path.isfile(path):
+                return path
+            if os.path.isfile(self.failed_marker_path(content_hash)):
+                raise PreviewFailed(content_hash)
+            return None
+        try:
+            future.result(timeout=wait)
+        except FutureTimeoutError:
+            return None
+        except Exception as e:
+            raise PreviewFailed(content_hash) from e
+        return path
+
+    def _open_source(self, content_hash, mimetype):
+        source = self.store.path_for(content_hash)
+        if mimetype == 'application/pdf':
+            with fitz.open(source) as pdf:
+                page = pdf[0]
+                # Renderujemy od razu w docelowej skali zamiast pełnej strony
+                zoom = self.max_size / max(page.rect.width, page.rect.height)
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        image = Image.open(source)
+        # draft() pozwala dekoderowi JPEG od razu zmniejszyć obraz przy wczytywaniu
+        image.draft('RGB', (self.max_size, self.max_size))
+        # Image.open() czyta tylko nagłówek - PNG, TIFF itp. zdekodowałyby się w pełnym rozmiarze
+        width, height = image.size
+        if width * height > self.max_pixels:
+            image.close()
+            raise PreviewFailed(f'{content_hash}: {width}x{height} exceeds PREVIEW_MAX_PIXELS')
+        return ImageOps.exif_transpose(image)
+
+    def _generate(self, content_hash, mimetype):
+        path = self.path_for(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            image = self._open_source(content_hash, mimetype)
+            image.thumbnail((self.max_size, self.max_size))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+        except FileNotFoundError:
+            raise
+        except Exception:
+            # Treść się nie zmieni (adres z SHA-256) - kolejne żądania nie dekodują pliku ponownie
+            open(self.failed_marker_path(content_hash), 'ab').close()
+            raise
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                image.save(tmp, 'JPEG', quality=80, optimize=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def init_previews(app):
+    """Tworzy pulę generującą podglądy (init_storage musi być wywołane wcześniej)"""
+    service = PreviewService(
+        app.extensions['document_store'],
+        max_size=int(app.config.get('PREVIEW_MAX_SIZE', 480)),
+        workers=int(app.config.get('PREVIEW_WORKERS', 2)),
+        max_pixels=int(app.config.get('PREVIEW_MAX_PIXELS', 25_000_000))
+    )
+    app.extensions['previews'] = service
+    atexit.register(service.shutdown)
+    return service
+
+
+def get_previews():
+    return current_app.extensions['previews']
@@ -0,0 +1,141 @@
+"""
+Principal cache - id, role, is_active and manager_id of an employee,
+cached with a TTL so role checks do not hit the database on every request.
+
+The store is an in-process LRU, or Redis when it is configured (then the
+cache and its invalidation are shared by all worker processes).
+"""
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+from models import db, Employee
+
+Principal = namedtuple('Principal', ['id', 'role', 'is_active', 'manager_id'])
+
+
+class LocalPrincipalStore:
+    """In-process LRU with per-entry expiry"""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, employee_id):
+        with self._lock:
+            entry = self._entries.get(employee_id)
+            if entry is None:
+                return None
+            principal, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[employee_id]
+                return None
+            self._entries.move_to_end(employee_id)
+            return principal
+
+    def set(self, principal):
+        with self._lock:
+            self._entries[principal.id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, employee_id):
+        with self._lock:
+            self._entries.pop(employee_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisPrincipalStore:
+    """Principal store kept in Redis, shared between worker processes"""
+
+    key_prefix = 'principal:'
+
+    def __init__(self, client, ttl=60):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, employee_id):
+        raw = self.client.get(f'{self.key_prefix}{employee_id}')
+        if raw is None:
+            return None
+        return Principal(**json.loads(raw))
+
+    def set(self, principal):
+        self.client.setex(f'{self.key_prefix}{principal.id}', self.ttl, json.dumps(principal._asdict()))
+
+    def delete(self, employee_id):
+        self.client.delete(f'{self.key_prefix}{employee_id}')
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.key_prefix}*'):
+            self.client.delete(key)
+
+
+class PrincipalCache:
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, employee_id):
+        """Zwraca Principal z cache, a przy braku ładuje go z bazy (None gdy pracownik nie istnieje)"""
+        try:
+            employee_id = int(employee_id)
+        except (TypeError, ValueError):
+            return None
+
+        try:
+            principal = self.store.get(employee_id)
+        except Exception as e:
+            # Awaria Redisa nie może blokować autoryzacji - idziemy do bazy
+            print(f"[PRINCIPAL_CACHE] Warning: cache read failed: {e}")
+            principal = None
+        if principal is not None:
+            return principal
+
+        row = db.session.query(
+            Employee.id, Employee.role, Employee.is_active, Employee.manager_id
+        ).filter(Employee.id == employee_id).first()
+        if row is None:
+            return None
+
+        principal = Principal(id=row.id, role=row.role, is_active=row.is_active, manager_id=row.manager_id)
+        try:
+            self.store.set(principal)
+        except Exception as e:
+            print(f"[PRINCIPAL_CACHE] Warning: cache write failed: {e}")
+        return principal
+
+    def invalidate(self, employee_id):
+        try:
+            self.store.delete(int(employee_id))
+        except Exception as e:
+            print(f"[PRINCIPAL_CACHE] Warning: cache invalidation failed: {e}")
+
+
+def init_principal_cache(app):
+    """Tworzy cache principali (Redis jeśli dostępny, w przeciwnym razie lokalne LRU)"""
+    ttl = int(app.config.get('PRINCIPAL_CACHE_TTL', 60))
+    client = app.extensions.get('redis')
+    if client is not None:
+        store = RedisPrincipalStore(client, ttl=ttl)
+    else:
+        store = LocalPrincipalStore(maxsize=int(app.config.get('PRINCIPAL_CACHE_SIZE', 10000)), ttl=ttl)
+    cache = PrincipalCache(store)
+    app.extensions['principal_cache'] = cache
+    return cache
+
+
+def get_principal(employee_id):
+    return current_app.extensions['principal_cache'].get(employee_id)
+
+
+def invalidate_principal(employee_id):
+    current_app.extensions['principal_cache'].invalidate(employee_id)
@@ -0,0 +1,158 @@
+"""
+Token-bucket rate limiting for the login endpoint.
+
+Each bucket kind (login_email, login_ip) has a capacity and a period in
+which an empty bucket refills completely. Buckets live in Redis (one Lua
+call per check) or in process memory when Redis is not configured.
+Allowed/rejected counters are kept per bucket kind to help tune the limits.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+# KEYS[1] - bucket, KEYS[2] - counters; ARGV: capacity, refill per second, now, ttl
+_TAKE_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+  tokens = capacity
+  ts = now
+end
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if allowed == 1 then
+  redis.call('HINCRBY', KEYS[2], 'allowed', 1)
+else
+  redis.call('HINCRBY', KEYS[2], 'rejected', 1)
+end
+return {allowed, tostring(tokens)}
+"""
+
+
+def parse_limit(value):
+    """'5/60' -> (5, 60.0): pojemność kubełka i czas pełnego napełnienia w sekundach"""
+    capacity, _, period = str(value).partition('/')
+    return int(capacity), float(period or 60)
+
+
+class LocalBucketStore:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def take(self, bucket, key, capacity, rate, ttl):
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts = self._buckets.get((bucket, key), (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[(bucket, key)] = (tokens, now)
+            self._buckets.move_to_end((bucket, key))
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            counters = self._counters.setdefault(bucket, {'allowed': 0, 'rejected': 0})
+            counters['allowed' if allowed else 'rejected'] += 1
+        return allowed, tokens
+
+    def counters(self, bucket):
+        with self._lock:
+            return dict(self._counters.get(bucket, {'allowed': 0, 'rejected': 0}))
+
+
+class RedisBucketStore:
+    key_prefix = 'ratelimit:'
+
+    def __init__(self, client):
+        self.client = client
+        self._script = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, bucket, key, capacity, rate, ttl):
+        allowed, tokens = self._script(
+            keys=[f'{self.key_prefix}{bucket}:{key}', f'{self.key_prefix}stats:{bucket}'],
+            args=[capacity, rate, time.time(), int(ttl) + 1]
+        )
+        return bool(allowed), float(tokens)
+
+    def counters(self, bucket):
+        raw = self.client.hgetall(f'{self.key_prefix}stats:{bucket}')
+        return {
+            'allowed': int(raw.get(b'allowed', 0)),
+            'rejected': int(raw.get(b'rejected', 0))
+        }
+
+
+class RateLimiter:
+    def __init__(self, store, limits, fallback_store=None):
+        self.store = store
+        self.fallback_store = fallback_store or store
+        self.limits = limits
+
+    def hit(self, bucket, key):
+        """Pobiera token z kubełka; zwraca 0 gdy żądanie jest dozwolone, inaczej Retry-After w sekundach"""
+        capacity, period = self.limits[bucket]
+        rate = capacity / period
+        try:
+            allowed, tokens = self.store.take(bucket, key, capacity, rate, period)
+        except Exception as e:
+            # Redis niedostępny - limitujemy lokalnie zamiast przepuszczać wszystko
+            print(f"[RATE_LIMIT] Warning: store failed, using local buckets: {e}")
+            allowed, tokens = self.fallback_store.take(bucket, key, capacity, rate, period)
+        if allowed:
+            return 0
+        return max(1, int((1 - tokens) / rate + 0.999))
+
+    def stats(self):
+        result = {}
+        for bucket, (capacity, period) in self.limits.items():
+            try:
+                counters = self.store.counters(bucket)
+            except Exception:
+                counters = self.fallback_store.counters(bucket)
+            result[bucket] = {'capacity': capacity, 'period_seconds': period, **counters}
+        return result
+
+
+def init_rate_limiter(app):
+    """Tworzy limiter logowania (Redis jeśli dostępny, w przeciwnym razie pamięć procesu)"""
+    limits = {
+        'login_email': parse_limit(app.config.get('LOGIN_RATE_LIMIT_EMAIL', '5/60')),
+        'login_ip': parse_limit(app.config.get('LOGIN_RATE_LIMIT_IP', '30/60'))
+    }
+    local_store = LocalBucketStore()
+    client = app.extensions.get('redis')
+    store = RedisBucketStore(client) if client is not None else local_store
+    limiter = RateLimiter(store, limits, fallback_store=local_store)
+    app.extensions['rate_limiter'] = limiter
+    return limiter
+
+
+def get_rate_limiter():
+    return current_app.extensions['rate_limiter']
+
+
+def check_login_rate(email, client_ip):
+    """
+    Sprawdza limity logowania dla IP i adresu email.
+    Zwraca 0 gdy próba jest dozwolona, w przeciwnym razie Retry-After w sekundach.
+    """
+    limiter = get_rate_limiter()
+    retry_after = limiter.hit('login_ip', client_ip or 'unknown')
+    if retry_after:
+        return retry_after
+    return limiter.hit('login_email', email.strip().lower())
@@ -0,0 +1,32 @@
+"""
+Shared Redis connection used by the caching and throttling services.
+Redis is optional: when REDIS_URL is not set or the server is unreachable
+every service falls back to its in-process implementation.
+"""
+from flask import current_app
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is listed in requirements.txt
+    redis = None
+
+
+def init_redis(app):
+    """Create the Redis client once per app and keep it in app.extensions"""
+    client = None
+    url = app.config.get('REDIS_URL')
+    if url and redis is not None:
+        try:
+            client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            client.ping()
+            print(f"[REDIS] Connected to {url}")
+        except Exception as e:
+            print(f"[REDIS] Warning: Redis unavailable ({e}), using in-memory fallback")
+            client = None
+    app.extensions['redis'] = client
+    return client
+
+
+def get_redis():
+    """Pobiera klienta Redis z current_app (None gdy Redis nie jest skonfigurowany)"""
+    return current_app.extensions.get('redis')
@@ -0,0 +1,323 @@
+"""
+Per-delegation rollup of expense counts and PLN sums by status.
+
+delegation_rollup keeps one row per delegation with the number of its
+expenses and the sum of their PLN amounts per normalized status (PENDING,
+APPROVED, REJECTED). List and detail views take the delegation status and
+summary from that row instead of aggregating all of its expenses.
+
+The row changes in the same transaction as the expenses: a flush that
+inserts, deletes or changes expenses (status, amounts, delegation) applies
+one relative UPDATE (x = x + delta) per touched delegation, and Core
+statements that bypass the session call apply_rollup_deltas() themselves.
+Relative updates need no prior read and commute, so concurrent writers only
+queue on the row lock; rows are always locked in delegation_id order.
+
+`flask rollups check` compares the table with an aggregation over expense and
+`flask rollups rebuild` recomputes it (backfill / repair). A rebuild locks
+the rows it recomputes first, so it can run while the application is live.
+"""
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, delete, event, exists, func, insert, inspect, literal, or_, select, update
+
+from models import db, Delegation, DelegationRollup, Expense
+from services.delegation_status import StatusCounts, derive_status, normalize_status, normalized_status_expr
+
+COUNT_COLUMNS = ('total_count', 'pending_count', 'approved_count', 'rejected_count')
+AMOUNT_COLUMNS = ('total_pln', 'pending_pln', 'approved_pln', 'rejected_pln')
+ROLLUP_COLUMNS = COUNT_COLUMNS + AMOUNT_COLUMNS
+# Atrybuty wydatku, od których zależy rollup delegacji
+_TRACKED_ATTRS = ('delegation_id', 'status', 'pln_amount', 'amount')
+
+RollupSummary = namedtuple('RollupSummary', 'status counts total pending approved rejected')
+
+_table = DelegationRollup.__table__
+_delta_statement = (
+    update(_table)
+    .where(_table.c.delegation_id == bindparam('b_delegation_id'))
+    .values({
+        **{name: _table.c[name] + bindparam(f'b_{name}') for name in ROLLUP_COLUMNS},
+        'updated_at': bindparam('b_updated_at')
+    })
+)
+
+
+def expense_pln(pln_amount, amount):
+    """Kwota wydatku liczona do sum - pln_amount, a gdy brak (0/NULL) amount"""
+    return Decimal(str(pln_amount or amount or 0))
+
+
+def expense_pln_expr(pln_amount=Expense.pln_amount, amount=Expense.amount):
+    """expense_pln jako wyrażenie SQL"""
+    return func.coalesce(func.nullif(pln_amount, 0), func.nullif(amount, 0), 0)
+
+
+class RollupDeltas:
+    """Zmiany liczników i sum zebrane per delegacja - zapisywane jednym UPDATE na delegację"""
+
+    def __init__(self):
+        self._deltas = {}
+
+    def add(self, delegation_id, status, pln_amount, amount, sign=1):
+        if delegation_id is None:
+            return
+        delta = self._deltas.setdefault(delegation_id, dict.fromkeys(ROLLUP_COLUMNS, 0))
+        prefix = normalize_status(status).lower()
+        value = sign * expense_pln(pln_amount, amount)
+        delta['total_count'] += sign
+        delta[f'{prefix}_count'] += sign
+        delta['total_pln'] += value
+        delta[f'{prefix}_pln'] += value
+
+    def add_expense(self, expense, sign=1):
+        """Wydatek jako obiekt lub wiersz z delegation_id, status, pln_amount, amount"""
+        self.add(expense.delegation_id, expense.status, expense.pln_amount, expense.amount, sign)
+
+    def apply(self, connection):
+        """Wykonuje niezerowe delty (w kolejności delegation_id); zwraca zmienione delegacje"""
+        now = datetime.utcnow()
+        params = [
+            {'b_delegation_id': delegation_id, 'b_updated_at': now,
+             **{f'b_{name}': value for name, value in delta.items()}}
+            for delegation_id, delta in sorted(self._deltas.items()) if any(delta.values())
+        ]
+        self._deltas.clear()
+        if params:
+            connection.execute(_delta_statement, params)
+        return [p['b_delegation_id'] for p in params]
+
+
+def _expire_rollups(session, delegation_ids):
+    """Obiekty DelegationRollup w sesji mają nieaktualne wartości - odczyt pobierze je ponownie"""
+    for delegation_id in delegation_ids:
+        rollup = session.identity_map.get(session.identity_key(DelegationRollup, delegation_id))
+        if rollup is not None:
+            session.expire(rollup)
+
+
+def apply_rollup_deltas(deltas):
+    """Zapisuje delty wydatków zmienionych poza ORM (np. INSERT/UPDATE przez Core)"""
+    session = db.session()
+    _expire_rollups(session, deltas.apply(session.connection()))
+
+
+def _tracked_changes(obj):
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in _TRACKED_ATTRS)
+
+
+def _collect_expense_deltas(session, flush_context, instances):
+    """
+    Przed flushem wiersze mają jeszcze stare wartości - odczytujemy je z bazy
+    (atrybuty obiektu mogły wygasnąć po commicie, historia nie zawsze zna poprzednią wartość)
+    """
+    changed = [obj for obj in session.dirty if isinstance(obj, Expense) and obj.id is not None
+               and _tracked_changes(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Expense) and obj.id is not None]
+    if not changed and not deleted:
+        return
+    originals = {row.id: row for row in session.connection().execute(
+        select(Expense.id, Expense.delegation_id, Expense.status, Expense.pln_amount, Expense.amount)
+        .where(Expense.id.in_({obj.id for obj in changed + deleted}))
+    )}
+    deltas = session.info.setdefault('rollup_deltas', RollupDeltas())
+    for obj in deleted:
+        if obj.id in originals:
+            deltas.add_expense(originals[obj.id], -1)
+    for obj in changed:
+        original = originals.get(obj.id)
+        if original is None:
+            continue
+        state = inspect(obj)
+        current = {}
+        for key in _TRACKED_ATTRS:
+            added = state.attrs[key].history.added
+            current[key] = added[0] if added else getattr(original, key)
+        deltas.add_expense(original, -1)
+        deltas.add(current['delegation_id'], current['status'], current['pln_amount'], current['amount'])
+
+
+def _write_rollups(session, flush_context):
+    deltas = session.info.pop('rollup_deltas', None) or RollupDeltas()
+    new_delegations = sorted(obj.id for obj in session.new if isinstance(obj, Delegation))
+    deleted_delegations = sorted(obj.id for obj in session.deleted if isinstance(obj, Delegation))
+    for obj in session.new:
+        if isinstance(obj, Expense):
+            deltas.add_expense(obj)
+
+    connection = session.connection()
+    if new_delegations:
+        connection.execute(insert(_table), [{'delegation_id': d} for d in new_delegations])
+    touched = deltas.apply(connection)
+    if deleted_delegations:
+        connection.execute(delete(_table).where(_table.c.delegation_id.in_(deleted_delegations)))
+    if touched:
+        session.info.setdefault('touched_rollups', set()).update(touched)
+
+
+def _expire_rollups_after_flush(session, flush_context):
+    delegation_ids = session.info.pop('touched_rollups', None)
+    if delegation_ids:
+        _expire_rollups(session, delegation_ids)
+
+
+def _forget_deltas(session, previous_transaction):
+    session.info.pop('rollup_deltas', None)
+    session.info.pop('touched_rollups', None)
+
+
+def summarize_rollup(rollup):
+    """Status delegacji i sumy PLN z wiersza rollupu (brak wiersza = brak wydatków)"""
+    if rollup is None:
+        counts = StatusCounts(0, 0, 0, 0)
+        amounts = (Decimal('0'),) * 4
+    else:
+        counts = StatusCounts(rollup.total_count, rollup.pending_count, rollup.approved_count,
+                              rollup.rejected_count)
+        amounts = (rollup.total_pln, rollup.pending_pln, rollup.approved_pln, rollup.rejected_pln)
+    return RollupSummary(derive_status(counts), counts, *(Decimal(str(a or 0)) for a in amounts))
+
+
+def serialize_rollup_summary(summary):
+    return {
+        "total": float(summary.total),
+        "pending": float(summary.pending),
+        "approved": float(summary.approved),
+        "rejected": float(summary.rejected)
+    }
+
+
+def expected_rollups_select(*criteria):
+    """Wartości rollupu policzone od zera z tabeli expense (delegacje spełniające criteria)"""
+    expense = select(
+        Expense.id, Expense.delegation_id,
+        normalized_status_expr().label('status'),
+        expense_pln_expr().label('pln')
+    ).subquery()
+    columns = [func.count(expense.c.id).label('total_count')]
+    columns += [func.count(expense.c.id).filter(expense.c.status == status).label(f'{status.lower()}_count')
+                for status in ('PENDING', 'APPROVED', 'REJECTED')]
+    columns.append(func.coalesce(func.sum(expense.c.pln), 0).label('total_pln'))
+    columns += [func.coalesce(func.sum(expense.c.pln).filter(expense.c.status == status), 0)
+                .label(f'{status.lower()}_pln') for status in ('PENDING', 'APPROVED', 'REJECTED')]
+    return (
+        select(Delegation.id.label('delegation_id'), *columns)
+        .select_from(Delegation)
+        .outerjoin(expense, expense.c.delegation_id == Delegation.id)
+        .where(*criteria)
+        .group_by(Delegation.id)
+    )
+
+
+def find_rollup_drift(delegation_ids=None):
+    """
+    Delegacje, których rollup różni się od wyliczenia z expense, nie ma wiersza
+    albo wiersz nie ma delegacji - posortowane id
+    """
+    criteria = [Delegation.id.in_(delegation_ids)] if delegation_ids is not None else []
+    expected = expected_rollups_select(*criteria).subquery()
+    mismatched = select(expected.c.delegation_id).outerjoin(
+        _table, _table.c.delegation_id == expected.c.delegation_id
+    ).where(or_(_table.c.delegation_id.is_(None), *(expected.c[name] != _table.c[name] for name in ROLLUP_COLUMNS)))
+    orphans = select(_table.c.delegation_id).where(~exists().where(Delegation.id == _table.c.delegation_id))
+    if delegation_ids is not None:
+        orphans = orphans.where(_table.c.delegation_id.in_(delegation_ids))
+    drift = set(db.session.execute(mismatched).scalars()) | set(db.session.execute(orphans).scalars())
+    return sorted(drift)
+
+
+def rebuild_rollups(delegation_ids):
+    """
+    Przelicza rollup wskazanych delegacji z expense (bez commitu). Najpierw blokuje
+    istniejące wiersze - równoległe delty czekają i dodają się do nowych wartości,
+    a zapytanie liczące widzi wszystko, co zatwierdzono przed blokadą
+    """
+    delegation_ids = sorted(set(delegation_ids))
+    if not delegation_ids:
+        return
+    db.session.execute(
+        select(_table.c.delegation_id).where(_table.c.delegation_id.in_(delegation_ids))
+        .order_by(_table.c.delegation_id).with_for_update()
+    ).all()
+    expected = expected_rollups_select(Delegation.id.in_(delegation_ids)).subquery()
+    now = datetime.utcnow()
+    db.session.execute(
+        update(_table).where(_table.c.delegation_id == expected.c.delegation_id)
+        .values({**{name: expected.c[name] for name in ROLLUP_COLUMNS}, 'updated_at': now})
+    )
+    missing = expected_rollups_select(
+        Delegation.id.in_(delegation_ids),
+        ~exists().where(_table.c.delegation_id == Delegation.id)
+    ).add_columns(literal(now).label('updated_at'))
+    db.session.execute(insert(_table).from_select(('delegation_id',) + ROLLUP_COLUMNS + ('updated_at',), missing))
+    db.session.execute(delete(_table).where(
+        _table.c.delegation_id.in_(delegation_ids),
+        ~exists().where(Delegation.id == _table.c.delegation_id)
+    ))
+    _expire_rollups(db.session(), delegation_ids)
+
+
+def backfill_rollups():
+    """Tworzy brakujące wiersze rollupu (np. po migracji) - zwraca ich liczbę"""
+    missing = [row.id for row in db.session.query(Delegation.id).filter(
+        ~exists().where(_table.c.delegation_id == Delegation.id)
+    )]
+    rebuild_rollups(missing)
+    db.session.commit()
+    return len(missing)
+
+
+def _all_rollup_ids():
+    return sorted(set(db.session.execute(select(Delegation.id)).scalars())
+                  | set(db.session.execute(select(_table.c.delegation_id)).scalars()))
+
+
+def _batches(ids, size):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+rollups_cli = AppGroup('rollups', help='Rollup wydatków delegacji (delegation_rollup)')
+
+
+@rollups_cli.command('check')
+@click.option('--batch-size', default=1000, show_default=True)
+def check_command(batch_size):
+    """Porównuje delegation_rollup z wyliczeniem z expense (kod wyjścia 1 przy rozbieżnościach)"""
+    drift = []
+    for batch in _batches(_all_rollup_ids(), batch_size):
+        drift += find_rollup_drift(batch)
+        db.session.rollback()
+    if drift:
+        click.echo(f"[ROLLUPS] {len(drift)} delegation(s) out of sync: {', '.join(map(str, drift[:50]))}"
+                   + (' ...' if len(drift) > 50 else ''))
+        raise SystemExit(1)
+    click.echo("[ROLLUPS] ✓ delegation_rollup is consistent with expense")
+
+
+@rollups_cli.command('rebuild')
+@click.option('--delegation-id', 'delegation_ids', type=int, multiple=True,
+              help='Tylko wskazane delegacje (domyślnie wszystkie)')
+@click.option('--batch-size', default=1000, show_default=True)
+def rebuild_command(delegation_ids, batch_size):
+    """Przelicza delegation_rollup z expense partiami (commit po każdej partii)"""
+    ids = sorted(set(delegation_ids)) if delegation_ids else _all_rollup_ids()
+    for batch in _batches(ids, batch_size):
+        rebuild_rollups(batch)
+        db.session.commit()
+    click.echo(f"[ROLLUPS] ✓ Rebuilt {len(ids)} delegation rollup(s)")
+
+
+def init_rollups(app):
+    """Podpina utrzymywanie rollupów przy zmianach wydatków i delegacji oraz komendy `flask rollups`"""
+    if not event.contains(db.session, 'before_flush', _collect_expense_deltas):
+        event.listen(db.session, 'before_flush', _collect_expense_deltas)
+        event.listen(db.session, 'after_flush', _write_rollups)
+        event.listen(db.session, 'after_flush_postexec', _expire_rollups_after_flush)
+        event.listen(db.session, 'after_soft_rollback', _forget_deltas)
+    app.cli.add_command(rollups_cli)
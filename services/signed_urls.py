@@ -0,0 +1,85 @@
+"""
+Short-lived HMAC-signed URLs for stored document files and previews.
+
+A signed URL carries everything needed to serve the file - content hash,
+expiry, download name and content type - plus an HMAC-SHA256 over those
+values, so it is verified without touching the database. Expiry times are
+rounded up to SIGNED_URL_BUCKET seconds: all URLs minted for a file within
+one bucket are identical, which keeps listings and browser caches stable.
+"""
+import base64
+import hashlib
+import hmac
+import re
+import time
+
+from flask import current_app, url_for
+
+URL_KINDS = ('document', 'preview')
+CONTENT_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class SignedUrls:
+    def __init__(self, secret, ttl=900, bucket=300):
+        self._key = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.bucket = max(1, bucket)
+
+    def expiry(self, now=None):
+        """Koniec ważności URL-i wydawanych teraz (zaokrąglony w górę do kubełka)"""
+        now = int(now if now is not None else time.time())
+        return (now + self.ttl + self.bucket - 1) // self.bucket * self.bucket
+
+    def signature(self, kind, content_hash, expires, name, mimetype):
+        message = '\n'.join((kind, content_hash, str(expires), name or '', mimetype or '')).encode('utf-8')
+        digest = hmac.new(self._key, message, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+    def params(self, kind, content_hash, name, mimetype, expires=None):
+        expires = expires or self.expiry()
+        return {
+            'exp': expires,
+            'name': name or '',
+            'type': mimetype or '',
+            'sig': self.signature(kind, content_hash, expires, name, mimetype)
+        }
+
+    def verify(self, kind, content_hash, args, now=None):
+        """Sprawdza podpis i ważność parametrów zapytania; zwraca (name, mimetype, expires) albo None"""
+        if kind not in URL_KINDS or not CONTENT_HASH_RE.match(content_hash or ''):
+            return None
+        try:
+            expires = int(args.get('exp', ''))
+        except ValueError:
+            return None
+        if expires < (now if now is not None else time.time()):
+            return None
+        name, mimetype = args.get('name', ''), args.get('type', '')
+        expected = self.signature(kind, content_hash, expires, name, mimetype)
+        if not hmac.compare_digest(expected, args.get('sig', '')):
+            return None
+        return name, mimetype, expires
+
+
+def init_signed_urls(app):
+    """Klucz SIGNED_URL_SECRET, a bez niego klucz wyprowadzony z JWT_SECRET_KEY"""
+    secret = app.config.get('SIGNED_URL_SECRET')
+    if not secret:
+        secret = hmac.new(app.config['JWT_SECRET_KEY'].encode('utf-8'), b'signed-urls', hashlib.sha256).digest()
+    signer = SignedUrls(
+        secret,
+        ttl=int(app.config.get('SIGNED_URL_TTL', 900)),
+        bucket=int(app.config.get('SIGNED_URL_BUCKET', 300))
+    )
+    app.extensions['signed_urls'] = signer
+    return signer
+
+
+def get_signed_urls():
+    return current_app.extensions['signed_urls']
+
+
+def signed_file_url(kind, content_hash, name, mimetype):
+    """Podpisany adres pliku ('document') lub podglądu ('preview') w blueprincie files"""
+    params = get_signed_urls().params(kind, content_hash, name, mimetype)
+    return url_for('files.serve_signed_file', kind=kind, content_hash=content_hash, **params)
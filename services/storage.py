@@ -0,0 +1,162 @@
+"""
+Content-addressed local store for uploaded documents.
+
+Uploads are copied to a temporary file in fixed-size chunks while their
+SHA-256 is computed, then atomically renamed to <root>/ab/cd/<sha256>.
+Identical files therefore end up stored once; a second upload of the same
+receipt only discards its temporary copy.
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+from urllib.parse import quote
+
+from flask import current_app, send_file
+
+CHUNK_SIZE = 64 * 1024
+# Zapas na granice multipart i pozostałe pola formularza ponad sam plik
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class DocumentTooLarge(Exception):
+    """Plik przekracza DOCUMENT_MAX_BYTES"""
+
+    def __init__(self, max_bytes):
+        super().__init__(f"File exceeds the maximum size of {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+class StoredBlob:
+    __slots__ = ('content_hash', 'size', 'relative_path', 'deduplicated')
+
+    def __init__(self, content_hash, size, relative_path, deduplicated):
+        self.content_hash = content_hash
+        self.size = size
+        self.relative_path = relative_path
+        self.deduplicated = deduplicated
+
+
+class ContentStore:
+    def __init__(self, root, max_bytes=None, chunk_size=CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def relative_path(content_hash):
+        return os.path.join(content_hash[:2], content_hash[2:4], content_hash)
+
+    def path_for(self, content_hash):
+        return os.path.join(self.root, self.relative_path(content_hash))
+
+    def exists(self, content_hash):
+        return os.path.isfile(self.path_for(content_hash))
+
+    def save(self, stream):
+        """
+        Zapisuje strumień (obiekt z read()) do magazynu, licząc SHA-256 w locie.
+        Zwraca StoredBlob; DocumentTooLarge gdy plik przekracza max_bytes.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, prefix='upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise DocumentTooLarge(self.max_bytes)
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            return self.commit(tmp_path, digest.hexdigest(), size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def commit(self, tmp_path, content_hash, size):
+        """Przenosi gotowy plik tymczasowy pod adres z hasha (albo go usuwa, gdy treść już istnieje)"""
+        final_path = self.path_for(content_hash)
+        if os.path.isfile(final_path):
+            os.remove(tmp_path)
+            deduplicated = True
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            # os.replace jest atomowe w obrębie jednego systemu plików (tmp leży w root)
+            os.replace(tmp_path, final_path)
+            deduplicated = False
+        return StoredBlob(content_hash, size, self.relative_path(content_hash), deduplicated)
+
+
+def document_mimetype(document):
+    if document.file_type and '/' in document.file_type:
+        return document.file_type
+    return mimetypes.guess_type(document.filename or '')[0] or 'application/octet-stream'
+
+
+def _content_disposition(filename, disposition='attachment'):
+    fallback = ''.join(ch for ch in (filename or '') if 32 <= ord(ch) < 127 and ch not in '"\\')
+    value = f'{disposition}; filename="{fallback or "document"}"'
+    if fallback != filename:
+        value += f"; filename*=UTF-8''{quote(filename)}"
+    return value
+
+
+def send_from_store(store, relative_path, mimetype, etag, download_name=None, as_attachment=False):
+    """
+    Odpowiedź z plikiem z magazynu bez czytania go w Pythonie:
+    za nginx (DOCUMENT_ACCEL_REDIRECT_PREFIX) tylko nagłówek X-Accel-Redirect,
+    w przeciwnym razie send_file (wsgi.file_wrapper / sendfile, Range, ETag)
+    """
+    prefix = current_app.config.get('DOCUMENT_ACCEL_REDIRECT_PREFIX')
+    if prefix:
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{relative_path.replace(os.sep, '/')}"
+        if download_name or as_attachment:
+            response.headers['Content-Disposition'] = _content_disposition(
+                download_name, 'attachment' if as_attachment else 'inline'
+            )
+        response.set_etag(etag)
+        return response
+    return send_file(
+        os.path.join(store.root, relative_path),
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag
+    )
+
+
+def send_stored_file(store, document, as_attachment=True):
+    """Plik dokumentu z ETag = SHA-256 treści"""
+    return send_from_store(
+        store,
+        store.relative_path(document.content_hash),
+        document_mimetype(document),
+        document.content_hash,
+        download_name=document.filename,
+        as_attachment=as_attachment
+    )
+
+
+def init_storage(app):
+    """Tworzy magazyn dokumentów w DOCUMENT_STORAGE_ROOT i zapisuje go w app.extensions"""
+    store = ContentStore(
+        app.config.get('DOCUMENT_STORAGE_ROOT') or os.path.join(app.root_path, 'storage'),
+        max_bytes=app.config.get('DOCUMENT_MAX_BYTES')
+    )
+    app.extensions['document_store'] = store
+    return store
+
+
+def get_storage():
+    return current_app.extensions['document_store']
@@ -0,0 +1,175 @@
+"""
+Delta sync of an employee's delegations, expenses and documents.
+
+Every INSERT/UPDATE of delegation, expense and document stamps the row with
+nextval('change_seq') and with the id of the writing transaction
+(change_xid). Deletions - ORM, Core or cascaded - leave a row in
+sync_tombstone, written by AFTER DELETE triggers in the database. A client
+keeps the highest cursor it has seen and asks only for rows past it, so a
+sync reads what changed instead of the whole history.
+
+The cursor is the (change_xid, change_seq) pair of the last delivered row.
+Sequence numbers are taken when a statement runs, not when its transaction
+commits, so ordering by change_seq alone lets a slow transaction (NDJSON
+stream, bulk import, bulk decisions) commit a number lower than one already
+delivered. Instead the durable cursor never moves past the snapshot xmin -
+the oldest transaction still in progress. Every transaction below it has
+finished and its rows were visible to the queries; rows of younger
+transactions are delivered now and once more on the next sync (clients apply
+them as upserts).
+
+Paging is not tied to xmin: every response also carries a continuation
+cursor - the durable cursor plus the position of the last delivered row - so
+a long transaction elsewhere in the database does not stall a client with
+many changes. Once a page went past xmin the durable cursor stays where it
+was for the rest of that paging run; rows of transactions that commit in the
+meantime below the read position are picked up by the next sync.
+
+A child change always bumps its delegation (services.versioning) in the same
+transaction after the child got its number, so the delegation's cursor
+position is never lower than its children's. Changed expenses and documents
+are therefore looked up only within the delegations that changed, via
+(delegation_id, change_xid, change_seq) indexes.
+"""
+from sqlalchemy import BigInteger, Text, cast, func, select, tuple_
+
+from models import db, Delegation, Document, Expense, SyncTombstone
+from services.delegations import serialize_document
+from services.expenses import serialize_expense
+
+FULL_SYNC = (0, 0)
+
+
+class InvalidSyncCursor(ValueError):
+    """Kursor synchronizacji w złym formacie"""
+
+
+def encode_sync_cursor(position, after=None):
+    """Kursor xid.seq; w trakcie stronicowania z pozycją odczytu - xid.seq~xid.seq"""
+    cursor = f"{position[0]}.{position[1]}"
+    if after is not None and after != position:
+        cursor += f"~{after[0]}.{after[1]}"
+    return cursor
+
+
+def _decode_position(value):
+    xid, dot, seq = value.partition('.')
+    try:
+        position = (int(xid), int(seq)) if dot else (int(xid), 0)
+    except ValueError:
+        raise InvalidSyncCursor(value)
+    if min(position) < 0:
+        raise InvalidSyncCursor(value)
+    return position if dot else FULL_SYNC
+
+
+def decode_sync_cursor(value):
+    """
+    Para (kursor trwały, pozycja odczytu) z kursora "xid.seq" lub
+    "xid.seq~xid.seq". Brak kursora lub liczba z dawnego formatu (sam
+    change_seq) oznacza pełną synchronizację
+    """
+    if not value:
+        return FULL_SYNC, FULL_SYNC
+    durable, tilde, after = value.partition('~')
+    since = _decode_position(durable)
+    if not tilde:
+        return since, since
+    after = _decode_position(after)
+    if after < since:
+        raise InvalidSyncCursor(value)
+    return since, after
+
+
+def snapshot_xmin():
+    """Najstarsza transakcja wciąż w toku - wszystkie starsze są zakończone i widoczne"""
+    xmin = func.pg_snapshot_xmin(func.pg_current_snapshot())
+    return db.session.execute(select(cast(cast(xmin, Text), BigInteger))).scalar_one()
+
+
+def serialize_sync_delegation(delegation):
+    return {
+        'id': delegation.id,
+        'employee_id': delegation.employee_id,
+        'start_date': delegation.start_date.isoformat() if delegation.start_date else None,
+        'end_date': delegation.end_date.isoformat() if delegation.end_date else None,
+        'status': delegation.status,
+        'country': delegation.country,
+        'city': delegation.city,
+        'name': delegation.name,
+        'purpose': delegation.purpose,
+        'created_at': delegation.created_at.isoformat() if delegation.created_at else None,
+        'updated_at': delegation.updated_at.isoformat() if delegation.updated_at else None,
+        'version': delegation.version
+    }
+
+
+def _position(row):
+    return row.change_xid, row.change_seq
+
+
+def _changed(model, since, limit, *criteria):
+    """Do limit+1 wierszy po pozycji since, rosnąco po (change_xid, change_seq)"""
+    return model.query.filter(tuple_(model.change_xid, model.change_seq) > since, *criteria) \
+        .order_by(model.change_xid, model.change_seq).limit(limit + 1).all()
+
+
+def changes_since(employee_id, since, limit, after=None):
+    """
+    Zmiany delegacji pracownika po pozycji odczytu after (domyślnie since),
+    najwyżej limit elementów łącznie. Zwraca (słownik
+    delegations/expenses/documents/deleted, kursor trwały, pozycja ostatniego
+    zwróconego elementu, has_more)
+    """
+    after = since if after is None else after
+    # Przed odczytem zmian - transakcje starsze niż xmin są już widoczne dla kolejnych zapytań
+    xmin = snapshot_xmin()
+    changed_ids = [row.id for row in db.session.query(Delegation.id).filter(
+        Delegation.employee_id == employee_id, tuple_(Delegation.change_xid, Delegation.change_seq) > after
+    )]
+    feeds = [
+        ('delegations', _changed(Delegation, after, limit, Delegation.employee_id == employee_id)),
+        ('deleted', _changed(SyncTombstone, after, limit, SyncTombstone.employee_id == employee_id)),
+    ]
+    if changed_ids:
+        feeds += [
+            ('expenses', _changed(Expense, after, limit, Expense.delegation_id.in_(changed_ids))),
+            ('documents', _changed(Document, after, limit, Document.delegation_id.in_(changed_ids))),
+        ]
+
+    # Scalanie jak w merge sort: źródło, które trafiło w limit, mogło mieć dalsze
+    # zmiany o pozycji niższej niż elementy pozostałych źródeł - tniemy na jego końcu
+    cut = None
+    for _, rows in feeds:
+        if len(rows) > limit:
+            cut = min(cut, _position(rows[limit - 1])) if cut is not None else _position(rows[limit - 1])
+    merged = sorted(
+        ((_position(row), name, row) for name, rows in feeds
+         for row in rows if cut is None or _position(row) <= cut),
+        key=lambda item: item[0]
+    )
+    has_more = cut is not None or len(merged) > limit
+    merged = merged[:limit]
+
+    cursor = since
+    position = merged[-1][0] if merged else after
+    if after == since:
+        for row_position, _, _ in merged:
+            if row_position[0] >= xmin:
+                # Starsza transakcja może jeszcze zatwierdzić zmiany - kursor trwały czeka,
+                # kolejne strony czyta się od pozycji ostatniego zwróconego elementu
+                break
+            cursor = row_position
+
+    result = {'delegations': [], 'expenses': [], 'documents': [], 'deleted': []}
+    for _, name, row in merged:
+        if name == 'delegations':
+            result[name].append(serialize_sync_delegation(row))
+        elif name == 'expenses':
+            result[name].append({**serialize_expense(row), 'delegation_id': row.delegation_id,
+                                 'version': row.version})
+        elif name == 'documents':
+            result[name].append(serialize_document(row))
+        else:
+            result[name].append({'entity': row.entity, 'id': row.entity_id, 'delegation_id': row.delegation_id})
+    return result, cursor, position, has_more
@@ -0,0 +1,114 @@
+"""
+Team overview for managers: per-report delegation and expense counters.
+
+One statement returns every report of a manager with the number of their
+delegations by derived status, their pending expenses and their PLN spend
+in the current month and year. Delegation statuses and pending counts come
+from delegation_rollup rows; the spend is summed over the year's expenses
+only. Both are grouped per employee in derived tables joined to employee,
+so the cost does not grow with the number of reports. The reports are found
+through ix_employee_manager_id and their delegations through the indexes
+leading with delegation.employee_id.
+"""
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from models import db, Delegation, DelegationRollup, Employee, Expense
+from services.delegation_status import derived_status_expr, normalized_status_expr
+from services.rollups import expense_pln_expr
+
+STATUSES = ('PENDING', 'APPROVED', 'REJECTED')
+
+
+def current_periods(now=None):
+    """(początek bieżącego miesiąca, początek bieżącego roku, początek następnego roku)"""
+    now = now or datetime.utcnow()
+    return (
+        datetime(now.year, now.month, 1),
+        datetime(now.year, 1, 1),
+        datetime(now.year + 1, 1, 1)
+    )
+
+
+def _delegation_counts(manager_id):
+    rollup = DelegationRollup
+    total, pending, approved, rejected = (
+        func.coalesce(column, 0) for column in
+        (rollup.total_count, rollup.pending_count, rollup.approved_count, rollup.rejected_count)
+    )
+    status = derived_status_expr(total, pending, approved, rejected)
+    return (
+        select(
+            Delegation.employee_id,
+            func.count(Delegation.id).label('delegations'),
+            *(func.count(Delegation.id).filter(status == s).label(f'{s.lower()}_delegations') for s in STATUSES),
+            func.sum(pending).label('pending_expenses')
+        )
+        .join(Employee, Employee.id == Delegation.employee_id)
+        .outerjoin(rollup, rollup.delegation_id == Delegation.id)
+        .where(Employee.manager_id == manager_id)
+        .group_by(Delegation.employee_id)
+        .subquery()
+    )
+
+
+def _spend(manager_id, month_start, year_start, year_end):
+    spent_at = func.coalesce(Expense.payed_at, Expense.created_at)
+    amount = expense_pln_expr()
+    return (
+        select(
+            Delegation.employee_id,
+            func.sum(amount).filter(spent_at >= month_start).label('month_pln'),
+            func.sum(amount).label('year_pln')
+        )
+        .select_from(Expense)
+        .join(Delegation, Delegation.id == Expense.delegation_id)
+        .join(Employee, Employee.id == Delegation.employee_id)
+        .where(
+            Employee.manager_id == manager_id,
+            spent_at >= year_start,
+            spent_at < year_end,
+            # Odrzucone wydatki nie są wydatkami zespołu
+            normalized_status_expr() != 'REJECTED'
+        )
+        .group_by(Delegation.employee_id)
+        .subquery()
+    )
+
+
+def load_team_overview(manager_id, now=None):
+    """
+    Podwładni menedżera z licznikami - jedno zapytanie.
+    Zwraca listę (Employee, słownik stats) posortowaną po id pracownika
+    """
+    month_start, year_start, year_end = current_periods(now)
+    counts = _delegation_counts(manager_id)
+    spend = _spend(manager_id, month_start, year_start, year_end)
+    rows = db.session.query(
+        Employee,
+        counts.c.delegations, counts.c.pending_delegations, counts.c.approved_delegations,
+        counts.c.rejected_delegations, counts.c.pending_expenses,
+        spend.c.month_pln, spend.c.year_pln
+    ).outerjoin(counts, counts.c.employee_id == Employee.id) \
+        .outerjoin(spend, spend.c.employee_id == Employee.id) \
+        .filter(Employee.manager_id == manager_id) \
+        .order_by(Employee.id) \
+        .all()
+
+    result = []
+    for employee, total, pending, approved, rejected, pending_expenses, month_pln, year_pln in rows:
+        result.append((employee, {
+            "delegations": {
+                "total": total or 0,
+                "pending": pending or 0,
+                "approved": approved or 0,
+                "rejected": rejected or 0
+            },
+            "pending_expenses": int(pending_expenses or 0),
+            "spend_pln": {
+                "month": float(month_pln or 0),
+                "year": float(year_pln or 0)
+            }
+        }))
+    return result
@@ -0,0 +1,158 @@
+"""
+Security versions of employees, used to revoke stateless JWTs.
+
+Every access token carries the employee's role, manager_id and security
+version ("ver") as claims. A token is accepted only while its "ver" equals
+the current security_version of the employee, so bumping the version
+(block, role or manager change, password change) rejects all older tokens.
+The current versions are kept in Redis or, as a stand-in, in process memory
+with a short TTL so other workers pick up bumps from the database.
+
+A bump is published unconditionally after its commit. A cache miss is filled
+from the database only if it does not lower the stored version, and with a
+TTL: a request that read the version just before a bump committed cannot
+overwrite the newer one, and any other drift expires.
+"""
+import threading
+import time
+
+from flask import current_app
+from flask_jwt_extended import create_access_token
+
+from models import db, Employee
+
+# KEYS[1] - wersja pracownika; ARGV: wersja z bazy, ttl. Nie obniża zapisanej wersji
+_FILL_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+if current ~= nil and current >= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+class LocalVersionStore:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, employee_id):
+        with self._lock:
+            entry = self._versions.get(employee_id)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def set(self, employee_id, version):
+        with self._lock:
+            self._versions[employee_id] = (version, time.monotonic() + self.ttl)
+
+    def fill(self, employee_id, version):
+        """Uzupełnia brak w cache wersją z bazy, nie nadpisując nowszej"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._versions.get(employee_id)
+            if entry is not None and entry[1] >= now and entry[0] >= version:
+                return
+            self._versions[employee_id] = (version, now + self.ttl)
+
+
+class RedisVersionStore:
+    key_prefix = 'secver:'
+
+    def __init__(self, client, fill_ttl=3600):
+        self.client = client
+        self.fill_ttl = fill_ttl
+        self._fill_script = client.register_script(_FILL_SCRIPT)
+
+    def get(self, employee_id):
+        raw = self.client.get(f'{self.key_prefix}{employee_id}')
+        return int(raw) if raw is not None else None
+
+    def set(self, employee_id, version):
+        self.client.set(f'{self.key_prefix}{employee_id}', version)
+
+    def fill(self, employee_id, version):
+        """Uzupełnia brak w cache wersją z bazy (z TTL), nie nadpisując nowszej"""
+        self._fill_script(keys=[f'{self.key_prefix}{employee_id}'], args=[version, int(self.fill_ttl)])
+
+
+class TokenVersions:
+    def __init__(self, store):
+        self.store = store
+
+    def current(self, employee_id):
+        """Aktualna wersja bezpieczeństwa pracownika (None gdy pracownik nie istnieje)"""
+        try:
+            version = self.store.get(employee_id)
+        except Exception as e:
+            print(f"[TOKEN_VERSIONS] Warning: store read failed: {e}")
+            version = None
+        if version is not None:
+            return version
+
+        version = db.session.query(Employee.security_version).filter(Employee.id == employee_id).scalar()
+        if version is None:
+            return None
+        try:
+            # Odczyt sprzed commitu podbicia nie może nadpisać wersji opublikowanej po nim
+            self.store.fill(employee_id, version)
+        except Exception as e:
+            print(f"[TOKEN_VERSIONS] Warning: store write failed: {e}")
+        return version
+
+    def publish(self, employee_id, version):
+        """Nowa wersja po commicie podbicia - nadpisuje bezwarunkowo"""
+        try:
+            self.store.set(employee_id, version)
+        except Exception as e:
+            print(f"[TOKEN_VERSIONS] Warning: store write failed: {e}")
+
+
+def init_token_versions(app):
+    """Tworzy magazyn wersji tokenów (Redis jeśli dostępny, w przeciwnym razie pamięć procesu)"""
+    client = app.extensions.get('redis')
+    if client is not None:
+        store = RedisVersionStore(client, fill_ttl=int(app.config.get('TOKEN_VERSION_FILL_TTL', 3600)))
+    else:
+        store = LocalVersionStore(ttl=int(app.config.get('TOKEN_VERSION_CACHE_TTL', 30)))
+    versions = TokenVersions(store)
+    app.extensions['token_versions'] = versions
+    return versions
+
+
+def create_employee_token(employee):
+    """JWT z claimami role, manager_id i ver - wystarczającymi do autoryzacji bez bazy"""
+    return create_access_token(
+        identity=str(employee.id),
+        additional_claims={
+            'role': employee.role,
+            'manager_id': employee.manager_id,
+            'ver': employee.security_version or 1
+        }
+    )
+
+
+def is_token_revoked(jwt_payload):
+    """Token jest unieważniony, gdy jego 'ver' nie zgadza się z aktualną wersją pracownika"""
+    token_version = jwt_payload.get('ver')
+    if token_version is None:
+        # Tokeny wystawione przed wprowadzeniem wersji - autoryzacja przez cache principali
+        return False
+    try:
+        employee_id = int(jwt_payload.get('sub'))
+    except (TypeError, ValueError):
+        return True
+    return current_app.extensions['token_versions'].current(employee_id) != token_version
+
+
+def bump_security_version(employee):
+    """Podbija wersję bezpieczeństwa (przed commitem); po commicie wywołaj publish_security_version"""
+    employee.security_version = (employee.security_version or 1) + 1
+
+
+def publish_security_version(employee):
+    """Publikuje nową wersję po commicie - starsze tokeny są od tej chwili odrzucane"""
+    current_app.extensions['token_versions'].publish(employee.id, employee.security_version)
@@ -0,0 +1,220 @@
+"""
+Resumable (chunked) document uploads.
+
+An upload session is a pair of files in <DOCUMENT_STORAGE_ROOT>/uploads:
+<id>.json with the metadata and <id>.part with the bytes received so far.
+The current offset is simply the size of the .part file, so a client that
+lost its connection asks for the offset and continues from there. When all
+bytes are in, the part file is hashed and moved into the content-addressed
+store; the session remembers the stored hash and is removed only once the
+caller has committed its Document (finish), so a failed commit can simply
+be retried. Sessions not completed within UPLOAD_SESSION_TTL are removed
+opportunistically when new sessions are created.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+from flask import current_app
+
+from services.storage import CHUNK_SIZE, DocumentTooLarge, StoredBlob
+
+CLEANUP_INTERVAL = 600
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadNotFound(Exception):
+    """Sesja nie istnieje albo wygasła"""
+
+
+class UploadOffsetMismatch(Exception):
+    """Upload-Offset klienta nie zgadza się z liczbą bajtów po stronie serwera"""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload-Offset does not match, current offset is {offset}")
+        self.offset = offset
+
+
+class UploadBusy(Exception):
+    """Inne żądanie zapisuje właśnie fragment tej sesji"""
+
+
+class UploadIncomplete(Exception):
+    """Zakończenie sesji przed przesłaniem wszystkich bajtów"""
+
+    def __init__(self, offset, size):
+        super().__init__(f"Upload is incomplete: {offset} of {size} bytes received")
+        self.offset = offset
+        self.size = size
+
+
+class UploadSessions:
+    def __init__(self, store, ttl=86400):
+        self.store = store
+        self.ttl = ttl
+        self.root = os.path.join(store.root, 'uploads')
+        os.makedirs(self.root, exist_ok=True)
+        self._last_cleanup = 0
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.json')
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.root, f'{upload_id}.part')
+
+    def _remove(self, upload_id):
+        for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_meta(self, upload_id, meta):
+        tmp_path = self._meta_path(upload_id) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({key: value for key, value in meta.items() if key != 'offset'}, f)
+        os.replace(tmp_path, self._meta_path(upload_id))
+
+    def create(self, **meta):
+        """Tworzy sesję; meta musi zawierać size (całkowity rozmiar pliku w bajtach)"""
+        if self.store.max_bytes and meta['size'] > self.store.max_bytes:
+            raise DocumentTooLarge(self.store.max_bytes)
+        self.cleanup_expired()
+        upload_id = uuid.uuid4().hex
+        meta['expires_at'] = time.time() + self.ttl
+        open(self._part_path(upload_id), 'xb').close()
+        self._write_meta(upload_id, meta)
+        return upload_id, meta
+
+    def get(self, upload_id):
+        """Metadane sesji z bieżącym offsetem; UploadNotFound gdy nie istnieje lub wygasła"""
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadNotFound(upload_id)
+        try:
+            with open(self._meta_path(upload_id), encoding='utf-8') as f:
+                meta = json.load(f)
+            # Po complete plik jest już w magazynie, a .part nie istnieje
+            meta['offset'] = meta['size'] if meta.get('content_hash') else os.path.getsize(self._part_path(upload_id))
+        except (OSError, ValueError):
+            raise UploadNotFound(upload_id)
+        if meta['expires_at'] < time.time():
+            self._remove(upload_id)
+            raise UploadNotFound(upload_id)
+        return meta
+
+    def append(self, upload_id, offset, stream, length=None):
+        """
+        Dopisuje fragment od offset; zwraca nowy offset. Bajty zapisane przed
+        zerwaniem połączenia zostają - klient wznawia od nowego offsetu.
+        """
+        meta = self.get(upload_id)
+        if length is not None and offset + length > meta['size']:
+            raise DocumentTooLarge(meta['size'])
+        if meta.get('content_hash'):
+            raise UploadOffsetMismatch(meta['offset'])
+        with open(self._part_path(upload_id), 'r+b') as part:
+            try:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadBusy(upload_id)
+            current = os.fstat(part.fileno()).st_size
+            if offset != current:
+                raise UploadOffsetMismatch(current)
+            part.seek(current)
+            start = current
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if current + len(chunk) > meta['size']:
+                    # Fragment wychodzi poza zadeklarowany rozmiar - odrzucamy go w całości
+                    part.truncate(start)
+                    raise DocumentTooLarge(meta['size'])
+                part.write(chunk)
+                current += len(chunk)
+            part.flush()
+            os.fsync(part.fileno())
+        return current
+
+    def complete(self, upload_id):
+        """
+        Przenosi kompletny plik do magazynu dokumentów; zwraca (meta, StoredBlob).
+        Sesja zostaje (z hashem zapisanej treści) do wywołania finish - ponowne
+        complete po nieudanym commicie zwraca ten sam plik
+        """
+        meta = self.get(upload_id)
+        if meta['offset'] != meta['size']:
+            raise UploadIncomplete(meta['offset'], meta['size'])
+        content_hash = meta.get('content_hash')
+        if content_hash and self.store.exists(content_hash):
+            return meta, StoredBlob(content_hash, meta['size'], self.store.relative_path(content_hash), True)
+        part_path = self._part_path(upload_id)
+        digest = hashlib.sha256()
+        try:
+            part = open(part_path, 'rb')
+        except FileNotFoundError:
+            # Równoległe complete właśnie przeniosło plik do magazynu
+            raise UploadBusy(upload_id)
+        with part:
+            try:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadBusy(upload_id)
+            for chunk in iter(lambda: part.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+            # Przeniesienie pod blokadą - równoległe complete/PUT nie zobaczy już pliku .part
+            blob = self.store.commit(part_path, digest.hexdigest(), meta['size'])
+            meta['content_hash'] = blob.content_hash
+            self._write_meta(upload_id, meta)
+        return meta, blob
+
+    def finish(self, upload_id):
+        """Usuwa sesję po zapisaniu Document w bazie"""
+        self._remove(upload_id)
+
+    def abort(self, upload_id):
+        self.get(upload_id)
+        self._remove(upload_id)
+
+    def cleanup_expired(self, force=False):
+        """Usuwa wygasłe sesje (najwyżej raz na CLEANUP_INTERVAL sekund, chyba że force)"""
+        now = time.time()
+        if not force and now - self._last_cleanup < CLEANUP_INTERVAL:
+            return 0
+        self._last_cleanup = now
+        removed = 0
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            try:
+                with open(os.path.join(self.root, name), encoding='utf-8') as f:
+                    expires_at = json.load(f).get('expires_at', 0)
+            except (OSError, ValueError):
+                continue
+            if expires_at < now:
+                self._remove(upload_id)
+                removed += 1
+        # Pliki .part bez metadanych (np. przerwane tworzenie sesji)
+        for name in os.listdir(self.root):
+            if name.endswith('.part') and not os.path.exists(self._meta_path(name[:-len('.part')])):
+                path = os.path.join(self.root, name)
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+        return removed
+
+
+def init_uploads(app):
+    """Tworzy obsługę sesji uploadu na bazie magazynu dokumentów (init_storage musi być wywołane wcześniej)"""
+    sessions = UploadSessions(
+        app.extensions['document_store'],
+        ttl=int(app.config.get('UPLOAD_SESSION_TTL', 86400))
+    )
+    app.extensions['upload_sessions'] = sessions
+    return sessions
+
+
+def get_upload_sessions():
+    return current_app.extensions['upload_sessions']
@@ -0,0 +1,110 @@
+"""
+Representation versions of employees and delegations for ETag / If-None-Match.
+
+Every UPDATE of employee, delegation or expense bumps its version column
+(onupdate version + 1). A delegation's detail also shows its expenses and
+documents, so a flush that inserts, changes or deletes either of them bumps
+the parent delegation as well; Core statements that bypass the session
+(bulk INSERT of expenses) call touch_delegations() explicitly.
+
+Conditional GETs compare the client's ETag with a stamp read by a single
+primary-key / indexed lookup, before any expenses or documents are loaded.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect, update
+
+from models import db, Delegation, Document, Employee, Expense
+
+# Znacznik wersji delegacji wraz z danymi potrzebnymi do sprawdzenia dostępu
+DelegationStamp = namedtuple('DelegationStamp', 'id employee_id manager_id version employee_version')
+
+_CHILD_MODELS = (Expense, Document)
+
+
+def _bump_statement(delegation_ids):
+    table = Delegation.__table__
+    return (
+        update(table)
+        .where(table.c.id.in_(sorted(delegation_ids)))
+        .values(version=table.c.version + 1, updated_at=datetime.utcnow())
+    )
+
+
+def _expire_touched(session, delegation_ids):
+    """Obiekty Delegation w sesji mają nieaktualną wersję - odczyt pobierze ją ponownie"""
+    for delegation_id in delegation_ids:
+        delegation = session.identity_map.get(session.identity_key(Delegation, delegation_id))
+        if delegation is not None:
+            session.expire(delegation, ['version', 'updated_at'])
+
+
+def touch_delegations(delegation_ids):
+    """Podbija wersję delegacji zmienionych poza ORM (np. INSERT wydatków przez Core)"""
+    delegation_ids = {d for d in delegation_ids if d is not None}
+    if not delegation_ids:
+        return
+    db.session.execute(_bump_statement(delegation_ids))
+    _expire_touched(db.session(), delegation_ids)
+
+
+def _changed_parent_ids(session):
+    delegation_ids = set()
+    for obj in session.new | session.deleted:
+        if isinstance(obj, _CHILD_MODELS):
+            delegation_ids.add(obj.delegation_id)
+    for obj in session.dirty:
+        if isinstance(obj, _CHILD_MODELS) and session.is_modified(obj, include_collections=False):
+            history = inspect(obj).attrs.delegation_id.history
+            # Przeniesienie do innej delegacji zmienia obie
+            delegation_ids.update(history.deleted or ())
+            delegation_ids.add(obj.delegation_id)
+    delegation_ids.discard(None)
+    return delegation_ids
+
+
+def _touch_parents_after_flush(session, flush_context):
+    delegation_ids = _changed_parent_ids(session)
+    if delegation_ids:
+        session.connection().execute(_bump_statement(delegation_ids))
+        session.info.setdefault('touched_delegations', set()).update(delegation_ids)
+
+
+def _expire_parents_after_flush(session, flush_context):
+    delegation_ids = session.info.pop('touched_delegations', None)
+    if delegation_ids:
+        _expire_touched(session, delegation_ids)
+
+
+def load_delegation_stamp(delegation_id):
+    """Wersja delegacji i jej pracownika (jedno zapytanie po kluczach głównych) albo None"""
+    row = db.session.query(
+        Delegation.id, Delegation.employee_id, Employee.manager_id, Delegation.version, Employee.version
+    ).join(Employee, Employee.id == Delegation.employee_id).filter(Delegation.id == delegation_id).first()
+    return DelegationStamp(*row) if row else None
+
+
+def load_employee_version(employee_id):
+    """Wersja pracownika albo None gdy nie istnieje"""
+    return db.session.query(Employee.version).filter(Employee.id == employee_id).scalar()
+
+
+def load_employee_delegations_stamp(employee_id):
+    """
+    (wersja pracownika, liczba delegacji, suma ich wersji) albo None.
+    Liczba zmienia się przy dodaniu/usunięciu delegacji, suma przy każdej zmianie -
+    ix_delegation_employee_start_id zawęża odczyt do delegacji tego pracownika
+    """
+    row = db.session.query(
+        Employee.version, func.count(Delegation.id), func.coalesce(func.sum(Delegation.version), 0)
+    ).outerjoin(Delegation, Delegation.employee_id == Employee.id) \
+        .filter(Employee.id == employee_id).group_by(Employee.id, Employee.version).first()
+    return tuple(row) if row else None
+
+
+def init_versioning(app):
+    """Podpina podbijanie wersji delegacji przy zmianach jej wydatków i dokumentów"""
+    if not event.contains(db.session, 'after_flush', _touch_parents_after_flush):
+        event.listen(db.session, 'after_flush', _touch_parents_after_flush)
+        event.listen(db.session, 'after_flush_postexec', _expire_parents_after_flush)
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # Testy nie wymagają Postgresa - uwierzytelnianie dotyka tylko tabeli employee
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}")
+    os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+    os.environ.setdefault('DOCUMENT_STORAGE_ROOT', str(tmp_path_factory.mktemp('storage')))
+    from app import app as flask_app
+    from models import db
+
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+    yield flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_employee(app):
+    from models import db, Employee
+    from services.passwords import hash_password
+
+    created = []
+
+    def factory(email, role='employee', password='12345678'):
+        with app.app_context():
+            employee = Employee(
+                username=email.split('@')[0], email=email, password=hash_password(password),
+                first_name='Test', last_name='User', role=role, is_active=True
+            )
+            db.session.add(employee)
+            db.session.commit()
+            created.append(employee.id)
+            return employee.id
+
+    yield factory
+
+    with app.app_context():
+        Employee.query.filter(Employee.id.in_(created)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+@pytest.fixture
+def login(client):
+    def do_login(email, password='12345678'):
+        response = client.post('/api/auth/login', json={'email': email, 'password': password})
+        assert response.status_code == 200, response.get_json()
+        return {'Authorization': f"Bearer {response.get_json()['token']}"}
+    return do_login
@@ -0,0 +1,41 @@
+def test_deactivated_employee_token_is_rejected(client, make_employee, login):
+    make_employee('admin.deactivation@example.com', role='admin')
+    employee_id = make_employee('employee.deactivation@example.com')
+    admin_headers = login('admin.deactivation@example.com')
+    employee_headers = login('employee.deactivation@example.com')
+
+    assert client.get('/api/auth/me', headers=employee_headers).status_code == 200
+
+    response = client.put(f'/api/admin/employees/{employee_id}', headers=admin_headers, json={'is_active': False})
+    assert response.status_code == 200, response.get_json()
+
+    # Token wydany przed dezaktywacją nie może już działać
+    assert client.get('/api/auth/me', headers=employee_headers).status_code == 401
+
+
+def test_unchanged_is_active_keeps_tokens(client, make_employee, login):
+    make_employee('admin.unchanged@example.com', role='admin')
+    employee_id = make_employee('employee.unchanged@example.com')
+    admin_headers = login('admin.unchanged@example.com')
+    employee_headers = login('employee.unchanged@example.com')
+
+    response = client.put(f'/api/admin/employees/{employee_id}', headers=admin_headers, json={'is_active': True})
+    assert response.status_code == 200, response.get_json()
+
+    assert client.get('/api/auth/me', headers=employee_headers).status_code == 200
+
+
+def test_non_boolean_is_active_is_rejected(client, make_employee, login):
+    make_employee('admin.string@example.com', role='admin')
+    employee_id = make_employee('employee.string@example.com')
+    admin_headers = login('admin.string@example.com')
+
+    response = client.put(f'/api/admin/employees/{employee_id}', headers=admin_headers, json={'is_active': 'false'})
+    assert response.status_code == 400
+
+    response = client.put(f'/api/admin/employees/{employee_id}', headers=admin_headers, json={'is_active': False})
+    assert response.status_code == 200
+    response = client.put(f'/api/admin/employees/{employee_id}', headers=admin_headers, json={'is_active': 'false'})
+    assert response.status_code == 400
+    # Konto pozostaje nieaktywne
+    assert client.post('/api/auth/login', json={'email': 'employee.string@example.com', 'password': '12345678'}).status_code != 200
@@ -0,0 +1,24 @@
+from datetime import date
+
+
+def test_posted_expense_status_is_discarded(app):
+    from models import db, Currency, ExchangeRate, ExpenseCategory
+    from services.expenses import validate_expenses
+
+    with app.app_context():
+        currency = Currency(name='EUR-status-test')
+        category = ExpenseCategory(name='Hotel')
+        db.session.add_all([currency, category])
+        db.session.flush()
+        db.session.add(ExchangeRate(currency_id=currency.id, rate_to_pln=4.3, date_set=date(2026, 1, 1)))
+        db.session.commit()
+
+        rows, errors = validate_expenses([
+            {'amount': '10', 'currency_id': currency.id, 'category_id': category.id, 'status': 'APPROVED'},
+            {'amount': '20', 'currency_id': currency.id, 'category_id': category.id, 'status': 'REJECTED'},
+            {'amount': '30', 'currency_id': currency.id, 'category_id': category.id},
+        ])
+
+    assert errors == []
+    # Pracownik nie może sam zatwierdzić ani odrzucić wydatku
+    assert [row['status'] for row in rows] == ['draft', 'draft', 'draft']
@@ -0,0 +1,21 @@
+from services.token_versions import LocalVersionStore, TokenVersions
+
+
+def test_stale_fill_does_not_overwrite_published_version():
+    store = LocalVersionStore(ttl=30)
+    versions = TokenVersions(store)
+
+    # Podbicie opublikowane po commicie, potem spóźnione uzupełnienie odczytem sprzed commitu
+    versions.publish(7, 2)
+    store.fill(7, 1)
+
+    assert store.get(7) == 2
+
+
+def test_fill_replaces_missing_or_older_version():
+    store = LocalVersionStore(ttl=30)
+
+    store.fill(7, 1)
+    assert store.get(7) == 1
+    store.fill(7, 3)
+    assert store.get(7) == 3
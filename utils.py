@@ -1,10 +1,12 @@
 """
 Utility functions for role-based access control
 """
+import hashlib
 from functools import wraps
-from flask import jsonify
-from flask_jwt_extended import get_jwt_identity
+from flask import current_app, jsonify, g, request
+from flask_jwt_extended import get_jwt_identity, get_jwt
 from models import Employee
+from services.principal_cache import Principal, get_principal
 
 def require_role(*allowed_roles):
     """
@@ -20,33 +22,78 @@ def require_role(*allowed_roles):
                     "status": "error",
                     "message": "Authentication required"
                 }), 401
-            
-            employee = Employee.query.get(employee_id)
-            if not employee:
+
+            principal = get_current_principal()
+            if not principal:
                 return jsonify({
                     "status": "error",
                     "message": "Employee not found"
                 }), 404
-            
-            if not employee.is_active:
+
+            if not principal.is_active:
                 return jsonify({
                     "status": "error",
                     "message": "Account is inactive"
                 }), 403
-            
-            if employee.role not in allowed_roles:
+
+            if principal.role not in allowed_roles:
                 return jsonify({
                     "status": "error",
                     "message": f"Access denied. Required role: {', '.join(allowed_roles)}"
                 }), 403
-            
+
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+def get_current_principal():
+    """
+    Helper function to get identity (id, role, is_active, manager_id) of the
+    current employee. Tokens with role/version claims are trusted as they are
+    (stale versions are rejected by the JWT blocklist check), older tokens
+    go through the principal cache - no database round trip either way
+    """
+    if 'principal' in g:
+        return g.principal
+    employee_id = get_jwt_identity()
+    if not employee_id:
+        return None
+    claims = get_jwt()
+    if 'role' in claims and 'ver' in claims:
+        g.principal = Principal(
+            id=int(employee_id),
+            role=claims['role'],
+            is_active=True,
+            manager_id=claims.get('manager_id')
+        )
+    else:
+        g.principal = get_principal(employee_id)
+    return g.principal
+
 def get_current_employee():
     """Helper function to get current employee from JWT"""
     employee_id = get_jwt_identity()
     if not employee_id:
         return None
     return Employee.query.get(employee_id)
+
+def make_etag(*parts):
+    """Silny ETag z wersji reprezentacji (wersje wierszy, kubełek podpisanych URL-i itp.)"""
+    return hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+def not_modified_response(etag):
+    """Odpowiedź 304 gdy If-None-Match pasuje do etag, w przeciwnym razie None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    return _revalidate(response, etag)
+
+def etag_response(payload, etag):
+    """JSON 200 z ETagiem; klient musi rewalidować (If-None-Match) przed użyciem kopii"""
+    return _revalidate(jsonify(payload), etag)
+
+def _revalidate(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response